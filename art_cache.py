@@ -0,0 +1,216 @@
+"""
+Cover art for the MP3s: finding it, shrinking it and caching the result.
+
+The cover comes from the FLAC's PICTURE blocks (the front cover if there is one) or else from an
+image file next to the tracks (cover.jpg, folder.jpg, front.jpg...). Images within the size and byte
+limits are embedded unchanged; bigger ones are scaled down and re-encoded as JPEG by FFmpeg.
+Results are cached by a hash of the source image and the limits, in memory (LRU, for the tracks of
+an album) and on disk (LRU by modification time, across runs). Threads asking for an image that is
+already being processed wait for it instead of processing it again.
+"""
+import hashlib
+import os
+import struct
+import subprocess
+import tempfile
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+from flac_reader import FRONT_COVER, read_picture_data
+from governor import run_lowered
+
+# Image files looked for next to the tracks, in order of preference (case insensitive)
+COVER_FILENAMES = ["cover.jpg", "cover.jpeg", "cover.png", "folder.jpg", "folder.jpeg", "folder.png",
+                   "front.jpg", "front.jpeg", "front.png", "albumart.jpg"]
+
+# Processed covers kept in memory; a batch usually goes through one album at a time
+MEMORY_ITEMS = 64
+
+MIME_EXTENSIONS = {"image/jpeg": ".jpg", "image/png": ".png"}
+
+def default_cache_dir():
+    """Per-user cache folder: %LOCALAPPDATA% on Windows, $XDG_CACHE_HOME or ~/.cache elsewhere"""
+    if os.name == "nt":
+        base = os.environ.get("LOCALAPPDATA") or tempfile.gettempdir()
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "flac2mp3", "art")
+
+def image_mime(data):
+    if data[:3] == b"\xff\xd8\xff":
+        return "image/jpeg"
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        return "image/png"
+    return ""
+
+def image_dimensions(data):
+    """(width, height) of a JPEG or PNG image from its header, (0, 0) if it cannot be determined"""
+    if data[:8] == b"\x89PNG\r\n\x1a\n" and len(data) >= 24:
+        return struct.unpack(">II", data[16:24])
+    if data[:2] == b"\xff\xd8":
+        offset = 2
+        while offset + 9 < len(data):
+            if data[offset] != 0xFF:
+                break
+            marker = data[offset + 1]
+            segment_length, = struct.unpack(">H", data[offset + 2:offset + 4])
+            # Start Of Frame markers (except DHT, JPG and DAC) carry the dimensions
+            if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                height, width = struct.unpack(">HH", data[offset + 5:offset + 9])
+                return width, height
+            offset += 2 + segment_length
+    return 0, 0
+
+def find_folder_cover(folder):
+    """Path of the preferred cover image file in folder, or None"""
+    try:
+        names = {entry.name.lower(): entry.path for entry in os.scandir(folder) if entry.is_file()}
+    except OSError:
+        return None
+    for name in COVER_FILENAMES:
+        if name in names:
+            return names[name]
+    return None
+
+def choose_picture(pictures):
+    """The front cover among a FLAC's pictures, else the first one"""
+    for picture in pictures:
+        if picture["type"] == FRONT_COVER:
+            return picture
+    return pictures[0] if pictures else None
+
+class ArtCache:
+    def __init__(self, settings, cache_dir=None):
+        self.settings = settings # For the priority of the resizing FFmpeg (see governor.py)
+        self.ffmpeg_path = settings["ffmpeg_path"]
+        self.max_size = settings.get("art_max_size", 600)
+        self.max_bytes = settings.get("art_max_bytes", 200000)
+        self.jpeg_qscale = settings.get("art_jpeg_qscale", 3)
+        self.disk_limit = settings.get("art_cache_max_bytes", 200 * 1024 * 1024)
+        self.cache_dir = Path(cache_dir or settings.get("art_cache_dir") or default_cache_dir())
+        self.memory = OrderedDict() # key -> artwork dict, least recently used first
+        self.in_flight = {} # key -> Event set when the thread processing it is done
+        self.folder_covers = {} # folder -> cover file path or None
+        self.lock = threading.Lock()
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "processed": 0}
+
+    def cover_for(self, flac_path, pictures):
+        """
+        Artwork dict (data, mime, path of the cached file) for a track, or None when it has no cover.
+        Raises OSError when the image cannot be read or converted.
+        """
+        picture = choose_picture(pictures)
+        if picture:
+            data = read_picture_data(flac_path, picture)
+        else:
+            folder = str(Path(flac_path).parent)
+            with self.lock:
+                if folder not in self.folder_covers:
+                    self.folder_covers[folder] = find_folder_cover(folder)
+                cover_path = self.folder_covers[folder]
+            if not cover_path:
+                return None
+            with open(cover_path, "rb") as f:
+                data = f.read()
+        return self.get(data)
+
+    def key(self, data):
+        limits = f"{self.max_size}:{self.max_bytes}:{self.jpeg_qscale}"
+        return hashlib.sha1(data).hexdigest() + "-" + hashlib.sha1(limits.encode()).hexdigest()[:8]
+
+    def get(self, data):
+        """The artwork for image bytes, from the caches or processed now"""
+        key = self.key(data)
+        while True:
+            with self.lock:
+                if key in self.memory:
+                    self.memory.move_to_end(key)
+                    self.stats["memory_hits"] += 1
+                    return self.memory[key]
+                event = self.in_flight.get(key)
+                if event is None:
+                    event = self.in_flight[key] = threading.Event()
+                    break
+            # Another thread is processing this image: wait, then look again (it may have failed)
+            event.wait()
+
+        try:
+            artwork = self.load_from_disk(key)
+            if artwork:
+                with self.lock:
+                    self.stats["disk_hits"] += 1
+            else:
+                artwork = self.process(key, data)
+                with self.lock:
+                    self.stats["processed"] += 1
+            with self.lock:
+                self.memory[key] = artwork
+                while len(self.memory) > MEMORY_ITEMS:
+                    self.memory.popitem(last=False)
+            return artwork
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+            event.set()
+
+    def load_from_disk(self, key):
+        for mime, extension in MIME_EXTENSIONS.items():
+            path = self.cache_dir / key[:2] / (key + extension)
+            try:
+                with open(path, "rb") as f:
+                    data = f.read()
+            except OSError:
+                continue
+            os.utime(path) # Mark as recently used for the disk LRU
+            return {"data": data, "mime": mime, "path": str(path)}
+        return None
+
+    def process(self, key, data):
+        """Keep the image as is when it is within the limits, otherwise scale it down to a JPEG"""
+        mime = image_mime(data)
+        width, height = image_dimensions(data)
+        within_limits = mime and 0 < max(width, height) <= self.max_size and len(data) <= self.max_bytes
+        if not within_limits:
+            data, mime = self.resize(data), "image/jpeg"
+
+        path = self.cache_dir / key[:2] / (key + MIME_EXTENSIONS[mime])
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = path.with_name(f".{path.name}.{threading.get_ident()}.tmp")
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+        return {"data": data, "mime": mime, "path": str(path)}
+
+    def resize(self, data):
+        """Scale an image to fit max_size x max_size (never up) and encode it as JPEG with FFmpeg"""
+        scale = (f"scale='min({self.max_size},iw)':'min({self.max_size},ih)'"
+                 ":force_original_aspect_ratio=decrease")
+        cmd = [self.ffmpeg_path, "-hide_banner", "-v", "error", "-i", "pipe:0", "-vf", scale,
+               "-frames:v", "1", "-q:v", str(self.jpeg_qscale), "-c:v", "mjpeg", "-f", "image2", "pipe:1"]
+        try:
+            result = run_lowered(cmd, self.settings, timeout=60, input=data)
+        except (subprocess.TimeoutExpired, FileNotFoundError) as e:
+            raise OSError(f"Could not resize cover art: {e}")
+        if result.returncode != 0 or not result.stdout:
+            raise OSError(f"Could not resize cover art: {result.stderr.decode(errors='replace').strip()}")
+        return result.stdout
+
+    def trim_disk(self):
+        """Delete the least recently used cached images until the disk cache is within its size limit"""
+        files = []
+        for path in self.cache_dir.glob("*/*"):
+            try:
+                stat = path.stat()
+                files.append((stat.st_mtime, stat.st_size, path))
+            except OSError:
+                continue
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.disk_limit:
+                break
+            try:
+                path.unlink()
+                total -= size
+            except OSError:
+                continue
@@ -0,0 +1,196 @@
+"""
+Benchmark for the conversion pipeline.
+
+Generates a deterministic corpus of synthetic FLAC files with the configured FFmpeg, then runs
+the headless conversion engine over it once per configuration (worker count x decode mode x
+quality), each in a fresh process so its peak memory figures are its own, and writes the
+measurements as JSON, so runs can be compared over time.
+
+Example:
+    python benchmark.py --count 50 --duration 60 --workers 1,4,8 --modes stream,wav --qualities 128,320 \\
+        --output results.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+try:
+    import resource # Unix only: child CPU time and peak RSS
+except ImportError:
+    resource = None
+
+from converter_core import ConverterCore, DEFAULT_SETTINGS
+
+# Tag sets written into the corpus; "full" exercises long and non-ASCII values
+TAG_SETS = {
+    "none": {},
+    "basic": {"artist": "Benchmark Artist", "album": "Benchmark Album", "date": "2024"},
+    "full": {"artist": "Bénchmark Ärtist feat. Ensemble", "album": "Benchmark Album (Deluxe Edition)",
+             "albumartist": "Bénchmark Ärtist", "date": "2024-01-01", "genre": "Electronic",
+             "composer": "Composer Name", "comment": "x" * 512}
+}
+
+def parse_list(value, cast=str):
+    return [cast(item.strip()) for item in value.split(",") if item.strip()]
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark FLAC to MP3 conversion on a synthetic corpus.")
+    parser.add_argument("--corpus", default=os.path.join(tempfile.gettempdir(), "flac2mp3-benchmark-corpus"),
+                        help="Folder for the generated FLAC corpus (reused when its parameters match)")
+    parser.add_argument("--count", type=int, default=20, help="Number of FLAC files")
+    parser.add_argument("--duration", type=float, default=30, help="Duration of each file in seconds")
+    parser.add_argument("--sample-rate", type=int, default=44100)
+    parser.add_argument("--bit-depth", type=int, choices=[16, 24], default=16)
+    parser.add_argument("--channels", type=int, default=2)
+    parser.add_argument("--tags", choices=sorted(TAG_SETS), default="basic", help="Tag set written into each file")
+    parser.add_argument("--workers", default="1", help="Comma separated worker counts, e.g. 1,4,8")
+    parser.add_argument("--modes", default="stream,wav",
+                        help="Comma separated modes: stream, wav (FFmpeg -> LAME) and ffmpeg (single process)")
+    parser.add_argument("--qualities", default=DEFAULT_SETTINGS["quality"], help="Comma separated bitrates")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs per configuration")
+    parser.add_argument("--lame", default=DEFAULT_SETTINGS["lame_path"], help="Path to the LAME executable")
+    parser.add_argument("--ffmpeg", default=DEFAULT_SETTINGS["ffmpeg_path"], help="Path to the FFmpeg executable")
+    parser.add_argument("--ffprobe", default=DEFAULT_SETTINGS["ffprobe_path"], help="Path to the FFprobe executable")
+    parser.add_argument("--output", help="Write the JSON results to this file instead of stdout")
+    return parser.parse_args(argv)
+
+def generate_corpus(args, ffmpeg_version):
+    """Create the synthetic FLAC files, or reuse them if a corpus with the same parameters exists"""
+    corpus = Path(args.corpus)
+    spec = {"count": args.count, "duration": args.duration, "sample_rate": args.sample_rate,
+            "bit_depth": args.bit_depth, "channels": args.channels, "tags": args.tags,
+            "ffmpeg": ffmpeg_version}
+    spec_file = corpus / "corpus.json"
+    if spec_file.exists() and json.loads(spec_file.read_text()) == spec:
+        return spec
+
+    shutil.rmtree(corpus, ignore_errors=True)
+    corpus.mkdir(parents=True)
+    sample_fmt = ["-sample_fmt", "s16"] if args.bit_depth == 16 else ["-sample_fmt", "s32", "-bits_per_raw_sample", "24"]
+    for i in range(args.count):
+        # Seeded noise plus a tone: deterministic, and hard enough to compress to be realistic
+        source = (f"anoisesrc=seed={i + 1}:amplitude=0.2:sample_rate={args.sample_rate}:duration={args.duration}"
+                  f"[n];sine=frequency={220 + 20 * i}:sample_rate={args.sample_rate}:duration={args.duration}[s];"
+                  f"[n][s]amix=inputs=2,aformat=channel_layouts={'mono' if args.channels == 1 else 'stereo'}")
+        tags = {**TAG_SETS[args.tags], "title": f"Track {i + 1:03d}", "tracknumber": str(i + 1)}
+        metadata = [arg for key, value in tags.items() for arg in ("-metadata", f"{key}={value}")]
+        cmd = [args.ffmpeg, "-v", "error", "-y", "-filter_complex", source, *sample_fmt,
+               "-fflags", "+bitexact", "-flags:a", "+bitexact", *metadata,
+               "-c:a", "flac", str(corpus / f"track_{i + 1:03d}.flac")]
+        subprocess.run(cmd, check=True)
+    spec_file.write_text(json.dumps(spec))
+    return spec
+
+def rusage():
+    """(self, children) resource usage, or None where the resource module is unavailable"""
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+
+def run_configuration(args, corpus_spec, workers, mode, quality):
+    """Convert the whole corpus once with one configuration and return its measurements"""
+    settings = dict(DEFAULT_SETTINGS)
+    settings.update({
+        "lame_path": args.lame,
+        "ffmpeg_path": args.ffmpeg,
+        "ffprobe_path": args.ffprobe,
+        "quality": quality,
+        "workers": workers,
+        "encoder_engine": "ffmpeg" if mode == "ffmpeg" else "lame",
+        "stream_decode": mode == "stream",
+        "incremental": False,
+        # Run exactly the configured workers at normal priority, with the default I/O scheduling pinned
+        # so later changes to the defaults do not change what the results measure
+        "adaptive_workers": False,
+        "process_nice": 0,
+        "process_io_class": "",
+        "cpu_affinity": [],
+        "readers_per_device": 1,
+        "stage_outputs": "never"
+    })
+    core = ConverterCore(settings, log=lambda message: None)
+
+    dest_folder = Path(tempfile.mkdtemp(prefix="flac2mp3-benchmark-"))
+    try:
+        usage_before = rusage()
+        start = time.perf_counter()
+        summary = core.convert_files(args.corpus, dest_folder)
+        wall_seconds = time.perf_counter() - start
+        usage_after = rusage()
+        output_bytes = sum(p.stat().st_size for p in dest_folder.rglob("*.mp3"))
+    finally:
+        shutil.rmtree(dest_folder, ignore_errors=True)
+
+    audio_seconds = corpus_spec["count"] * corpus_spec["duration"]
+    result = {
+        "config": {"workers": workers, "mode": mode, "quality": quality},
+        "converted": summary["converted"],
+        "failed": summary["failed"],
+        "wall_seconds": round(wall_seconds, 3),
+        "files_per_second": round(summary["converted"] / wall_seconds, 3),
+        "realtime_factor": round(audio_seconds / wall_seconds, 2),
+        "output_bytes": output_bytes,
+        # Summed over all files, so with several workers the total exceeds the wall time
+        "stage_seconds": {stage: round(seconds, 3) for stage, seconds in summary["stage_seconds"].items()}
+    }
+    if usage_before:
+        # ru_maxrss is in KiB on Linux and bytes on macOS; for children it is the largest single child
+        scale = 1 if sys.platform == "darwin" else 1024
+        result["peak_rss_bytes"] = {"self": usage_after[0].ru_maxrss * scale,
+                                    "largest_child": usage_after[1].ru_maxrss * scale}
+        result["child_cpu_seconds"] = round(
+            (usage_after[1].ru_utime - usage_before[1].ru_utime) + (usage_after[1].ru_stime - usage_before[1].ru_stime), 3)
+    return result
+
+def run_isolated(args, corpus_spec, workers, mode, quality):
+    """
+    run_configuration in a new process: ru_maxrss is a maximum over a process's lifetime (and over all
+    its children), so in a shared process every run would report the largest seen by earlier runs
+    """
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+        return pool.submit(run_configuration, args, corpus_spec, workers, mode, quality).result()
+
+def main(argv=None):
+    args = parse_args(argv)
+    versions = ConverterCore(dict(DEFAULT_SETTINGS), log=lambda message: None)
+    print(f"Preparing corpus in {args.corpus}...", file=sys.stderr)
+    corpus_spec = generate_corpus(args, versions.tool_version(args.ffmpeg, "-version"))
+
+    runs = []
+    for workers in parse_list(args.workers, int):
+        for mode in parse_list(args.modes):
+            for quality in parse_list(args.qualities):
+                for _ in range(args.repeat):
+                    print(f"Running workers={workers} mode={mode} quality={quality}...", file=sys.stderr)
+                    runs.append(run_isolated(args, corpus_spec, workers, mode, quality))
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "ffmpeg": corpus_spec["ffmpeg"],
+            "lame": versions.tool_version(args.lame, "--version")
+        },
+        "corpus": corpus_spec,
+        "runs": runs
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(text)
+    else:
+        print(text)
+    return 1 if any(run["failed"] for run in runs) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
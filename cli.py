@@ -0,0 +1,267 @@
+"""
+Command line front end for the FLAC to MP3 converter.
+
+Runs the same conversion engine as the GUI without importing tkinter, so it works on
+machines without a display and from cron. Progress is printed to stdout as JSON lines,
+log messages go to stderr. The exit code is 0 when every file converted, 1 when any
+file failed, 2 when the arguments or tools are invalid and 130 when the run was cancelled
+with Ctrl-C (or SIGTERM); a second Ctrl-C exits immediately.
+
+With --watch the program keeps running after the first batch and converts FLAC files as they
+are added to the source folder, until it is stopped with Ctrl-C or SIGTERM.
+
+With --queue the conversions are shared out between worker processes, on this host or others,
+that run with --worker and the same queue folder (on storage all of them can reach).
+
+Example:
+    python cli.py ~/Music/Album --dest ~/Music/Album/MP3 --quality 256 --workers 8
+
+Several versions in one run, each source decoded once (into MP3/320, MP3/V0 and MP3/low):
+    python cli.py ~/Music/Album --profile 320 --profile V0 --profile 128:low
+
+Where each file would go, without converting anything:
+    python cli.py ~/Music/Album --dry-run
+
+A library converted by several hosts (the coordinator, then one worker per host):
+    python cli.py /nfs/music --dest /nfs/mp3 --queue /nfs/queue
+    python cli.py --worker /nfs/queue
+"""
+import argparse
+import json
+import os
+import signal
+import sys
+import threading
+from pathlib import Path
+
+from converter_core import ConverterCore, DEFAULT_SETTINGS
+from distributed import WorkerToolsError, run_coordinator, run_worker
+from profiles import parse_profile, parse_quality, profiles_from_settings
+from watcher import watch_folder
+
+def quality_arg(value):
+    try:
+        parse_quality(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+    return value
+
+def profile_arg(value):
+    try:
+        return parse_profile(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+def cpus_arg(value):
+    """CPU numbers from a list like "0-3,6" """
+    try:
+        cpus = []
+        for part in value.split(","):
+            first, _, last = part.partition("-")
+            cpus += range(int(first), int(last or first) + 1)
+        return sorted(set(cpus))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"not a CPU list like 0-3,6: {value}")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Convert a folder of FLAC files to MP3.")
+    parser.add_argument("source", nargs="?",
+                        help="Folder containing the FLAC files (with --worker: where this host mounts the coordinator's)")
+    parser.add_argument("--dest", help="Destination folder (default: an 'MP3' folder inside the source folder)")
+    parser.add_argument("--template", default=DEFAULT_SETTINGS["filename_template"],
+                        help="Filename template, variables: {artist}, {title}, {album}, {track}, {year}")
+    parser.add_argument("--quality", type=quality_arg, default=DEFAULT_SETTINGS["quality"],
+                        help="MP3 bitrate in kbps, or V0 to V9 for VBR")
+    parser.add_argument("--profile", type=profile_arg, action="append", default=[], metavar="QUALITY[:FOLDER[:TEMPLATE]]",
+                        help="Encode to this quality into FOLDER (default: named after the quality) inside the "
+                             "destination; repeat for several versions from a single decode. Replaces --quality")
+    parser.add_argument("--workers", type=int, default=DEFAULT_SETTINGS["workers"],
+                        help="Number of parallel conversions (0 = one per CPU core)")
+    parser.add_argument("--nice", type=int, default=DEFAULT_SETTINGS["process_nice"],
+                        help="Niceness of the FFmpeg/LAME processes (0 = normal priority)")
+    parser.add_argument("--cpus", type=cpus_arg, default=[], metavar="LIST",
+                        help="Only run the conversions on these CPUs, e.g. 0-3,6")
+    parser.add_argument("--no-adaptive", action="store_true",
+                        help="Always run --workers conversions, however busy the machine is")
+    parser.add_argument("--readers", type=int, default=DEFAULT_SETTINGS["readers_per_device"], metavar="N",
+                        help="Sources read ahead at the same time from one disk (0 = let each decoder read its file)")
+    parser.add_argument("--stage", choices=["auto", "always", "never"], default=DEFAULT_SETTINGS["stage_outputs"],
+                        help="Encode into the temporary folder and copy each MP3 to the destination in one write "
+                             "(auto: when the destination is on another device)")
+    parser.add_argument("--lame", default=DEFAULT_SETTINGS["lame_path"], help="Path to the LAME executable")
+    parser.add_argument("--ffmpeg", default=DEFAULT_SETTINGS["ffmpeg_path"], help="Path to the FFmpeg executable")
+    parser.add_argument("--ffprobe", default=DEFAULT_SETTINGS["ffprobe_path"], help="Path to the FFprobe executable")
+    parser.add_argument("--engine", choices=["auto", "ffmpeg", "lame"], default=DEFAULT_SETTINGS["encoder_engine"],
+                        help="Encoder engine: single-process FFmpeg/libmp3lame, FFmpeg -> LAME, or auto (default)")
+    parser.add_argument("--no-stream", action="store_true",
+                        help="Decode to a temporary WAV file instead of piping FFmpeg into LAME")
+    parser.add_argument("--no-recursive", action="store_true",
+                        help="Only convert the FLAC files directly inside the source folder")
+    parser.add_argument("--include", action="append", default=[], metavar="PATTERN",
+                        help="Only convert files matching this glob (relative to the source folder), repeatable")
+    parser.add_argument("--exclude", action="append", default=[], metavar="PATTERN",
+                        help="Skip files and folders matching this glob, repeatable")
+    parser.add_argument("--schedule", choices=["longest_first", "scan_order"], default=DEFAULT_SETTINGS["schedule"],
+                        help="Convert the longest tracks first (default, shortest total time) or in scan order")
+    parser.add_argument("--full", action="store_true",
+                        help="Convert every file, even those the destination manifest shows as unchanged")
+    parser.add_argument("--hash", action="store_true",
+                        help="Record a content hash of each source so touched but unchanged files are skipped")
+    parser.add_argument("--no-tags", action="store_true", help="Do not write the FLAC tags to the MP3s")
+    parser.add_argument("--retag", action="store_true",
+                        help="Only rewrite the ID3 tags of already converted MP3s from their FLAC sources, without encoding")
+    parser.add_argument("--no-art", action="store_true", help="Do not embed cover art")
+    parser.add_argument("--art-size", type=int, default=DEFAULT_SETTINGS["art_max_size"],
+                        help="Scale embedded covers down to at most this many pixels per side")
+    parser.add_argument("--no-dedup", action="store_true",
+                        help="Encode every file, even when an MP3 of identical audio was already made")
+    parser.add_argument("--replaygain", action="store_true",
+                        help="Measure the loudness (EBU R128) while decoding and write ReplayGain 2.0 track and album tags")
+    parser.add_argument("--no-album-gain", action="store_true",
+                        help="With --replaygain, write only track gains (albums are the tracks of one source folder)")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Only print the output path each file would get (and which are unchanged), writing nothing")
+    parser.add_argument("--watch", action="store_true",
+                        help="Keep running and convert FLAC files as they are added or changed")
+    parser.add_argument("--settle", type=float, default=DEFAULT_SETTINGS["watch_settle_seconds"],
+                        help="Watch mode: seconds a file must stay unchanged before it is converted")
+    parser.add_argument("--poll", action="store_true",
+                        help="Watch mode: rescan periodically instead of using inotify")
+    parser.add_argument("--queue", metavar="DIR",
+                        help="Queue the conversions in this shared folder for --worker processes instead of running them")
+    parser.add_argument("--worker", metavar="DIR",
+                        help="Run conversions queued in this shared folder by a --queue coordinator, until it is done")
+    parser.add_argument("--lease", type=float, default=DEFAULT_SETTINGS["queue_lease_seconds"],
+                        help="Queue mode: seconds after which the job of a worker that stopped responding is run again")
+    parser.add_argument("--stall-timeout", type=float, default=DEFAULT_SETTINGS["stall_timeout"],
+                        help="Abort a conversion whose FFmpeg/LAME progress stops for this many seconds")
+    args = parser.parse_args(argv)
+    if args.queue and args.worker:
+        parser.error("--queue and --worker cannot be combined")
+    if args.worker and args.watch:
+        parser.error("--watch cannot be used with --worker")
+    if args.dry_run and (args.worker or args.queue or args.watch):
+        parser.error("--dry-run cannot be combined with --queue, --worker or --watch")
+    if not args.source and not args.worker:
+        parser.error("the source folder is required")
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    settings = dict(DEFAULT_SETTINGS)
+    settings.update({
+        "filename_template": args.template,
+        "quality": args.quality,
+        "profiles": args.profile,
+        "workers": max(0, args.workers),
+        "process_nice": max(0, args.nice),
+        "cpu_affinity": args.cpus,
+        "adaptive_workers": not args.no_adaptive,
+        "readers_per_device": max(0, args.readers),
+        "stage_outputs": args.stage,
+        "lame_path": args.lame,
+        "ffmpeg_path": args.ffmpeg,
+        "ffprobe_path": args.ffprobe,
+        "encoder_engine": args.engine,
+        "stream_decode": not args.no_stream,
+        "recursive": not args.no_recursive,
+        "include_patterns": args.include,
+        "exclude_patterns": args.exclude,
+        "schedule": args.schedule,
+        "incremental": not args.full,
+        "manifest_hash": args.hash,
+        "stall_timeout": args.stall_timeout,
+        "write_tags": not args.no_tags,
+        "retag_only": args.retag,
+        "embed_art": not args.no_art,
+        "art_max_size": args.art_size,
+        "dedup": not args.no_dedup,
+        "replaygain": args.replaygain,
+        "replaygain_album": not args.no_album_gain,
+        "watch_settle_seconds": args.settle,
+        "watch_method": "polling" if args.poll else "auto",
+        "queue_lease_seconds": args.lease
+    })
+
+    # Events can arrive from several worker threads; keep each JSON line intact
+    output_lock = threading.Lock()
+
+    def log(message):
+        with output_lock:
+            print(message, file=sys.stderr, flush=True)
+
+    def on_event(event, data):
+        with output_lock:
+            print(json.dumps({"event": event, **data}), flush=True)
+
+    core = ConverterCore(settings, log=log, on_event=on_event)
+
+    stopping = threading.Event()
+
+    def cancel(signum, frame):
+        # Restore the default handler so a second Ctrl-C stops immediately
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        stopping.set()
+        core.cancel()
+
+    if args.worker:
+        # The batch settings come from the coordinator; only the tools are this host's, tested against them
+        signal.signal(signal.SIGINT, cancel)
+        if hasattr(signal, "SIGTERM"):
+            signal.signal(signal.SIGTERM, cancel)
+        try:
+            counts = run_worker(core, args.worker, stopping, args.source, args.dest)
+        except WorkerToolsError as e:
+            for error in e.errors:
+                log(error)
+            return 2
+        if counts is None or stopping.is_set():
+            return 130
+        return 1 if counts.get("failed") else 0
+
+    source_folder = Path(args.source)
+    if not source_folder.is_dir():
+        log(f"Error: source folder does not exist: {source_folder}")
+        return 2
+    dest_folder = Path(args.dest) if args.dest else source_folder / "MP3"
+    try:
+        profiles_from_settings(settings, dest_folder)
+    except ValueError as e:
+        log(f"Error: {e}")
+        return 2
+
+    if args.dry_run:
+        core.plan_files(source_folder, dest_folder)
+        return 0
+
+    errors = core.test_tools()
+    if errors:
+        for error in errors:
+            log(error)
+        return 2
+
+    os.makedirs(dest_folder, exist_ok=True)
+    log(f"Using destination folder: {dest_folder}")
+
+    signal.signal(signal.SIGINT, cancel)
+    if hasattr(signal, "SIGTERM"):
+        signal.signal(signal.SIGTERM, cancel)
+
+    if args.watch:
+        watch_folder(core, source_folder, dest_folder, stopping)
+        return 0
+
+    if args.queue:
+        summary = run_coordinator(core, source_folder, dest_folder, args.queue, stopping)
+        if summary["was_cancelled"]:
+            return 130
+        return 1 if summary["failed"] else 0
+
+    summary = core.convert_files(source_folder, dest_folder)
+    if summary["was_cancelled"]:
+        return 130
+    return 1 if summary["failed"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
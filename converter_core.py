@@ -0,0 +1,1058 @@
+"""
+Conversion engine for the FLAC to MP3 converter.
+
+Scans a folder for FLAC files, reads their metadata and converts them with FFmpeg and LAME.
+This module does not depend on tkinter: the GUI (main.py) and the command line front end (cli.py)
+both drive the same ConverterCore and receive its output through callbacks.
+"""
+import os
+import itertools
+import json
+import queue
+import threading
+from pathlib import Path
+import re
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from art_cache import ArtCache
+from dedup import AudioDedup, usable_md5
+from encoders import select_engine, partial_output_path, commit_output
+from flac_reader import read_flac_info, FlacFormatError
+from governor import WorkerGovernor, run_lowered
+from id3 import frames_from_tags, update_txxx, write_tag
+from iosched import IOScheduler
+from jobcontrol import BatchControl
+from journal import JobJournal, is_same_batch, remove_stale_partials
+from loudness import album_loudness, analyse_loudness, is_measured, replaygain_frames, replaygain_values
+from manifest import ConversionManifest
+from planner import OutputPlanner
+from profiles import profiles_from_settings
+from run_report import RunReport
+from scanner import scan_flac_files
+from throughput import ThroughputSampler
+from toolchain import Toolchain
+
+# Conversion settings shared by every front end
+DEFAULT_SETTINGS = {
+    "filename_template": "{artist} - {title}",
+    # Set default paths based on OS, leave empty to force user selection initially
+    "lame_path": "" if os.name == "nt" else "/usr/bin/lame",
+    "ffmpeg_path": "" if os.name == "nt" else "/usr/bin/ffmpeg",
+    "ffprobe_path": "" if os.name == "nt" else "/usr/bin/ffprobe",
+    "quality": "320", # Bitrate in kbps, or "V0".."V9" for LAME's VBR presets
+    "profiles": [], # Several outputs per run: [{"quality": "V0", "dest": "V0", "template": ...}], empty = "quality" only
+    "workers": 0, # Number of parallel conversions, 0 = one per CPU core
+    "encoder_engine": "auto", # "ffmpeg" (single process, libmp3lame), "lame" (FFmpeg -> LAME) or "auto"
+    "stream_decode": True, # Pipe FFmpeg's PCM output straight into LAME instead of a temporary WAV
+    "incremental": True, # Skip sources the destination manifest shows as already converted
+    "manifest_hash": False, # Also record a content hash, so touched but unchanged sources are skipped
+    "recursive": True, # Scan subfolders and mirror the source tree in the destination
+    "include_patterns": [], # Glob patterns (relative to the source folder) a file must match, empty = all
+    "exclude_patterns": [], # Glob patterns of files and folders to leave out
+    "write_report": True, # Save a JSON run report with per-file timings in the destination folder
+    "schedule": "longest_first", # "longest_first" (shortest batch time) or "scan_order"
+    "schedule_window": 10000, # Files discovered ahead of the workers that the scheduler can choose from
+    "stall_timeout": 60, # Abort a conversion whose FFmpeg/LAME progress output stops advancing for this long
+    "timeout_base": 120, # Longest a conversion may take is timeout_base + timeout_per_audio_second x track length
+    "timeout_per_audio_second": 2.0,
+    "fsync_outputs": True, # Flush each finished MP3 to disk before renaming it into place
+    "write_tags": True, # Write the FLAC tags to the MP3s as ID3v2.4
+    "retag_only": False, # Only rewrite the tags of already converted MP3s, without encoding
+    "embed_art": True, # Embed the FLAC's cover (or cover.jpg/folder.jpg... next to it) in the MP3s
+    "art_max_size": 600, # Covers larger than this many pixels on either side are scaled down...
+    "art_max_bytes": 200000, # ...as are covers bigger than this many bytes
+    "art_jpeg_qscale": 3, # JPEG quality of scaled covers, FFmpeg -q:v scale: 2 (best) to 31
+    "art_cache_dir": "", # Where processed covers are kept between runs, empty = per-user cache folder
+    "art_cache_max_bytes": 200 * 1024 * 1024,
+    "dedup": True, # Reuse the MP3 of identical audio (same STREAMINFO MD5) instead of encoding it again
+    "dedup_hardlink": True, # Hardlink such MP3s when their tags are identical too, otherwise copy and retag
+    "replaygain": False, # Measure EBU R128 loudness during the decode and write ReplayGain 2.0 tags
+    "replaygain_album": True, # With replaygain, also write album gain (the tracks of one source folder)
+    "watch_settle_seconds": 5, # Watch mode: convert a file once it has not changed for this long
+    "watch_method": "auto", # "auto" (inotify on Linux, else polling) or "polling"
+    "watch_poll_interval": 10, # Seconds between rescans when polling
+    "queue_lease_seconds": 120, # Queue mode: a job whose worker stops renewing its claim this long is run again...
+    "queue_max_attempts": 3, # ...up to this many times before it counts as failed
+    "queue_poll_interval": 2, # Seconds between looks at the queue folder when there is nothing to do
+    "process_nice": 10, # Niceness of the FFmpeg/LAME processes, 0 = normal priority (Windows: above 0 = below normal)
+    "process_io_class": "best-effort", # Linux I/O class of those processes: "best-effort", "idle" or "" (unchanged)
+    "process_io_level": 7, # Best-effort I/O priority, 0 (highest) to 7
+    "cpu_affinity": [], # CPU numbers the conversions may run on, empty = all
+    "adaptive_workers": True, # Run fewer conversions while the machine is busy with other work (governor.py)
+    "load_per_cpu": 1.0, # Load average per CPU the conversions may fill up to
+    "memory_reserve_mb": 512, # Run fewer conversions while less memory than this is available
+    "min_workers": 1, # Conversions kept running however busy the machine is
+    "governor_interval": 5, # Seconds between checks of the load and memory
+    "readers_per_device": 1, # Sources read ahead at the same time from one disk or mount (iosched.py), 0 = no read-ahead
+    "readahead_max_bytes": 512 * 1024 * 1024, # Memory for sources read ahead of their decode; larger files are not
+    "stage_outputs": "auto", # Encode into the temp folder, then copy each MP3 out in one write: "auto" (other device), "always", "never"
+    "writers_per_device": 1, # Staged MP3s copied to one destination disk or mount at the same time
+    "throughput_interval": 1.0, # Seconds between "throughput" events (live speed and ETA from the encoders' progress)
+    "throughput_smoothing": 20.0, # Seconds over which the speed is averaged
+    "tool_probes": {} # Versions and capabilities of the tools by path, re-probed when a binary changes (toolchain.py)
+}
+
+def display_path(output_path, dest_folder):
+    """Output path relative to the destination folder for the log, or in full when it is elsewhere"""
+    try:
+        return output_path.relative_to(dest_folder)
+    except ValueError:
+        return output_path
+
+# Typical FLAC bitrate (16 bit / 44.1 kHz stereo), used to estimate a duration from the file size
+ESTIMATED_FLAC_BYTES_PER_SECOND = 110000
+
+class ConverterCore:
+    """
+    Runs the scan -> metadata -> convert pipeline.
+
+    log(message) receives human readable log lines, on_event(event, data) receives structured
+    progress events ("start", "file_done", "complete") and on_error(title, message) is called
+    for errors that deserve the user's attention. All callbacks may be called from worker threads.
+    """
+    def __init__(self, settings, log=print, on_event=None, on_error=None):
+        self.settings = settings
+        self.log = log
+        self.on_event = on_event
+        self.on_error = on_error
+        self.profiles = [] # OutputProfiles of the current batch, each with its manifest and dedup index
+        self.journal = None # Job journal of the current batch
+        self.resumed = {} # source -> output of files an interrupted run of this batch already converted
+        self.art_cache = None # Processed cover art, shared by the worker threads
+        self.toolchain = Toolchain(self.settings) # Tool versions and capabilities, cached in the settings
+        self.engine = None # EncoderEngine used for the current batch
+        self.stage_totals = {} # Seconds spent per stage in the current batch, summed over all files
+        self.gain_folders = set() # Source folders whose album gain must be written at the end of the batch
+        self.stats_lock = threading.Lock()
+        self.report = None # RunReport of the current batch
+        self.current = threading.local() # .record: report record of the file this worker thread is processing
+        self.control = BatchControl() # Cancel/pause state of the current batch, replaced per batch
+        self.io = IOScheduler(settings) # Per-device read and write limits, replaced per batch
+    
+    def emit(self, event, **data):
+        """Send a progress event to the front end, if it listens for them"""
+        if self.on_event:
+            self.on_event(event, data)
+    
+    @contextmanager
+    def timed(self, stage):
+        """
+        Measure the wall-clock time spent in the block, adding it to the batch's total for stage
+        and to the report record of the file the calling worker thread is processing.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.add_stage_time(stage, elapsed)
+    
+    def annotate(self, **fields):
+        """Set fields on the report record of the file the calling worker thread is processing"""
+        record = getattr(self.current, "record", None)
+        if record is not None:
+            record.update(fields)
+    
+    def count_written(self, paths):
+        """Add the sizes of outputs the calling worker thread has written to its report record"""
+        record = getattr(self.current, "record", None)
+        if record is not None:
+            record["bytes_written"] += sum(os.path.getsize(path) for path in paths)
+    
+    def add_stage_time(self, stage, elapsed):
+        with self.stats_lock:
+            self.stage_totals[stage] = self.stage_totals.get(stage, 0.0) + elapsed
+        record = getattr(self.current, "record", None)
+        if record is not None:
+            record["stages"][stage] = record["stages"].get(stage, 0.0) + elapsed
+    
+    def cancel(self):
+        """Cancel the running batch: running conversions are killed and their partial outputs removed"""
+        self.log("Cancelling...")
+        self.control.cancel()
+    
+    def pause(self):
+        self.log("Paused")
+        self.control.pause()
+    
+    def resume(self):
+        self.log("Resumed")
+        self.control.resume()
+    
+    def report_error(self, title, message):
+        """Surface an error to the front end, if it displays them"""
+        if self.on_error:
+            self.on_error(title, message)
+    
+    def test_executable(self, exec_path, name, test_arg="--help"):
+        """
+        Check that an executable exists and runs.
+
+        Returns (True, "") on success, otherwise (False, error message).
+        """
+        if not exec_path: # Path is empty
+            return False, f"Error: {name} path is empty."
+
+        if not os.path.exists(exec_path):
+            return False, f"Error: {name} not found at: {exec_path}"
+        
+        probe = self.toolchain.probe(exec_path, test_arg)
+        if probe["ok"]:
+            return True, ""
+        return False, f"Error: {name} test failed. Output: {probe['error']}"
+    
+    def required_tools(self):
+        """(settings key, display name, test argument) of every executable the current settings need"""
+        self.engine = select_engine(self)
+        return self.engine.required_tools() + [("ffprobe_path", "FFprobe", "-version")]
+    
+    def test_tools(self):
+        """Test the executables the selected engine needs; returns a list of error messages, empty when all work"""
+        errors = []
+        for path_key, name, test_arg in self.required_tools():
+            ok, error = self.test_executable(self.settings[path_key], name, test_arg)
+            if not ok:
+                errors.append(error)
+        return errors
+    
+    def tool_version(self, exec_path, version_arg):
+        """First line of a tool's version output, probed once per binary"""
+        return self.toolchain.probe(exec_path, version_arg)["version"]
+    
+    def ffmpeg_capabilities(self):
+        """What the configured FFmpeg can do ("libmp3lame", "sample_formats"), probed once per binary"""
+        return self.toolchain.ffmpeg_capabilities(self.settings["ffmpeg_path"])
+    
+    def probe_tools(self):
+        """
+        Probe every configured executable and the FFmpeg capabilities (slow the first time, cached
+        afterwards; meant for a background thread at startup). Returns {settings key: (ok, error)}.
+        """
+        names = {"lame_path": ("LAME encoder", "--version"), "ffmpeg_path": ("FFmpeg", "-version"),
+                 "ffprobe_path": ("FFprobe", "-version")}
+        results = {path_key: self.test_executable(self.settings[path_key], name, test_arg)
+                   for path_key, (name, test_arg) in names.items()}
+        if results["ffmpeg_path"][0]:
+            self.ffmpeg_capabilities()
+        return results
+    
+    def get_encoder_settings(self, profile):
+        """Settings that determine a profile's output; a change to any of them re-encodes every file"""
+        return {
+            "engine": self.engine.name,
+            "quality": profile.quality,
+            "template": profile.template,
+            "lame": self.tool_version(self.settings["lame_path"], "--version") if self.engine.name == "lame" else "",
+            "ffmpeg": self.tool_version(self.settings["ffmpeg_path"], "-version")
+        }
+    
+    def get_flac_metadata(self, flac_path):
+        """
+        Extract metadata from a FLAC file.
+
+        Tags and stream properties are read in-process from the FLAC metadata blocks; ffprobe is
+        only started when that fails. If both fail, falls back to using the filename as the title
+        and default values for other fields.
+        """
+        try:
+            with self.timed("metadata"):
+                info = read_flac_info(flac_path)
+            return self.build_metadata(info["tags"], info)
+        except (OSError, FlacFormatError) as e:
+            self.log(f"Could not read FLAC metadata of {flac_path.name} ({e}), trying ffprobe")
+        
+        with self.timed("ffprobe"):
+            return self.get_flac_metadata_ffprobe(flac_path)
+    
+    def build_metadata(self, tags, info):
+        """
+        Metadata dict used for filenames, from tags ({lowercase name: [values]}) and stream properties.
+        "tags" keeps every tag, for writing them to the MP3.
+        """
+        joined = {key: "; ".join(values) for key, values in tags.items()}
+        return {
+            "artist": joined.get("artist", "Unknown Artist"),
+            "title": joined.get("title", "Unknown Title"),
+            "album": joined.get("album", "Unknown Album"),
+            "track": joined.get("tracknumber", joined.get("track", "")),
+            "year": joined.get("date", joined.get("year", "")),
+            "duration": info.get("duration", 0.0),
+            "sample_rate": info.get("sample_rate", 0),
+            "bits_per_sample": info.get("bits_per_sample", 0),
+            "channels": info.get("channels", 0),
+            "tags": tags,
+            "pictures": info.get("pictures", []),
+            "audio_md5": usable_md5(info.get("md5", ""))
+        }
+    
+    def get_flac_metadata_ffprobe(self, flac_path):
+        """Extract metadata using ffprobe, for files the in-process reader cannot parse"""
+        ffprobe_path = self.settings["ffprobe_path"]
+        try:
+            cmd = [ffprobe_path, "-v", "quiet", "-print_format", "json", "-show_format", "-show_streams",
+                   "-select_streams", "a:0", str(flac_path)]
+            result = run_lowered(cmd, self.settings, timeout=30, text=True)
+
+            if result.returncode == 0:
+                data = json.loads(result.stdout)
+                format_info = data.get("format", {})
+                stream = (data.get("streams") or [{}])[0]
+                
+                # Normalize tag names (case insensitive)
+                normalized_tags = {}
+                for key, value in format_info.get("tags", {}).items():
+                    normalized_tags[key.lower()] = [value]
+                
+                return self.build_metadata(normalized_tags, {
+                    "duration": float(format_info.get("duration", 0) or 0),
+                    "sample_rate": int(stream.get("sample_rate", 0) or 0),
+                    "bits_per_sample": int(stream.get("bits_per_raw_sample", 0) or 0),
+                    "channels": int(stream.get("channels", 0) or 0)
+                })
+            else:
+                self.log(f"ffprobe failed for {flac_path.name}: {result.stderr.strip()}")
+        except Exception as e:
+            self.log(f"Error reading metadata from {flac_path.name}: {str(e)}")
+        
+        # Fallback to filename
+        filename = Path(flac_path).stem
+        return self.build_metadata({"title": [filename]}, {})
+    
+    def get_cover_art(self, flac_path, metadata):
+        """Cover art to embed for a track (an ArtCache artwork dict), or None"""
+        if not self.settings.get("embed_art", True):
+            return None
+        if self.art_cache is None:
+            self.art_cache = ArtCache(self.settings)
+        try:
+            with self.timed("art"):
+                return self.art_cache.cover_for(flac_path, metadata.get("pictures", []))
+        except OSError as e:
+            self.log(f"Could not prepare the cover art of {flac_path.name}, converting without it: {e}")
+            return None
+    
+    def sanitize_filename(self, filename):
+        """Remove invalid characters from filename"""
+        # Remove or replace invalid characters and remove leading/trailing spaces
+        return re.sub(r'[<>:"/\\|?*]', '_', filename).strip(' .')
+    
+    def format_filename(self, template, metadata):
+        """Format filename using template and metadata"""
+        # Create a mutable copy of metadata to format track number
+        formatted_metadata = metadata.copy()
+        if 'track' in formatted_metadata and formatted_metadata['track']:
+            try:
+                # Attempt to convert to int and format as 2 digits, e.g., '1' -> '01'
+                track_num = int(formatted_metadata['track'].split('/')[0]) # Handle 'X/Y' format
+                formatted_metadata['track'] = f"{track_num:02d}"
+            except ValueError:
+                # If conversion fails (e.g., track is non-numeric), keep original or handle
+                pass # Keep original value if it's not a number we can format
+
+        try:
+            formatted = template.format(**formatted_metadata)
+            return self.sanitize_filename(formatted)
+        except KeyError as e:
+            self.log(f"Invalid template variable: {e}. Falling back to default filename format.")
+            return self.sanitize_filename(f"{formatted_metadata.get('artist', 'Unknown Artist')} - {formatted_metadata.get('title', 'Unknown Title')}")
+
+    def convert_file(self, flac_path, outputs, metadata=None):
+        """
+        Convert single FLAC file to one MP3 per (output path, quality) of outputs with the selected
+        encoder engine, decoding it once.
+
+        The engine writes temporary files next to the output paths, which replace them only once
+        they are complete, so an interrupted conversion never leaves a truncated MP3 behind. The
+        source is read ahead and outputs are staged as the I/O scheduler decides (see iosched.py).
+        """
+        if self.engine is None:
+            self.engine = select_engine(self)
+        partials = [(partial_output_path(output_path), quality) for output_path, quality in outputs]
+        targets = [(self.io.staging_path(partial_path) if self.io.stages(partial_path.parent) else partial_path, quality)
+                   for partial_path, quality in partials]
+        with self.io.read_ahead(self, flac_path) as source_data:
+            self.annotate(read_ahead=source_data is not None)
+            if not self.engine.encode(flac_path, targets, metadata or {}, source_data):
+                return False
+        try:
+            for (target_path, _), (partial_path, _) in zip(targets, partials):
+                if target_path != partial_path:
+                    self.io.copy_out(self, target_path, partial_path)
+                    os.remove(target_path)
+            with self.timed("finalize"):
+                for (partial_path, _), (output_path, _) in zip(partials, outputs):
+                    commit_output(partial_path, output_path, fsync=self.settings.get("fsync_outputs", True))
+            return True
+        except OSError as e:
+            self.log(f"Error saving the MP3s of {flac_path.name}: {e}")
+            for path, _ in targets + partials:
+                if os.path.exists(path):
+                    os.remove(path)
+            return False
+    
+    def get_worker_count(self):
+        """Number of parallel conversions: the configured value, or one per CPU core (of cpu_affinity) when 0"""
+        cpus = len(self.settings.get("cpu_affinity") or []) or os.cpu_count() or 1
+        return max(1, self.settings.get("workers", 0) or cpus)
+    
+    def find_flac_files(self, source_folder, dest_folder=None):
+        """Generator of the FLAC files to convert, in a stable order; the destinations are never scanned"""
+        skip_dirs = [dest_folder] if dest_folder else []
+        skip_dirs += [profile.dest_folder for profile in self.profiles]
+        return scan_flac_files(source_folder,
+                               recursive=self.settings.get("recursive", True),
+                               include=self.settings.get("include_patterns", []),
+                               exclude=self.settings.get("exclude_patterns", []),
+                               skip_dirs=skip_dirs)
+    
+    def run_job(self, flac_path, source_folder, enqueued_at, plan):
+        """
+        Process one file with its plan_in_order plan on a worker thread, recording its timings in
+        the batch report. Returns the output path, the status and the report record.
+        """
+        record = {"source": str(flac_path), "output": None, "status": None, "stages": {},
+                  "bytes_read": 0, "bytes_written": 0, "audio_seconds": 0.0}
+        self.current.record = record
+        self.add_stage_time("queue_wait", time.perf_counter() - enqueued_at)
+        output_path, status = None, "failed"
+        try:
+            with self.timed("total"):
+                output_path, status = self.convert_one(flac_path, source_folder, plan)
+        except Exception as e:
+            self.log(f"An unexpected error occurred while processing {flac_path.name}: {str(e)}")
+        finally:
+            self.current.record = None
+            if status in ("converted", "retagged", "reused", "skipped"):
+                self.journal.done(flac_path, output_path)
+            elif status == "failed":
+                self.journal.failed(flac_path)
+            record["stages"] = {stage: round(seconds, 4) for stage, seconds in record["stages"].items()}
+            record["output"] = str(output_path) if output_path else None
+            record["status"] = status
+            if status == "converted":
+                record["bytes_read"] = os.path.getsize(flac_path)
+            self.report.add_file(record)
+        return output_path, status, record
+    
+    def estimate_duration(self, flac_path):
+        """Track length in seconds from STREAMINFO, or estimated from the file size if it cannot be read"""
+        try:
+            duration = read_flac_info(flac_path)["duration"]
+            if duration:
+                return duration
+        except (OSError, FlacFormatError):
+            pass
+        try:
+            return os.path.getsize(flac_path) / ESTIMATED_FLAC_BYTES_PER_SECOND
+        except OSError:
+            return 0.0
+    
+    def pending_profiles(self, flac_path):
+        """The output profiles whose MP3 of this source is missing or out of date"""
+        return [profile for profile in self.profiles
+                if not (self.settings.get("incremental", True)
+                        and profile.manifest.is_up_to_date(flac_path, profile.encoder_settings))]
+    
+    def read_plan(self, flac_path):
+        """
+        The slow part of planning a source: (fingerprint, metadata, profiles to convert), or None when
+        every profile has it up to date (or when only retagging). Safe to run on any thread.
+        """
+        if self.settings.get("retag_only", False):
+            return None
+        # Fingerprint before converting, so a source modified mid-conversion is converted again next time
+        fingerprint = self.profiles[0].manifest.fingerprint(flac_path)
+        pending = self.pending_profiles(flac_path)
+        if not pending:
+            return None
+        return fingerprint, self.get_flac_metadata(flac_path), pending
+    
+    def claim_outputs(self, flac_path, source_folder, fingerprint, metadata, pending):
+        """
+        The plan of a source read by read_plan: (fingerprint, metadata, {profile: output path}). Each profile
+        writes to the same relative subfolder of its destination as the source has in source_folder; a name
+        another source already has gets a suffix (see planner.py), so claims must be made in a stable order.
+        """
+        source_key = self.profiles[0].manifest.source_key(flac_path)
+        outputs = {}
+        for profile in pending:
+            output_folder = profile.dest_folder / flac_path.parent.relative_to(source_folder)
+            wanted = output_folder / (self.format_filename(profile.template, metadata) + ".mp3")
+            outputs[profile] = profile.planner.claim(source_key, wanted, metadata)
+            if outputs[profile] != wanted:
+                self.log(f"{wanted.name} is taken by another source, using {outputs[profile].name} for {flac_path.name}")
+        return fingerprint, metadata, outputs
+    
+    def plan_in_order(self, flac_paths, source_folder):
+        """
+        Generator of (flac_path, plan, duration) for flac_paths, where plan is the plan of a source to convert,
+        None when it is up to date or the exception planning it raised, and duration its track length.
+
+        Fingerprints and metadata are read by a pool of threads, a few files ahead of the caller, so a
+        slow read (a hash, an ffprobe fallback) does not hold up the others; only the output names are
+        claimed here, in the order of flac_paths, so they do not depend on the pool's timing.
+        """
+        def read(flac_path):
+            try:
+                prepared = self.read_plan(flac_path)
+            except Exception as e:
+                return e, self.estimate_duration(flac_path)
+            duration = prepared[1]["duration"] if prepared and prepared[1]["duration"] else 0.0
+            return prepared, duration or self.estimate_duration(flac_path)
+        
+        threads = self.get_worker_count()
+        ahead = deque()
+        with ThreadPoolExecutor(max_workers=threads, thread_name_prefix="plan") as pool:
+            try:
+                for flac_path in itertools.chain(flac_paths, [None]):
+                    if flac_path is not None:
+                        ahead.append((flac_path, pool.submit(read, flac_path)))
+                    while ahead and (flac_path is None or len(ahead) > threads * 2):
+                        path, future = ahead.popleft()
+                        prepared, duration = future.result()
+                        if prepared is not None and not isinstance(prepared, Exception):
+                            try:
+                                prepared = self.claim_outputs(path, source_folder, *prepared)
+                            except Exception as e:
+                                prepared = e
+                        yield path, prepared, duration
+            finally:
+                for _, future in ahead: # The caller stopped early (cancel)
+                    future.cancel()
+    
+    def convert_one(self, flac_path, source_folder, plan=None):
+        """
+        Convert a single file with the output names of its plan (from plan_in_order) on a worker thread.
+        A plan of None means the file was up to date when it was planned; an exception, that planning failed.
+
+        Profiles whose output is up to date are left alone; the others reuse an MP3 of identical audio
+        where they can and are encoded together from one decode otherwise.
+
+        Returns (output path, status) where status is "converted", "retagged", "reused" (made from the MP3
+        of identical audio), "failed", "skipped" or "cancelled".
+        """
+        if self.settings.get("retag_only", False):
+            return self.retag_one(flac_path)
+        
+        if isinstance(plan, Exception):
+            # Not planned again here: names are only claimed in scan order
+            self.log(f"Could not plan the output of {flac_path.name}: {plan}")
+            return None, "failed"
+        if plan is None:
+            record = self.profiles[0].manifest.lookup(flac_path)
+            if self.settings.get("replaygain", False) and "loudness" not in record:
+                return self.analyse_one(flac_path)
+            self.log(f"Unchanged, skipping: {flac_path.name}")
+            return Path(record["output"]), "skipped"
+        resumed_output = self.resumed.get(self.journal.source_key(flac_path))
+        if resumed_output and os.path.exists(resumed_output):
+            self.log(f"Converted before the interrupted run stopped, skipping: {flac_path.name}")
+            return Path(resumed_output), "skipped"
+        
+        fingerprint, metadata, outputs = plan
+        pending = list(outputs)
+        self.annotate(audio_seconds=metadata["duration"])
+        for output_path in outputs.values():
+            output_path.parent.mkdir(parents=True, exist_ok=True)
+        
+        metadata["art"] = self.get_cover_art(flac_path, metadata)
+        
+        # Profiles that already have this audio reuse it; the others are encoded together.
+        # Profiles are claimed in the same order by every worker, so two workers cannot wait on each other.
+        audio_md5 = metadata["audio_md5"]
+        reusable, to_encode, claimed = [], [], []
+        for profile in pending:
+            if profile.dedup and audio_md5:
+                earlier = profile.dedup.acquire(audio_md5, profile.encoder_settings)
+                if earlier:
+                    reusable.append((profile, earlier))
+                    continue
+                claimed.append(profile)
+            to_encode.append(profile)
+        try:
+            statuses = []
+            for profile, earlier in reusable:
+                _, status = self.reuse_one(flac_path, profile, outputs[profile], metadata, fingerprint, earlier)
+                statuses.append(status)
+            if to_encode:
+                _, status = self.encode_one(flac_path, {profile: outputs[profile] for profile in to_encode},
+                                            metadata, fingerprint)
+                statuses.append(status)
+        finally:
+            for profile in claimed:
+                profile.dedup.release(audio_md5)
+        
+        output_path = outputs[pending[0]]
+        for status in ("cancelled", "failed", "converted"):
+            if status in statuses:
+                return output_path, status
+        return output_path, "reused"
+    
+    def encode_one(self, flac_path, outputs, metadata, fingerprint):
+        """Encode a file into the output paths of profiles ({profile: path}) and record them in their manifests"""
+        names = ", ".join(dict.fromkeys(output_path.name for output_path in outputs.values()))
+        self.log(f"Converting: {flac_path.name} -> {names}")
+        self.journal.running(flac_path, [partial_output_path(output_path) for output_path in outputs.values()])
+        
+        first_output = next(iter(outputs.values()))
+        if not self.convert_file(flac_path, [(path, profile.quality) for profile, path in outputs.items()], metadata):
+            return first_output, "cancelled" if self.control.cancelled.is_set() else "failed"
+        self.count_written(outputs.values()) # Every profile's MP3, not only the one reported as the output
+        loudness = metadata.get("loudness")
+        for profile, output_path in outputs.items():
+            profile.manifest.record(flac_path, fingerprint, profile.encoder_settings, output_path, metadata["audio_md5"],
+                                    loudness)
+        if is_measured(loudness):
+            self.write_track_gain(flac_path, outputs.values(), loudness)
+        return first_output, "converted"
+    
+    def reuse_one(self, flac_path, profile, output_path, metadata, fingerprint, earlier):
+        """Produce a profile's output from an MP3 of identical audio (earlier: their manifest records), without encoding"""
+        if self.engine is None:
+            self.engine = select_engine(self)
+        self.journal.running(flac_path, [partial_output_path(output_path)])
+        replaygain = self.settings.get("replaygain", False)
+        # Identical audio has the same loudness, so the track gain of an earlier encode applies too
+        loudness = earlier[0].get("loudness") if replaygain else None
+        frames = self.engine.tag_frames(metadata) + replaygain_frames(loudness)
+        try:
+            with self.timed("dedup"):
+                method, record = profile.dedup.reuse(earlier, output_path, frames)
+        except OSError as e:
+            self.log(f"Could not reuse an MP3 of the same audio for {flac_path.name}, encoding instead: {e}")
+            return self.encode_one(flac_path, {profile: output_path}, metadata, fingerprint)
+        self.annotate(reused_from=record["output"], reuse_method=method)
+        if method == "copied": # A hardlink or retag writes no audio
+            self.count_written([output_path])
+        self.log(f"Same audio as {Path(record['source']).name}, reusing its MP3 ({method}): {flac_path.name}")
+        if replaygain and not loudness:
+            loudness = analyse_loudness(self, flac_path, metadata)
+        profile.manifest.record(flac_path, fingerprint, profile.encoder_settings, output_path, metadata["audio_md5"],
+                                loudness)
+        if is_measured(loudness):
+            self.write_track_gain(flac_path, [output_path], loudness)
+        return output_path, "reused"
+    
+    def start_journal(self, source_folder, dest_folder):
+        """
+        Open the job journal for a new batch. Temporary files left by an interrupted run are removed and,
+        when it converted the same source with the same settings, its finished files are not converted again.
+        """
+        self.journal = JobJournal(dest_folder)
+        self.resumed = {}
+        encoder_settings = [profile.encoder_settings for profile in self.profiles]
+        interrupted = self.journal.load_interrupted()
+        carried_over = []
+        if interrupted:
+            header, jobs = interrupted
+            remove_stale_partials(jobs, self.log)
+            if is_same_batch(header, source_folder, encoder_settings):
+                carried_over = [record for record in jobs.values() if record["state"] == "done"]
+                self.resumed = {record["source"]: record["output"] for record in carried_over}
+                self.log(f"Resuming an interrupted run: {len(carried_over)} files were already converted")
+        self.io.remove_stale(self.log)
+        self.journal.begin(source_folder, encoder_settings, carried_over)
+    
+    def retag_one(self, flac_path):
+        """
+        Rewrite the ID3 tags of the MP3s the manifests record for this source, without encoding.
+        The MP3s keep their names even if the tags used in the filename template changed.
+        """
+        records = [(profile, profile.manifest.lookup(flac_path)) for profile in self.profiles]
+        records = [(profile, record) for profile, record in records if record and os.path.exists(record["output"])]
+        if not records:
+            self.log(f"No converted MP3 to retag: {flac_path.name}")
+            return None, "skipped"
+        fingerprint = self.profiles[0].manifest.fingerprint(flac_path)
+        metadata = self.get_flac_metadata(flac_path)
+        artwork = self.get_cover_art(flac_path, metadata)
+        loudness = records[0][1].get("loudness")
+        frames = frames_from_tags(metadata["tags"], artwork)
+        if self.settings.get("replaygain", False) and is_measured(loudness):
+            frames += replaygain_frames(loudness) # The album gain follows at the end of the batch
+            self.gain_folders.add(os.path.dirname(records[0][1]["source"]))
+        for profile, record in records:
+            output_path = Path(record["output"])
+            try:
+                with self.timed("tag"):
+                    in_place = write_tag(output_path, frames)
+                self.annotate(tag_in_place=in_place)
+            except OSError as e:
+                self.log(f"Error writing tags for {output_path.name}: {e}")
+                return output_path, "failed"
+            # The audio is unchanged, so the output stays valid for the encoder settings it was made with
+            profile.manifest.record(flac_path, fingerprint, record["settings"], output_path, record.get("audio_md5", ""),
+                                    record.get("loudness"))
+        return Path(records[0][1]["output"]), "retagged"
+    
+    def analyse_one(self, flac_path):
+        """
+        Measure the loudness of a source converted before ReplayGain was enabled and tag its MP3s, without
+        encoding. A source FFmpeg cannot measure is recorded as UNMEASURED, so it is not tried again.
+        """
+        self.log(f"Measuring loudness: {flac_path.name}")
+        metadata = self.get_flac_metadata(flac_path)
+        loudness = analyse_loudness(self, flac_path, metadata)
+        records = [(profile, profile.manifest.lookup(flac_path)) for profile in self.profiles]
+        first_output = Path(records[0][1]["output"])
+        if loudness is None:
+            return first_output, "cancelled" if self.control.cancelled.is_set() else "failed"
+        for profile, record in records:
+            profile.manifest.append({**record, "loudness": loudness})
+        if not is_measured(loudness): # Logged by analyse_loudness
+            return first_output, "skipped"
+        self.write_track_gain(flac_path, [record["output"] for _, record in records], loudness)
+        return first_output, "retagged"
+    
+    def write_track_gain(self, flac_path, output_paths, loudness):
+        """Write the track gain into MP3s (in place when their tag has room) and queue the album gain of the source's folder"""
+        self.annotate(loudness_lufs=loudness["lufs"], true_peak=loudness["peak"])
+        self.gain_folders.add(os.path.dirname(self.profiles[0].manifest.source_key(flac_path)))
+        values = replaygain_values(loudness)
+        for output_path in dict.fromkeys(output_paths):
+            try:
+                with self.timed("tag"):
+                    update_txxx(output_path, values)
+            except (OSError, ValueError) as e:
+                self.log(f"Error writing ReplayGain tags for {Path(output_path).name}: {e}")
+    
+    def apply_album_gain(self, folders):
+        """
+        Write the album gain of each source folder in folders to the MP3s of all its tracks, including
+        those converted by earlier runs, from the loudness recorded in the manifests.
+        """
+        if not folders or not self.settings.get("replaygain_album", True):
+            return
+        by_folder = {}
+        for profile in self.profiles:
+            with profile.manifest.lock:
+                records = list(profile.manifest.records.values())
+            for record in records:
+                folder = os.path.dirname(record["source"])
+                if folder in folders and is_measured(record.get("loudness")) and os.path.exists(record["source"]):
+                    by_folder.setdefault(folder, []).append((profile, record))
+        
+        updated = 0
+        for folder, entries in sorted(by_folder.items()):
+            tracks = {record["source"]: record["loudness"] for _, record in entries} # Once per source, not per profile
+            album = album_loudness(list(tracks.values()))
+            self.report.albums.append({"folder": folder, "tracks": len(tracks), **album})
+            for profile, record in entries:
+                values = replaygain_values(record["loudness"], album)
+                try:
+                    if update_txxx(record["output"], values) is not None:
+                        updated += 1
+                except (OSError, ValueError) as e:
+                    self.log(f"Error writing ReplayGain tags for {Path(record['output']).name}: {e}")
+        if by_folder:
+            self.log(f"Album gain written for {len(by_folder)} albums ({updated} MP3s updated)")
+    
+    def prepare_batch(self, source_folder, dest_folder, full_scan=True):
+        """
+        Set up the state of a new batch: engine, output profiles with their manifests and dedup
+        indexes, cancel/pause control, cover art cache and run report. A batch that is not a full
+        scan keeps the manifests, output name indexes and art cache of the previous batch into the same
+        destination.
+        """
+        dest_folder = Path(dest_folder).absolute() # Manifest records hold absolute outputs (see manifest.py)
+        self.engine = select_engine(self)
+        previous_profiles = {profile.dest_folder: profile for profile in self.profiles}
+        self.profiles = profiles_from_settings(self.settings, dest_folder)
+        for profile in self.profiles:
+            previous = None if full_scan else previous_profiles.get(profile.dest_folder)
+            if previous:
+                profile.manifest, profile.planner = previous.manifest, previous.planner
+                profile.planner.renamed = 0
+            else:
+                profile.manifest = ConversionManifest(profile.dest_folder,
+                                                      use_hash=self.settings.get("manifest_hash", False))
+                profile.planner = OutputPlanner(profile.manifest)
+            profile.encoder_settings = self.get_encoder_settings(profile)
+            if self.settings.get("dedup", True):
+                profile.dedup = AudioDedup(profile.manifest, hardlink=self.settings.get("dedup_hardlink", True),
+                                           fsync=self.settings.get("fsync_outputs", True))
+        self.stage_totals = {}
+        self.gain_folders = set()
+        self.control = BatchControl()
+        self.io = IOScheduler(self.settings)
+        if not self.settings.get("embed_art", True):
+            self.art_cache = None
+        elif full_scan or self.art_cache is None:
+            self.art_cache = ArtCache(self.settings)
+        else:
+            self.art_cache.stats = dict.fromkeys(self.art_cache.stats, 0)
+        self.report = RunReport(source_folder, dest_folder, dict(self.settings))
+    
+    def plan_files(self, source_folder, dest_folder):
+        """
+        Dry run: plan the outputs of every FLAC file under source_folder without converting or writing
+        anything. Sends a "planned" event per file with its outputs ("action" is "convert" or
+        "unchanged") and returns counts of the files by action and of the "renamed" outputs.
+        """
+        source_folder = Path(source_folder)
+        dest_folder = Path(dest_folder).absolute()
+        self.prepare_batch(source_folder, dest_folder)
+        counts = {"total": 0, "convert": 0, "unchanged": 0, "renamed": 0}
+        for flac_path, plan, _ in self.plan_in_order(self.find_flac_files(source_folder, dest_folder), source_folder):
+            counts["total"] += 1
+            if isinstance(plan, Exception):
+                self.log(f"Could not plan the output of {flac_path.name}: {plan}")
+                continue
+            relative_source = flac_path.relative_to(source_folder)
+            if plan is None:
+                counts["unchanged"] += 1
+                record = self.profiles[0].manifest.lookup(flac_path)
+                outputs = [record["output"]] if record else []
+                action = "unchanged"
+            else:
+                counts["convert"] += 1
+                outputs = [str(output_path) for output_path in plan[2].values()]
+                action = "convert"
+                for output_path in outputs:
+                    self.log(f"{relative_source} -> {output_path}")
+            self.emit("planned", source=str(flac_path), outputs=outputs, action=action)
+        counts["renamed"] = sum(profile.planner.renamed for profile in self.profiles)
+        self.log(f"Plan: {counts['total']} FLAC files, {counts['convert']} to convert, {counts['unchanged']} unchanged, "
+                 f"{counts['renamed']} outputs renamed to avoid a name collision")
+        return counts
+    
+    def convert_files(self, source_folder, dest_folder, files=None):
+        """
+        Convert all new or changed FLAC files under source_folder into dest_folder, or into the
+        folders of the "profiles" setting (relative to dest_folder) when several outputs are configured.
+        
+        files, when given, lists the FLAC files (under source_folder) to convert instead of scanning
+        the whole folder. Such batches cost only the work for those files, as the watch mode needs:
+        the manifest and cover art cache of the previous batch into the same destination are reused,
+        and the manifest is not compacted nor checked for orphans.
+
+        A scanner thread feeds a bounded queue that the worker threads take files from, so conversion
+        starts as soon as the first file is found and memory use does not depend on the library size.
+        By default the longest tracks waiting in the queue are converted first, which shortens the batch.
+        cancel(), pause() and resume() may be called from another thread while the batch runs.
+        Returns a summary dict with the "total", "converted", "reused", "skipped", "failed" and "cancelled" counts,
+        the list of "orphans" (outputs whose source was deleted) and "stage_seconds",
+        the time spent in each stage summed over all files.
+        """
+        source_folder = Path(source_folder)
+        dest_folder = Path(dest_folder).absolute()
+        workers = self.get_worker_count()
+        
+        full_scan = files is None
+        self.prepare_batch(source_folder, dest_folder, full_scan)
+        control = self.control
+        self.start_journal(source_folder, dest_folder)
+        
+        # Jobs are ordered by (0, priority, sequence); the workers' stop markers use 1 so they sort last.
+        # With "longest_first" the priority is the negated track length: long tracks start first instead
+        # of finishing alone at the end of the batch. The bound keeps memory flat on huge libraries.
+        longest_first = self.settings.get("schedule", "longest_first") == "longest_first"
+        jobs = queue.PriorityQueue(maxsize=max(workers * 4, self.settings.get("schedule_window", 10000)))
+        results = queue.Queue()
+        
+        def scan():
+            found = 0
+            try:
+                flac_paths = self.find_flac_files(source_folder, dest_folder) if full_scan else files
+                # Output names are claimed here, in scan order, so they do not depend on worker timing
+                for flac_path, plan, duration in self.plan_in_order(flac_paths, source_folder):
+                    if control.cancelled.is_set():
+                        break
+                    priority = -duration if longest_first else 0
+                    self.journal.queued(flac_path)
+                    jobs.put((0, priority, found, flac_path, duration, time.perf_counter(), plan))
+                    found += 1
+                    results.put(("found", (found, duration)))
+            except Exception as e:
+                self.log(f"Error scanning {source_folder}: {str(e)}")
+            finally:
+                for i in range(workers):
+                    jobs.put((1, 0, i, None, 0, 0, None)) # One stop marker per worker
+                results.put(("scan_complete", found))
+        
+        def work():
+            while True:
+                # The permit is taken before the job, so a worker held back by the governor leaves it to the others
+                with governor.permit(control.cancelled):
+                    _, _, _, flac_path, duration, enqueued_at, plan = jobs.get()
+                    if flac_path is None:
+                        return
+                    # Waits while paused; after a cancel the remaining queue is drained without converting
+                    if control.wait_if_paused():
+                        output_path, status, _ = self.run_job(flac_path, source_folder, enqueued_at, plan)
+                    else:
+                        output_path, status = None, "cancelled"
+                results.put(("file_done", (flac_path, output_path, status, duration)))
+        
+        self.log(f"Scanning {source_folder} and converting with {workers} parallel workers "
+                 f"using {self.engine.description}")
+        if len(self.profiles) > 1:
+            self.log("Output profiles (each source is decoded once): "
+                     + "; ".join(profile.describe() for profile in self.profiles))
+        self.emit("start", workers=workers, engine=self.engine.name)
+        governor = WorkerGovernor(self.settings, workers, self.log, self.emit)
+        
+        for profile in self.profiles:
+            profile.manifest.open()
+        threads = [threading.Thread(target=scan, name="scan", daemon=True)]
+        threads += [threading.Thread(target=work, name=f"convert-{i}", daemon=True) for i in range(workers)]
+        for thread in threads:
+            thread.start()
+        
+        # Results are collected here, on this thread only, so the counters need no locking
+        found = 0
+        scan_complete = False
+        converted = 0
+        reused = 0
+        skipped = 0
+        failed = 0
+        cancelled = 0
+        completed = 0
+        # Progress and ETA are weighted by audio length, not file count
+        found_seconds = 0.0
+        done_seconds = 0.0
+        converted_seconds = 0.0
+        start = time.perf_counter()
+        sampler = ThroughputSampler(control, self.settings.get("throughput_interval", 1.0),
+                                    self.settings.get("throughput_smoothing", 20.0))
+        running_seconds = 0.0 # Audio processed so far by the files being converted
+        try:
+            while not scan_complete or completed < found:
+                try:
+                    kind, value = results.get(timeout=sampler.interval)
+                except queue.Empty:
+                    kind, value = None, None
+                # Between files too, so progress and ETA move during long tracks
+                if sampler.due():
+                    running_seconds = sampler.sample()
+                    remaining = found_seconds - done_seconds - running_seconds
+                    eta = sampler.eta(remaining) if scan_complete else None
+                    self.emit("throughput", realtime_factor=round(sampler.rate or 0.0, 2),
+                              current_realtime_factor=round(sampler.current_rate, 2), active=len(control.jobs),
+                              progress=round(min(1.0, (done_seconds + running_seconds) / found_seconds), 4) if found_seconds else 0.0,
+                              audio_seconds_done=round(done_seconds + running_seconds, 1),
+                              audio_seconds_total=round(found_seconds, 1), scan_complete=scan_complete,
+                              eta_seconds=round(eta, 1) if eta is not None else None)
+                if kind is None:
+                    continue
+                if kind == "found":
+                    found, duration = value
+                    found_seconds += duration
+                    continue
+                if kind == "scan_complete":
+                    found = value
+                    scan_complete = True
+                    self.log(f"Scan complete: found {found} FLAC files ({found_seconds / 3600:.1f} hours of audio)")
+                    self.emit("scan_complete", total=found, audio_seconds=round(found_seconds, 1))
+                    continue
+                
+                flac_path, output_path, status, duration = value
+                completed += 1
+                done_seconds += duration
+                if status == "converted":
+                    converted += 1
+                    converted_seconds += duration
+                    self.log(f"✓ Converted: {display_path(output_path, dest_folder)}")
+                elif status == "retagged":
+                    converted += 1 # Counted with the converted files: the MP3 was brought up to date
+                    self.log(f"✓ Retagged: {display_path(output_path, dest_folder)}")
+                elif status == "reused":
+                    reused += 1
+                    self.log(f"✓ Reused: {display_path(output_path, dest_folder)}")
+                elif status == "skipped":
+                    skipped += 1
+                elif status == "cancelled":
+                    cancelled += 1
+                else:
+                    failed += 1
+                    self.log(f"✗ Failed: {flac_path.name}")
+                
+                # The rate only counts converted audio: skipped files finish instantly and would skew the ETA
+                elapsed = time.perf_counter() - start
+                eta = None
+                if scan_complete and sampler.rate:
+                    eta = round(sampler.eta(found_seconds - done_seconds - running_seconds), 1)
+                elif scan_complete and converted_seconds > 0:
+                    eta = round((found_seconds - done_seconds) / (converted_seconds / elapsed), 1)
+                
+                # While the scan is running "total" is the number of files found so far
+                self.emit("file_done", source=str(flac_path), output=str(output_path) if output_path else None,
+                          status=status, success=status in ("converted", "retagged", "reused", "skipped"), completed=completed,
+                          total=found, scan_complete=scan_complete,
+                          converted=converted, reused=reused, skipped=skipped, failed=failed, cancelled=cancelled,
+                          progress=done_seconds / found_seconds if found_seconds else completed / found,
+                          audio_seconds_done=round(done_seconds, 1), audio_seconds_total=round(found_seconds, 1),
+                          eta_seconds=eta)
+            for thread in threads:
+                thread.join()
+            # A cancelled or crashed batch is not marked complete, so the next run resumes it
+            if not control.cancelled.is_set():
+                self.journal.finish()
+        finally:
+            for profile in self.profiles:
+                profile.manifest.close()
+                if full_scan:
+                    profile.manifest.compact()
+            self.journal.close()
+        
+        if found == 0 and full_scan:
+            self.log("No FLAC files found in source folder")
+        
+        # Also after a cancel: the folders' finished tracks get their album gain now, the rest when converted
+        self.apply_album_gain(self.gain_folders)
+        counts = {"total": found, "converted": converted, "reused": reused, "skipped": skipped, "failed": failed,
+                  "cancelled": cancelled}
+        return self.finish_batch(counts, full_scan, control.cancelled.is_set())
+    
+    def finish_batch(self, counts, full_scan, was_cancelled):
+        """Log the batch statistics and orphans, save the run report and send the "complete" event with the summary"""
+        if self.art_cache:
+            stats = self.art_cache.stats
+            if any(stats.values()):
+                self.log(f"Cover art: {stats['processed']} processed, {stats['memory_hits']} reused, "
+                         f"{stats['disk_hits']} loaded from the cache")
+            if full_scan:
+                self.art_cache.trim_disk()
+        
+        if counts["reused"]:
+            stats = {method: sum(profile.dedup.stats[method] for profile in self.profiles if profile.dedup)
+                     for method in ("linked", "copied", "retagged")}
+            breakdown = ""
+            if any(stats.values()): # Only known here when this process did the reusing
+                breakdown = (f" ({stats['linked']} hardlinked, {stats['copied']} copied and retagged, "
+                             f"{stats['retagged']} retagged in place)")
+            self.log(f"Duplicate audio: {counts['reused']} files reused the MP3 of an identical recording "
+                     f"instead of being encoded{breakdown}")
+        
+        # Outputs whose source is gone are reported, never deleted
+        orphans = []
+        if full_scan:
+            orphans = [record["output"] for profile in self.profiles for record in profile.manifest.orphans()]
+        for output in orphans:
+            self.log(f"Orphaned output (source deleted): {output}")
+        
+        summary = {**counts, "was_cancelled": was_cancelled, "orphans": orphans,
+                   "stage_seconds": dict(self.stage_totals)}
+        
+        self.report.finish(summary)
+        for line in self.report.summary_lines():
+            self.log(line)
+        if counts["total"] and self.settings.get("write_report", True):
+            try:
+                summary["report_path"] = str(self.report.save())
+                self.log(f"Run report saved to {summary['report_path']}")
+            except OSError as e:
+                self.log(f"Error saving run report: {e}")
+        
+        converted, reused, skipped, failed = counts["converted"], counts["reused"], counts["skipped"], counts["failed"]
+        if was_cancelled:
+            self.log(f"\nConversion cancelled: {converted} files converted, {reused} reused, {skipped} unchanged, "
+                     f"{failed} failed, {counts['cancelled']} not converted\n")
+        else:
+            self.log(f"\nConversion complete: {converted} files converted, {reused} reused, {skipped} unchanged, "
+                     f"{failed} failed\n")
+        self.emit("complete", **summary)
+        return summary
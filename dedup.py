@@ -0,0 +1,92 @@
+"""
+Reuse of MP3s already encoded from the same audio.
+
+Every FLAC stores the MD5 of its decoded audio in STREAMINFO, so copies of a track (compilations,
+re-releases, renamed files) are recognised from their metadata alone. The manifest records that MD5
+with each output; when a file's audio was already encoded with the same encoder settings, its MP3 is
+hardlinked (when the tags are identical too) or copied and retagged instead of being encoded again.
+Tags are compared byte for byte as id3.py writes them, which both engines and every copy made here use.
+Workers that meet audio another worker is encoding wait for that encode and then reuse it.
+"""
+import os
+import shutil
+import threading
+
+from encoders import commit_output, partial_output_path
+from id3 import tag_matches, write_tag
+
+# FLAC encoders that do not compute the MD5 leave the field zeroed
+UNSET_MD5 = "0" * 32
+
+def usable_md5(md5):
+    return md5 if md5 and md5 != UNSET_MD5 else ""
+
+class AudioDedup:
+    def __init__(self, manifest, hardlink=True, fsync=True):
+        self.manifest = manifest
+        self.hardlink = hardlink
+        self.fsync = fsync
+        self.in_flight = {} # audio MD5 -> Event set when the worker encoding it is done
+        self.lock = threading.Lock()
+        self.stats = {"linked": 0, "copied": 0, "retagged": 0}
+
+    def acquire(self, md5, encoder_settings):
+        """
+        The manifest records of earlier encodes of this audio, or an empty list when the caller is to
+        encode it; then the caller must call release(md5) once its encode has finished or failed.
+        """
+        while True:
+            with self.lock:
+                records = self.manifest.find_audio(md5, encoder_settings)
+                if records:
+                    return records
+                event = self.in_flight.get(md5)
+                if event is None:
+                    self.in_flight[md5] = threading.Event()
+                    return []
+            # Another worker is encoding the same audio: wait, then look again (it may have failed)
+            event.wait()
+
+    def release(self, md5):
+        with self.lock:
+            event = self.in_flight.pop(md5, None)
+        if event:
+            event.set()
+
+    def reuse(self, records, output_path, frames):
+        """
+        Make output_path an MP3 of the audio of records (from acquire) with the given tag frames:
+        retag it in place if it is one of their outputs, else hardlink an output with the same tags
+        or copy the first one and retag the copy.
+        Returns the method ("retagged", "linked" or "copied") and the record used. Raises OSError.
+        """
+        for record in records:
+            if os.path.exists(output_path) and os.path.samefile(record["output"], output_path):
+                write_tag(output_path, frames)
+                with self.lock:
+                    self.stats["retagged"] += 1
+                return "retagged", record
+
+        record = records[0]
+        method = "copied"
+        partial_path = partial_output_path(output_path)
+        try:
+            if self.hardlink:
+                same_tags = next((r for r in records if tag_matches(r["output"], frames)), None)
+                if same_tags:
+                    try:
+                        os.link(same_tags["output"], partial_path)
+                        record, method = same_tags, "linked"
+                    except OSError: # No hardlinks on this file system (or across devices)
+                        pass
+            if method == "copied":
+                shutil.copyfile(record["output"], partial_path)
+                write_tag(partial_path, frames)
+            commit_output(partial_path, output_path, fsync=self.fsync and method == "copied")
+        except OSError:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+            raise
+        with self.lock:
+            self.stats[method] += 1
+        return method, record
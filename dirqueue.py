@@ -0,0 +1,178 @@
+"""
+Job queue kept in a directory on shared storage (NFS, SMB or a local folder), with no broker.
+
+    QUEUE/config.json     batch description written by the coordinator
+    QUEUE/pending/        jobs waiting for a worker, one JSON file each
+    QUEUE/claimed/        jobs a worker is running
+    QUEUE/results/        finished jobs, until the coordinator has read them
+    QUEUE/tmp/            files being written; renamed into place once complete
+    QUEUE/closed          present once the coordinator needs no more workers
+
+A worker claims a job by renaming it from pending/ to claimed/: the rename is atomic on one file
+system, so exactly one worker gets each job. While the job runs the worker touches the claimed file
+(its lease); a job whose lease was not renewed for lease_seconds is moved back to pending/ by the
+coordinator, so the jobs of a worker that died are run again. Outputs are written atomically, so a
+job that runs twice is harmless. Pending job names start with a sort key, so the longest tracks are
+claimed first. Times are compared with the storage's clock, not the hosts'.
+"""
+import hashlib
+import json
+import os
+import socket
+import threading
+import time
+from pathlib import Path
+
+CONFIG_FILENAME = "config.json"
+CLOSED_FILENAME = "closed"
+CLOCK_FILENAME = ".clock"
+
+class DirectoryQueue:
+    def __init__(self, queue_dir):
+        self.path = Path(queue_dir)
+        self.pending = self.path / "pending"
+        self.claimed = self.path / "claimed"
+        self.results = self.path / "results"
+        self.tmp = self.path / "tmp"
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}"
+        self.listing = [] # Pending job names this worker has not tried yet, refreshed when used up
+        self.lock = threading.Lock()
+
+    def create(self, config):
+        """Set up the queue folders and write the batch config (jobs of an earlier run are kept)"""
+        for folder in (self.pending, self.claimed, self.results, self.tmp):
+            folder.mkdir(parents=True, exist_ok=True)
+        if (self.path / CLOSED_FILENAME).exists():
+            os.remove(self.path / CLOSED_FILENAME)
+        self.write_json(self.path / CONFIG_FILENAME, config)
+
+    def read_config(self):
+        """The coordinator's batch config; raises OSError while there is none"""
+        with open(self.path / CONFIG_FILENAME, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def write_json(self, path, data):
+        """Write a file under a temporary name and rename it into place, so readers never see half of it"""
+        temp_path = self.tmp / f"{path.name}.{self.worker_id}-{threading.get_native_id()}"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(temp_path, path)
+
+    def now(self):
+        """Current time on the shared storage, so leases do not depend on the hosts' clocks agreeing"""
+        clock = self.path / CLOCK_FILENAME
+        with open(clock, "a"):
+            pass
+        os.utime(clock)
+        return clock.stat().st_mtime
+
+    # --- Coordinator ---
+
+    def job_id(self, source):
+        return hashlib.sha1(source.encode("utf-8")).hexdigest()[:20]
+
+    def put(self, source, duration=0.0, outputs=None):
+        """
+        Queue a job for a source path (relative to the batch source folder), optionally with its
+        planned output paths (one per output profile, relative to its folder); returns its id
+        """
+        job_id = self.job_id(source)
+        # Longest tracks first: the sort key falls as the duration grows
+        name = f"{max(0, 999999 - int(duration)):06d}-{job_id}.json"
+        if not (self.claimed / name).exists():
+            self.write_json(self.pending / name, {"id": job_id, "source": source, "duration": duration,
+                                                  "outputs": outputs, "attempts": 0})
+        return job_id
+
+    def collect(self):
+        """Read and remove the results written by the workers"""
+        results = []
+        for entry in os.scandir(self.results):
+            try:
+                with open(entry.path, "r", encoding="utf-8") as f:
+                    results.append(json.load(f))
+                os.remove(entry.path)
+            except (OSError, ValueError):
+                continue # Removed by another reader, or not readable yet
+        return results
+
+    def requeue_expired(self, lease_seconds, max_attempts):
+        """
+        Move jobs whose lease expired back to pending/. Returns the jobs given up on after max_attempts,
+        which are removed from the queue.
+        """
+        now = self.now()
+        abandoned = []
+        for entry in os.scandir(self.claimed):
+            try:
+                if now - entry.stat().st_mtime < lease_seconds:
+                    continue
+                with open(entry.path, "r", encoding="utf-8") as f:
+                    job = json.load(f)
+                os.remove(entry.path)
+            except (OSError, ValueError):
+                continue # Finished or renewed meanwhile
+            job["attempts"] = job.get("attempts", 0) + 1
+            if job["attempts"] >= max_attempts:
+                abandoned.append(job)
+            else:
+                self.write_json(self.pending / entry.name, job)
+        return abandoned
+
+    def counts(self):
+        """Number of pending and claimed jobs"""
+        return len(os.listdir(self.pending)), len(os.listdir(self.claimed))
+
+    def close(self):
+        """Tell the workers that no more jobs will come"""
+        with open(self.path / CLOSED_FILENAME, "w"):
+            pass
+
+    # --- Workers ---
+
+    def is_closed(self):
+        return (self.path / CLOSED_FILENAME).exists()
+
+    def claim(self):
+        """Take the next pending job; returns (job, claim name) or None when nothing is pending"""
+        while True:
+            with self.lock:
+                if not self.listing:
+                    self.listing = sorted(os.listdir(self.pending), reverse=True)
+                    if not self.listing:
+                        return None
+                name = self.listing.pop()
+            try:
+                os.rename(self.pending / name, self.claimed / name)
+            except OSError:
+                continue # Another worker was faster
+            os.utime(self.claimed / name) # The lease starts now, not when the job was queued
+            try:
+                with open(self.claimed / name, "r", encoding="utf-8") as f:
+                    return json.load(f), name
+            except (OSError, ValueError):
+                continue # Requeued by the coordinator already
+
+    def renew(self, name):
+        """Extend the lease of a claimed job; False if it was lost (the coordinator requeued it)"""
+        try:
+            os.utime(self.claimed / name)
+            return True
+        except OSError:
+            return False
+
+    def finish(self, name, result):
+        """Report a job's result and remove its claim"""
+        result["worker"] = self.worker_id
+        self.write_json(self.results / f"{name}.{self.worker_id}", result)
+        try:
+            os.remove(self.claimed / name)
+        except OSError:
+            pass # Requeued after the lease expired; the coordinator ignores the second result
+
+    def release(self, name):
+        """Give a claimed job back without running it (e.g. the worker was cancelled)"""
+        try:
+            os.rename(self.claimed / name, self.pending / name)
+        except OSError:
+            pass
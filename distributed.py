@@ -0,0 +1,272 @@
+"""
+Distributed conversion: one coordinator and any number of worker processes, on one or many hosts,
+sharing a job queue folder (see dirqueue.py) and the source and destination folders.
+
+The coordinator scans the source folder, plans the output names (see planner.py), queues the files
+that need converting with their planned outputs (longest first) and is the only writer of the manifests: workers send back the manifest records of their outputs with
+each result. Workers take the encoder settings from the coordinator's batch config, so an output
+counts as up to date whichever host encoded it.
+"""
+import os
+import threading
+import time
+from pathlib import Path
+
+from dirqueue import DirectoryQueue
+from governor import WorkerGovernor
+from journal import JobJournal
+from loudness import is_measured
+
+# Settings a worker takes from the coordinator, because they determine the outputs
+SHARED_SETTINGS = ("quality", "profiles", "filename_template", "stream_decode", "incremental", "manifest_hash",
+                   "write_tags", "retag_only", "embed_art", "art_max_size", "art_max_bytes", "art_jpeg_qscale", "dedup",
+                   "dedup_hardlink", "replaygain", "replaygain_album", "fsync_outputs", "stall_timeout", "timeout_base", "timeout_per_audio_second",
+                   "queue_lease_seconds")
+
+class WorkerToolsError(Exception):
+    """The tools a worker needs for the coordinator's settings are missing or do not run"""
+    def __init__(self, errors):
+        super().__init__("; ".join(errors))
+        self.errors = errors
+
+def relative_path(path, folder):
+    """path relative to folder in "/" form, as paths are sent between hosts"""
+    return Path(os.path.relpath(os.path.abspath(path), os.path.abspath(folder))).as_posix()
+
+def relative_record(record, source_folder, dest_folder):
+    """A manifest record with its paths relative to the batch source folder and the profile's destination"""
+    return {**record, "source": relative_path(record["source"], source_folder),
+            "output": relative_path(record["output"], dest_folder)}
+
+def run_coordinator(core, source_folder, dest_folder, queue_dir, stop_event):
+    """
+    Queue the FLAC files of source_folder that need converting and collect the workers' results until
+    every job is done or stop_event is set. Jobs left when stopping stay queued: running the
+    coordinator again picks them up. Returns the batch summary, as ConverterCore.convert_files does.
+    """
+    source_folder = Path(source_folder)
+    dest_folder = Path(dest_folder).absolute()
+    lease_seconds = core.settings.get("queue_lease_seconds", 120)
+    max_attempts = core.settings.get("queue_max_attempts", 3)
+    poll_interval = core.settings.get("queue_poll_interval", 2)
+    queue = DirectoryQueue(queue_dir)
+
+    core.prepare_batch(source_folder, dest_folder)
+    settings = {key: core.settings[key] for key in SHARED_SETTINGS if key in core.settings}
+    settings["encoder_engine"] = core.engine.name
+    queue.create({"source_folder": str(source_folder.absolute()), "dest_folder": str(dest_folder.absolute()),
+                  "settings": settings,
+                  "encoder_settings": [profile.encoder_settings for profile in core.profiles]})
+    core.log(f"Queueing jobs in {queue.path} for workers using {core.engine.description}")
+    if len(core.profiles) > 1:
+        core.log("Output profiles (each source is decoded once): "
+                 + "; ".join(profile.describe() for profile in core.profiles))
+    core.emit("start", workers=0, engine=core.engine.name)
+
+    counts = {"total": 0, "converted": 0, "reused": 0, "skipped": 0, "failed": 0, "cancelled": 0}
+    outstanding = {} # job id -> source path relative to source_folder
+    for profile in core.profiles:
+        profile.manifest.open()
+    try:
+        # Output names are claimed in scan order, so all hosts agree on them (see planner.py)
+        for flac_path, plan, duration in core.plan_in_order(core.find_flac_files(source_folder, dest_folder),
+                                                            source_folder):
+            if stop_event.is_set():
+                break
+            counts["total"] += 1
+            outputs = None
+            if isinstance(plan, Exception):
+                counts["failed"] += 1
+                core.log(f"✗ Failed: could not plan the output of {flac_path.name}: {plan}")
+                continue
+            if plan:
+                outputs = [relative_path(plan[2][profile], profile.dest_folder) if profile in plan[2] else None
+                           for profile in core.profiles]
+            elif not core.settings.get("retag_only", False):
+                counts["skipped"] += 1
+                continue
+            source = flac_path.relative_to(source_folder).as_posix()
+            outstanding[queue.put(source, duration, outputs)] = source
+        core.log(f"Scan complete: found {counts['total']} FLAC files, {len(outstanding)} queued for the workers")
+        core.emit("scan_complete", total=counts["total"])
+
+        queued = len(outstanding)
+
+        def file_done(source, output, status):
+            core.emit("file_done", source=source, output=output, status=status,
+                      success=status in ("converted", "retagged", "reused", "skipped"),
+                      completed=queued - len(outstanding), total=queued, scan_complete=True,
+                      converted=counts["converted"], reused=counts["reused"], skipped=counts["skipped"],
+                      failed=counts["failed"], cancelled=0)
+
+        next_requeue = 0.0
+        while outstanding and not stop_event.is_set():
+            for result in queue.collect():
+                # Records of a job that ran twice (its lease expired) are merged again, which is harmless
+                for profile, record in zip(core.profiles, result.get("records", [])):
+                    if record:
+                        source = str((source_folder / record["source"]).absolute())
+                        profile.manifest.append({**record, "source": source,
+                                                 "output": os.path.normpath(profile.dest_folder / record["output"])})
+                        if is_measured(record.get("loudness")):
+                            core.gain_folders.add(os.path.dirname(source))
+                if outstanding.pop(result["id"], None) is None:
+                    continue
+                status = result["status"]
+                source = str(source_folder / result["source"])
+                output = os.path.normpath(dest_folder / result["output"]) if result.get("output") else None
+                if result.get("report"):
+                    core.report.add_file({**result["report"], "source": source, "output": output,
+                                          "worker": result.get("worker")})
+                    for stage, seconds in result["report"]["stages"].items():
+                        core.stage_totals[stage] = core.stage_totals.get(stage, 0.0) + seconds
+                if status in ("converted", "retagged"):
+                    counts["converted"] += 1
+                    core.log(f"✓ {status.capitalize()}: {result['output']} ({result.get('worker')})")
+                elif status == "reused":
+                    counts["reused"] += 1
+                    core.log(f"✓ Reused: {result['output']} ({result.get('worker')})")
+                elif status == "skipped":
+                    counts["skipped"] += 1
+                else:
+                    counts["failed"] += 1
+                    core.log(f"✗ Failed: {result['source']} ({result.get('worker')})")
+                file_done(source, output, status)
+
+            if time.monotonic() >= next_requeue:
+                next_requeue = time.monotonic() + lease_seconds / 4
+                for job in queue.requeue_expired(lease_seconds, max_attempts):
+                    if outstanding.pop(job["id"], None) is not None:
+                        counts["failed"] += 1
+                        core.log(f"✗ Failed: {job['source']} (abandoned after {job['attempts']} workers "
+                                 f"stopped renewing its lease)")
+                        file_done(str(source_folder / job["source"]), None, "failed")
+            if outstanding:
+                stop_event.wait(poll_interval)
+    finally:
+        for profile in core.profiles:
+            profile.manifest.close()
+            profile.manifest.compact()
+
+    core.apply_album_gain(core.gain_folders) # Workers only write track gains: an album may span several
+    was_cancelled = bool(outstanding)
+    if was_cancelled:
+        core.log(f"Coordinator stopped; {len(outstanding)} jobs stay queued in {queue.path}")
+    else:
+        queue.close()
+    counts["cancelled"] = len(outstanding)
+    return core.finish_batch(counts, True, was_cancelled)
+
+def run_worker(core, queue_dir, stop_event, source_folder=None, dest_folder=None):
+    """
+    Run jobs from the queue with core.get_worker_count() threads until the coordinator closes it or
+    stop_event is set. source_folder and dest_folder override the coordinator's paths, for hosts that
+    mount the shared folders elsewhere. Returns the number of jobs by status; None if stopped before
+    the coordinator wrote its config. Raises WorkerToolsError when this host's tools cannot run the
+    coordinator's settings (they are tested once those are known, as they choose the encoder engine).
+    """
+    poll_interval = core.settings.get("queue_poll_interval", 2)
+    queue = DirectoryQueue(queue_dir)
+    config = None
+    while config is None:
+        try:
+            config = queue.read_config()
+        except (OSError, ValueError):
+            if stop_event.wait(poll_interval):
+                return None
+
+    core.settings.update(config["settings"])
+    errors = core.test_tools()
+    if errors:
+        raise WorkerToolsError(errors)
+    lease_seconds = core.settings.get("queue_lease_seconds", 120) # The coordinator's, which it expires leases by
+    source_folder = Path(source_folder or config["source_folder"])
+    dest_folder = Path(dest_folder or config["dest_folder"]).absolute()
+    core.prepare_batch(source_folder, dest_folder)
+    for profile, encoder_settings in zip(core.profiles, config["encoder_settings"]):
+        profile.encoder_settings = encoder_settings
+    # Manifests and the journal are the coordinator's: the worker only reads the manifests
+    core.journal = JobJournal(dest_folder)
+    core.resumed = {}
+    workers = core.get_worker_count()
+    core.log(f"Worker {queue.worker_id} taking jobs from {queue.path} with {workers} parallel workers "
+             f"using {core.engine.description}")
+
+    def planned(flac_path, job):
+        """The plan of a job with the coordinator's output names, None when retagging or the error reading it"""
+        if not job.get("outputs"):
+            return None
+        try:
+            fingerprint = core.profiles[0].manifest.fingerprint(flac_path)
+            metadata = core.get_flac_metadata(flac_path)
+        except OSError as e:
+            return e
+        outputs = {profile: Path(os.path.normpath(profile.dest_folder / output))
+                   for profile, output in zip(core.profiles, job["outputs"]) if output}
+        return fingerprint, metadata, outputs
+
+    governor = WorkerGovernor(core.settings, workers, core.log, core.emit)
+    counts = {}
+    active = set() # Claim names being run, whose leases the heartbeat renews
+    lock = threading.Lock()
+    done = threading.Event()
+
+    def heartbeat():
+        while not done.wait(lease_seconds / 4):
+            with lock:
+                names = list(active)
+            for name in names:
+                if not queue.renew(name):
+                    core.log(f"Lost the lease of {name}; the coordinator gave it to another worker")
+
+    def run(job, name):
+        """Run a claimed job and report its result"""
+        with lock:
+            active.add(name)
+        try:
+            flac_path = source_folder / job["source"]
+            output_path, status, record = core.run_job(flac_path, source_folder, time.perf_counter(),
+                                                       planned(flac_path, job))
+            if status == "cancelled":
+                queue.release(name) # Another worker runs it
+                return
+            records = []
+            if status != "failed":
+                records = [profile.manifest.lookup(flac_path) for profile in core.profiles]
+                records = [relative_record(r, source_folder, profile.dest_folder) if r else None
+                           for profile, r in zip(core.profiles, records)]
+            output = relative_path(output_path, dest_folder) if output_path else None
+            report = {key: value for key, value in record.items() if key not in ("source", "output")}
+            queue.finish(name, {"id": job["id"], "source": job["source"], "status": status, "output": output,
+                                "records": records, "report": report})
+            with lock:
+                counts[status] = counts.get(status, 0) + 1
+        finally:
+            with lock:
+                active.discard(name)
+
+    def work():
+        while not stop_event.is_set() and not core.control.cancelled.is_set():
+            with governor.permit(core.control.cancelled):
+                claim = queue.claim()
+                if claim is None:
+                    if queue.is_closed():
+                        return
+                    stop_event.wait(poll_interval)
+                    continue
+                run(*claim)
+
+    threads = [threading.Thread(target=heartbeat, name="lease", daemon=True)]
+    threads += [threading.Thread(target=work, name=f"convert-{i}", daemon=True) for i in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads[1:]:
+        thread.join()
+    done.set()
+
+    summary = ", ".join(f"{count} {status}" for status, count in sorted(counts.items())) or "no jobs"
+    if stop_event.is_set() or core.control.cancelled.is_set():
+        core.log(f"Worker stopped: {summary}")
+    else:
+        core.log(f"Queue closed, worker finished: {summary}")
+    return counts
@@ -0,0 +1,502 @@
+"""
+Encoder engines: the ways a FLAC file can be turned into an MP3.
+
+"lame" decodes with FFmpeg and encodes with the LAME executable, either streaming the PCM through a
+pipe or via a temporary WAV file. "ffmpeg" decodes and encodes in a single FFmpeg process with its
+built-in libmp3lame encoder, halving the process spawns per file and removing the PCM hand-off.
+select_engine picks the engine from the settings and what the configured FFmpeg supports.
+Every child process runs under a WatchedJob, so it can be cancelled and is aborted when it stalls.
+Engines write to a temporary name next to the final MP3; commit_output moves it into place.
+A source read ahead into memory (see iosched.py) is fed to FFmpeg through its stdin.
+The FLAC tags are written as ID3v2.4 by id3.py into room the encoder reserves, so each MP3 is written
+once and both engines produce the same tags.
+With ReplayGain enabled the decode also measures the loudness (see loudness.py) into metadata["loudness"].
+An engine can encode one source into several MP3s (output profiles) while decoding it only once.
+"""
+import os
+import subprocess
+import tempfile
+import threading
+from pathlib import Path
+
+from id3 import frames_from_tags, write_tag, lame_padding_size
+from jobcontrol import WatchedJob, JobCancelled, JobStalled, JobTimedOut
+from loudness import UNMEASURED, loudness_filter, parse_loudness, replaygain_frames
+from profiles import lame_quality_args, ffmpeg_quality_args
+
+# Suffix of MP3s still being written; the file name starts with a dot to hide it on Unix
+PARTIAL_SUFFIX = ".partial.mp3"
+
+def drain_stream(stream):
+    """Read a process pipe to EOF on a daemon thread; returns (thread, collected chunks)"""
+    chunks = []
+    def reader():
+        with stream:
+            for chunk in iter(lambda: stream.read(65536), b""):
+                chunks.append(chunk)
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+    return thread, chunks
+
+def fan_out(source, sinks):
+    """
+    Copy a process pipe to several process stdins on a daemon thread; returns the thread.
+    A sink whose process exits early is dropped (its exit code reports the error); the source is
+    closed once no sink is left, so the producing process sees a broken pipe as well.
+    """
+    def copier():
+        open_sinks = list(sinks)
+        with source:
+            for chunk in iter(lambda: source.read(65536), b""):
+                for sink in list(open_sinks):
+                    try:
+                        sink.write(chunk)
+                    except (BrokenPipeError, ValueError, OSError):
+                        open_sinks.remove(sink)
+                if not open_sinks:
+                    break
+        for sink in sinks:
+            try:
+                sink.close()
+            except OSError:
+                pass
+    thread = threading.Thread(target=copier, daemon=True)
+    thread.start()
+    return thread
+
+def feed_stream(data, sink, on_done=None):
+    """
+    Write data to a process stdin on a daemon thread, closing it at the end and then calling on_done
+    (also when the process exited early); returns the thread
+    """
+    def writer():
+        try:
+            with sink:
+                sink.write(data)
+        except (BrokenPipeError, ValueError, OSError):
+            pass # The process exited early; its exit code reports the error
+        finally:
+            if on_done:
+                on_done()
+    thread = threading.Thread(target=writer, daemon=True)
+    thread.start()
+    return thread
+
+def input_args(flac_path, source_data):
+    """FFmpeg options reading the source from its file, or from stdin when it was read ahead"""
+    if source_data is None:
+        return ["-i", str(flac_path)]
+    return ["-f", "flac", "-i", "pipe:0"]
+
+def spawn_decoder(job, cmd, source_data, progress=True, **popen_kwargs):
+    """
+    Start an FFmpeg reading the source with input_args, feeding it source_data (an iosched.SourceBuffer)
+    when read ahead; the buffer is released as soon as it has all been written
+    """
+    if source_data is not None:
+        popen_kwargs["stdin"] = subprocess.PIPE
+    proc = job.spawn(cmd, progress, **popen_kwargs)
+    if source_data is not None:
+        feed_stream(source_data.data, proc.stdin, source_data.release)
+    return proc
+
+def join_output(reader):
+    """Wait for a drain_stream reader to finish and return its output as text"""
+    thread, chunks = reader
+    thread.join(timeout=5)
+    return b"".join(chunks).decode(errors="replace").strip()
+
+def remove_partial_output(core, output_path):
+    """Remove a partially written MP3 so it cannot be mistaken for a complete one"""
+    if Path(output_path).exists():
+        try:
+            os.remove(output_path)
+        except OSError as e:
+            core.log(f"Error removing partial output {Path(output_path).name}: {e}")
+
+def partial_output_path(output_path):
+    """
+    Temporary name an MP3 is written under until it is complete (same folder, so the rename is atomic).
+    It is unique per process and thread, so two jobs writing the same output never share it.
+    """
+    output_path = Path(output_path)
+    return output_path.with_name(f".{output_path.stem}.{os.getpid()}-{threading.get_native_id()}{PARTIAL_SUFFIX}")
+
+def commit_output(partial_path, output_path, fsync=True):
+    """
+    Atomically replace output_path with the finished partial file.
+
+    With fsync the data is flushed to disk before the rename and the rename before returning,
+    so after a crash or power loss output_path holds either the old file or the complete new one.
+    """
+    if fsync:
+        with open(partial_path, "r+b") as f:
+            os.fsync(f.fileno())
+    os.replace(partial_path, output_path)
+    if fsync and os.name != "nt": # Windows cannot open a folder to flush it
+        folder = os.open(Path(output_path).parent, os.O_RDONLY)
+        try:
+            os.fsync(folder)
+        finally:
+            os.close(folder)
+
+class EncoderEngine:
+    """Base class of the encoder engines; encode() returns True on success"""
+    name = ""
+    description = ""
+
+    def __init__(self, core):
+        self.core = core
+
+    def required_tools(self):
+        """(settings key, display name, version argument) of the executables this engine runs"""
+        return [("ffmpeg_path", "FFmpeg", "-version")]
+
+    def encode(self, flac_path, outputs, metadata, source_data=None):
+        """
+        Encode flac_path into every (output path, quality) of outputs, decoding it once. source_data
+        is the iosched.SourceBuffer of the file when it was read ahead, to decode instead of reading the file.
+        """
+        raise NotImplementedError
+
+    def tag_frames(self, metadata):
+        """ID3 frames for the FLAC tags, or none when tag writing is disabled"""
+        if not self.core.settings.get("write_tags", True):
+            return []
+        return frames_from_tags(metadata.get("tags", {}), metadata.get("art"))
+
+    def write_tags(self, flac_path, outputs, metadata):
+        """
+        Write the ID3v2.4 tag (with the ReplayGain measured by the decode that just finished) into the
+        space the encoder reserved for it. Returns False, with the outputs removed, when that fails.
+        """
+        frames = self.tag_frames(metadata)
+        if not frames:
+            return True
+        frames += replaygain_frames(metadata.get("loudness"))
+        try:
+            with self.core.timed("tag"):
+                in_place = all([write_tag(output_path, frames) for output_path, _ in outputs])
+            self.core.annotate(tag_in_place=in_place)
+            return True
+        except OSError as e:
+            self.core.log(f"Error writing tags for {flac_path.name}: {e}")
+            self.remove_outputs(outputs)
+            return False
+
+    def watched_job(self, metadata, outputs=1):
+        """WatchedJob for one file, with time limits scaled to the track's duration and number of outputs"""
+        return WatchedJob(self.core.control, self.core.settings,
+                          metadata.get("duration", 0) * outputs, metadata.get("sample_rate", 0))
+
+    def loudness_args(self, metadata):
+        """FFmpeg filters measuring the loudness during the decode, when ReplayGain is enabled"""
+        if not self.core.settings.get("replaygain", False):
+            return []
+        return ["-af", loudness_filter(metadata.get("bits_per_sample", 0))]
+
+    def keep_loudness(self, flac_path, ffmpeg_stderr, metadata):
+        """Store the loudness measured by loudness_args' filter in metadata["loudness"]"""
+        if not self.core.settings.get("replaygain", False):
+            return
+        metadata["loudness"] = parse_loudness(ffmpeg_stderr, metadata.get("duration", 0))
+        if metadata["loudness"] is None:
+            self.core.log(f"No loudness measured for {flac_path.name} (silent or too short)")
+            metadata["loudness"] = dict(UNMEASURED)
+
+    def remove_outputs(self, outputs):
+        for output_path, _ in outputs:
+            remove_partial_output(self.core, output_path)
+
+    def log_abort(self, flac_path, error):
+        """Log a job stopped by a cancel or by the watchdog"""
+        if isinstance(error, JobCancelled):
+            self.core.log(f"Cancelled: {flac_path.name}")
+        else:
+            self.core.log(f"Conversion aborted for {flac_path.name}: {error}.")
+            self.core.report_error("Timeout", f"Conversion aborted for {flac_path.name}: {error}.")
+
+class LameChainEngine(EncoderEngine):
+    """FFmpeg decodes to WAV, the LAME executable encodes it to MP3"""
+    name = "lame"
+    description = "FFmpeg decode -> LAME encode"
+
+    def required_tools(self):
+        return [("lame_path", "LAME encoder", "--version"), ("ffmpeg_path", "FFmpeg", "-version")]
+
+    def encode(self, flac_path, outputs, metadata, source_data=None):
+        """
+        Convert single FLAC file to MP3s, streamed or via a temporary WAV depending on settings.
+
+        LAME only writes ID3v2.3 and a few fields, so it is asked to reserve an empty tag big enough
+        for all of them; the ID3v2.4 tag is then written into that space without touching the audio.
+        """
+        if self.core.settings.get("stream_decode", True):
+            success = self.encode_streamed(flac_path, outputs, metadata, source_data)
+        else:
+            success = self.encode_via_wav(flac_path, outputs, metadata, source_data)
+        return success and self.write_tags(flac_path, outputs, metadata)
+
+    def lame_tag_args(self, metadata):
+        """LAME options reserving room for the ID3v2 tag written after encoding"""
+        frames = self.tag_frames(metadata)
+        if not frames:
+            return []
+        return ["--id3v2-only", "--pad-id3v2-size", str(lame_padding_size(frames))]
+
+    def lame_command(self, input_path, output_path, quality, metadata):
+        return [
+            self.core.settings["lame_path"],
+            *lame_quality_args(quality), # Bitrate or VBR preset
+            *self.lame_tag_args(metadata),
+            input_path, # "-" reads from stdin
+            str(output_path) # Output MP3 file
+        ]
+
+    def encode_streamed(self, flac_path, outputs, metadata, source_data=None):
+        """
+        Convert single FLAC file to MP3s by piping FFmpeg's decoded WAV stream straight into LAME.
+
+        Decode and encode run at the same time and no PCM is written to disk. With several outputs
+        the stream is copied to one LAME process per output, so the FLAC is still decoded only once.
+        Partially written MP3s are removed if any process fails or the conversion is aborted.
+        """
+        ffmpeg_path = self.core.settings["ffmpeg_path"]
+        
+        ffmpeg_cmd = [
+            ffmpeg_path, "-hide_banner", "-nostdin",
+            *input_args(flac_path, source_data),
+            *self.loudness_args(metadata),
+            "-f", "wav", # Output format
+            "-acodec", "pcm_s16le", # Force PCM 16-bit signed little-endian
+            "pipe:1" # Output to stdout
+        ]
+        
+        job = self.watched_job(metadata, len(outputs))
+        success = False
+        
+        try:
+            # The job's progress is LAME's: the decoder runs ahead by the pipe's buffer
+            ffmpeg_proc = spawn_decoder(job, ffmpeg_cmd, source_data, progress=False, stdout=subprocess.PIPE)
+            lame_procs = []
+            if len(outputs) == 1:
+                output_path, quality = outputs[0]
+                lame_procs.append(job.spawn(self.lame_command("-", output_path, quality, metadata),
+                                            stdin=ffmpeg_proc.stdout, stdout=subprocess.PIPE))
+                # Only LAME reads the pipe now; closing our copy lets FFmpeg see EPIPE if LAME exits early
+                ffmpeg_proc.stdout.close()
+            else:
+                for output_path, quality in outputs:
+                    lame_procs.append(job.spawn(self.lame_command("-", output_path, quality, metadata),
+                                                stdin=subprocess.PIPE, stdout=subprocess.PIPE))
+                fan_out_thread = fan_out(ffmpeg_proc.stdout, [proc.stdin for proc in lame_procs])
+            
+            # stderr is read by the job's progress readers; drain stdout too so LAME never blocks on it
+            lame_stdout_readers = [drain_stream(proc.stdout) for proc in lame_procs]
+            
+            # All processes run concurrently, so the watchdog supervises them together
+            with self.core.timed("decode_encode"):
+                job.wait()
+            if len(outputs) > 1:
+                fan_out_thread.join(timeout=5)
+            
+            ffmpeg_stderr = job.stderr(ffmpeg_proc)
+            
+            # When LAME dies first FFmpeg fails with a broken pipe, so report LAME's error first
+            for lame_proc, reader in zip(lame_procs, lame_stdout_readers):
+                lame_stdout = join_output(reader)
+                if lame_proc.returncode != 0:
+                    self.core.log(f"LAME conversion failed for {flac_path.name}.")
+                    self.core.log(f"LAME stderr: {job.stderr(lame_proc)}")
+                    if lame_stdout: # Log stdout if it exists
+                        self.core.log(f"LAME stdout: {lame_stdout}")
+            if ffmpeg_proc.returncode != 0:
+                self.core.log(f"FFmpeg decode failed for {flac_path.name}.")
+                self.core.log(f"FFmpeg stderr: {ffmpeg_stderr}")
+            if ffmpeg_proc.returncode != 0 or any(proc.returncode != 0 for proc in lame_procs):
+                return False
+            
+            self.core.log(f"Streamed FFmpeg -> LAME conversion successful for {flac_path.name}.")
+            self.keep_loudness(flac_path, ffmpeg_stderr, metadata)
+            success = True
+            return True
+        
+        except FileNotFoundError as e:
+            self.core.log(f"Executable not found: {e}. Please check LAME/FFmpeg paths in settings.")
+            self.core.report_error("Error", f"Executable not found: {e}. Please check LAME/FFmpeg paths in settings.")
+            return False
+        except (JobCancelled, JobStalled, JobTimedOut) as e:
+            self.log_abort(flac_path, e)
+            return False
+        except Exception as e:
+            self.core.log(f"An unexpected error occurred during conversion of {flac_path.name}: {str(e)}")
+            self.core.report_error("Error", f"An unexpected error occurred: {str(e)}")
+            return False
+        finally:
+            # Make sure no process outlives a failed or aborted conversion
+            job.close()
+            if not success:
+                self.remove_outputs(outputs)
+    
+    def encode_via_wav(self, flac_path, outputs, metadata, source_data=None):
+        """Convert single FLAC file to MP3s via an intermediate WAV file, encoded by one LAME process per output."""
+        ffmpeg_path = self.core.settings["ffmpeg_path"]
+        
+        temp_wav_path = None # Initialize to None to ensure proper cleanup in finally block
+        job = self.watched_job(metadata, len(outputs))
+        success = False
+
+        try:
+            # 1. Create a temporary WAV file path
+            with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as temp_wav_file:
+                temp_wav_path = Path(temp_wav_file.name)
+            
+
+            # 2. Convert FLAC to WAV using FFmpeg
+            ffmpeg_cmd = [
+                ffmpeg_path, "-y", # Overwrite without asking
+                *input_args(flac_path, source_data),
+                *self.loudness_args(metadata),
+                "-f", "wav", # Output format
+                "-acodec", "pcm_s16le", # Force PCM 16-bit signed little-endian
+                str(temp_wav_path) # Output to temporary WAV file
+            ]
+            
+            # The job's progress is the encode's; the decode to WAV takes a small part of the time
+            ffmpeg_proc = spawn_decoder(job, ffmpeg_cmd, source_data, progress=False,
+                                        stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+            with self.core.timed("decode"):
+                job.wait()
+
+            if ffmpeg_proc.returncode != 0:
+                self.core.log(f"FFmpeg conversion failed for {flac_path.name}.")
+                self.core.log(f"FFmpeg stderr: {job.stderr(ffmpeg_proc)}")
+                return False
+
+            self.core.log(f"FFmpeg conversion to WAV successful for {flac_path.name}.")
+            self.keep_loudness(flac_path, job.stderr(ffmpeg_proc), metadata)
+
+            # 3. Convert WAV to MP3 using LAME, all outputs at the same time
+            lame_procs = [job.spawn(self.lame_command(str(temp_wav_path), output_path, quality, metadata),
+                                    stdin=subprocess.DEVNULL, stdout=subprocess.PIPE)
+                          for output_path, quality in outputs]
+            lame_stdout_readers = [drain_stream(proc.stdout) for proc in lame_procs]
+            with self.core.timed("encode"):
+                job.wait()
+
+            for lame_proc, reader in zip(lame_procs, lame_stdout_readers):
+                lame_stdout = join_output(reader)
+                if lame_proc.returncode != 0:
+                    self.core.log(f"LAME conversion failed for {flac_path.name}.")
+                    self.core.log(f"LAME stderr: {job.stderr(lame_proc)}")
+                    if lame_stdout: # Log stdout if it exists
+                        self.core.log(f"LAME stdout: {lame_stdout}")
+            if any(proc.returncode != 0 for proc in lame_procs):
+                return False
+
+            self.core.log(f"LAME conversion to MP3 successful for {flac_path.name}.")
+            success = True
+            return True
+
+        except FileNotFoundError as e:
+            self.core.log(f"Executable not found: {e}. Please check LAME/FFmpeg paths in settings.")
+            self.core.report_error("Error", f"Executable not found: {e}. Please check LAME/FFmpeg paths in settings.")
+            return False
+        except (JobCancelled, JobStalled, JobTimedOut) as e:
+            self.log_abort(flac_path, e)
+            return False
+        except Exception as e:
+            self.core.log(f"An unexpected error occurred during conversion of {flac_path.name}: {str(e)}")
+            self.core.report_error("Error", f"An unexpected error occurred: {str(e)}")
+            return False
+        finally:
+            job.close()
+            if not success:
+                self.remove_outputs(outputs)
+            # 4. Clean up temporary WAV file
+            if temp_wav_path and temp_wav_path.exists():
+                self.core.annotate(temp_bytes=temp_wav_path.stat().st_size)
+                try:
+                    with self.core.timed("temp_cleanup"):
+                        os.remove(temp_wav_path)
+                except OSError as e:
+                    self.core.log(f"Error cleaning up temporary WAV {temp_wav_path.name}: {e}")
+
+class FfmpegLameEngine(EncoderEngine):
+    """A single FFmpeg process decodes and encodes with libmp3lame"""
+    name = "ffmpeg"
+    description = "FFmpeg with libmp3lame (single process)"
+
+    def encode(self, flac_path, outputs, metadata, source_data=None):
+        """
+        One FFmpeg process with one output per profile: the decoded audio feeds every encoder.
+
+        FFmpeg's MP3 muxer writes some frames differently (or as TXXX), so it only reserves padding for
+        the tag and the tag itself is written afterwards by id3.py, as with LAME.
+        """
+        ffmpeg_path = self.core.settings["ffmpeg_path"]
+
+        frames = self.tag_frames(metadata)
+        tag_args = ["-metadata_header_padding", str(lame_padding_size(frames))] if frames else []
+        ffmpeg_cmd = [
+            ffmpeg_path, "-hide_banner", "-nostdin", "-y",
+            *input_args(flac_path, source_data)
+        ]
+        for i, (output_path, quality) in enumerate(outputs):
+            ffmpeg_cmd += [
+                "-map", "0:a", # The FLAC's own pictures would become a video stream; the cover goes in the tag
+                *(self.loudness_args(metadata) if i == 0 else []), # Measured once; every output gets the same audio
+                "-c:a", "libmp3lame",
+                *ffmpeg_quality_args(quality), # Bitrate or VBR preset
+                "-map_metadata", "-1", # The tags are written by write_tags
+                "-id3v2_version", "4",
+                "-write_id3v1", "0",
+                *tag_args,
+                str(output_path)
+            ]
+
+        job = self.watched_job(metadata, len(outputs))
+        success = False
+        try:
+            ffmpeg_proc = spawn_decoder(job, ffmpeg_cmd, source_data, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+            with self.core.timed("decode_encode"):
+                job.wait()
+
+            if ffmpeg_proc.returncode != 0:
+                self.core.log(f"FFmpeg conversion failed for {flac_path.name}.")
+                self.core.log(f"FFmpeg stderr: {job.stderr(ffmpeg_proc)}")
+                return False
+
+            self.core.log(f"FFmpeg libmp3lame conversion successful for {flac_path.name}.")
+            self.keep_loudness(flac_path, job.stderr(ffmpeg_proc), metadata)
+            success = True
+
+        except FileNotFoundError as e:
+            self.core.log(f"Executable not found: {e}. Please check the FFmpeg path in settings.")
+            self.core.report_error("Error", f"Executable not found: {e}. Please check the FFmpeg path in settings.")
+            return False
+        except (JobCancelled, JobStalled, JobTimedOut) as e:
+            self.log_abort(flac_path, e)
+            return False
+        except Exception as e:
+            self.core.log(f"An unexpected error occurred during conversion of {flac_path.name}: {str(e)}")
+            self.core.report_error("Error", f"An unexpected error occurred: {str(e)}")
+            return False
+        finally:
+            job.close()
+            if not success:
+                self.remove_outputs(outputs)
+
+ENGINES = {engine.name: engine for engine in (LameChainEngine, FfmpegLameEngine)}
+
+def select_engine(core):
+    """
+    Engine named by the "encoder_engine" setting; with "auto", the single process FFmpeg engine when
+    the configured FFmpeg has libmp3lame, otherwise the FFmpeg -> LAME chain.
+    """
+    choice = core.settings.get("encoder_engine", "auto")
+    if choice in ENGINES:
+        return ENGINES[choice](core)
+    if core.ffmpeg_capabilities()["libmp3lame"]:
+        return FfmpegLameEngine(core)
+    return LameChainEngine(core)
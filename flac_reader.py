@@ -0,0 +1,141 @@
+"""
+In-process FLAC metadata reader.
+
+Reads only the metadata blocks at the start of a FLAC file (STREAMINFO, VORBIS_COMMENT and the
+headers of PICTURE blocks) and seeks past everything else, so tags and stream properties are
+available without starting an ffprobe process or reading any audio frames. Picture data is not
+read; read_picture_data fetches it when it is needed.
+"""
+import struct
+
+STREAMINFO = 0
+VORBIS_COMMENT = 4
+PICTURE = 6
+
+# ID3/FLAC picture type of the front cover
+FRONT_COVER = 3
+
+class FlacFormatError(Exception):
+    """The file is not a FLAC file or its metadata is corrupt"""
+
+def skip_id3v2(f):
+    """Skip an ID3v2 tag some taggers put in front of the fLaC marker; returns the next 4 bytes"""
+    header = f.read(10)
+    if header[:3] != b"ID3" or len(header) < 10:
+        f.seek(4)
+        return header[:4]
+    # Tag size is a 28 bit "synchsafe" integer (7 bits per byte)
+    size = (header[6] << 21) | (header[7] << 14) | (header[8] << 7) | header[9]
+    if header[5] & 0x10: # Footer present
+        size += 10
+    f.seek(10 + size)
+    return f.read(4)
+
+def parse_streaminfo(data):
+    """Decode the STREAMINFO block into sample rate, channels, bit depth, length and audio MD5"""
+    if len(data) < 34:
+        raise FlacFormatError("STREAMINFO block too short")
+    # Bytes 10-17 pack: sample rate (20 bits), channels - 1 (3 bits),
+    # bits per sample - 1 (5 bits) and total samples (36 bits)
+    packed = int.from_bytes(data[10:18], "big")
+    sample_rate = packed >> 44
+    channels = ((packed >> 41) & 0x7) + 1
+    bits_per_sample = ((packed >> 36) & 0x1F) + 1
+    total_samples = packed & 0xFFFFFFFFF
+    return {
+        "sample_rate": sample_rate,
+        "channels": channels,
+        "bits_per_sample": bits_per_sample,
+        "total_samples": total_samples,
+        # Total samples may be 0 (unknown) for streamed encodes
+        "duration": total_samples / sample_rate if sample_rate and total_samples else 0.0,
+        "md5": data[18:34].hex()
+    }
+
+def parse_vorbis_comment(data):
+    """Decode a VORBIS_COMMENT block into {lowercase field name: [values]}"""
+    try:
+        vendor_length, = struct.unpack_from("<I", data, 0)
+        offset = 4 + vendor_length
+        count, = struct.unpack_from("<I", data, offset)
+        offset += 4
+        tags = {}
+        for _ in range(count):
+            length, = struct.unpack_from("<I", data, offset)
+            offset += 4
+            comment = data[offset:offset + length].decode("utf-8", errors="replace")
+            offset += length
+            key, separator, value = comment.partition("=")
+            if separator:
+                tags.setdefault(key.lower(), []).append(value)
+        return tags
+    except struct.error:
+        raise FlacFormatError("Truncated VORBIS_COMMENT block")
+
+def parse_picture_header(f, length):
+    """
+    Read the fields of a PICTURE block up to its image data and seek past the data.
+
+    Returns type, mime, description, width, height and the offset and length of the image data.
+    """
+    start = f.tell()
+    try:
+        picture_type, mime_length = struct.unpack(">II", f.read(8))
+        mime = f.read(mime_length).decode("ascii", errors="replace")
+        description_length, = struct.unpack(">I", f.read(4))
+        description = f.read(description_length).decode("utf-8", errors="replace")
+        width, height, _, _, data_length = struct.unpack(">IIIII", f.read(20))
+    except struct.error:
+        raise FlacFormatError("Truncated PICTURE block")
+    offset = f.tell()
+    if offset - start + data_length > length:
+        raise FlacFormatError("PICTURE data exceeds its block")
+    f.seek(start + length)
+    return {"type": picture_type, "mime": mime, "description": description, "width": width,
+            "height": height, "offset": offset, "length": data_length}
+
+def read_picture_data(path, picture):
+    """Image bytes of a picture returned by read_flac_info"""
+    with open(path, "rb") as f:
+        f.seek(picture["offset"])
+        return f.read(picture["length"])
+
+def read_flac_info(path):
+    """
+    Read STREAMINFO and Vorbis comments from a FLAC file.
+
+    Returns a dict with sample_rate, channels, bits_per_sample, total_samples, duration (seconds),
+    md5 (hex digest of the decoded audio), tags ({lowercase name: [values]}) and pictures
+    (the parse_picture_header dicts of the embedded images).
+    Raises FlacFormatError if the file is not a valid FLAC file.
+    """
+    with open(path, "rb") as f:
+        if skip_id3v2(f) != b"fLaC":
+            raise FlacFormatError("Missing fLaC marker")
+
+        info = None
+        tags = {}
+        pictures = []
+        is_last = False
+        while not is_last:
+            header = f.read(4)
+            if len(header) < 4:
+                raise FlacFormatError("Truncated metadata block header")
+            is_last = bool(header[0] & 0x80)
+            block_type = header[0] & 0x7F
+            length = int.from_bytes(header[1:4], "big")
+
+            if block_type == STREAMINFO:
+                info = parse_streaminfo(f.read(length))
+            elif block_type == VORBIS_COMMENT: # At most 16 MiB, the largest 24 bit block length
+                tags = parse_vorbis_comment(f.read(length))
+            elif block_type == PICTURE:
+                pictures.append(parse_picture_header(f, length))
+            else:
+                f.seek(length, 1) # Padding, seek tables... are not needed
+
+        if info is None:
+            raise FlacFormatError("Missing STREAMINFO block")
+        info["tags"] = tags
+        info["pictures"] = pictures
+        return info
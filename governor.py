@@ -0,0 +1,220 @@
+"""
+Resource governor: a batch uses the machine's idle capacity without slowing down its other work.
+
+The FFmpeg/LAME processes run at a lower CPU priority ("process_nice"), in a lower Linux I/O
+scheduling class ("process_io_class") and, with "cpu_affinity", only on the given CPUs. The
+priority is set right after each process starts rather than in a preexec_fn, which is not safe in a
+threaded program; the moment the process runs before that does not matter. Windows only knows
+priority classes, chosen when the process is created: any "process_nice" above 0 means below normal.
+
+With "adaptive_workers" each worker thread takes a permit before it starts a file, and the number
+of permits follows the load of the system's other work: the 1-minute load average minus the batch's
+own share of it. That share is the number of running conversions times the load one conversion
+causes (its processes' CPU time per second of conversion, measured as files finish), averaged over
+a minute the way the kernel averages the load. The limit starts at what other work leaves free of
+"load_per_cpu" x the number of CPUs, then checks every "governor_interval" seconds: it drops by one
+while other work takes more than the rest (or less than "memory_reserve_mb" of memory is available)
+and rises by one while both have room. Load-driven changes are at most once a minute, the time the
+load average takes to show them; a memory shortage lowers it at once. Files already running are
+never stopped: a lower limit applies as they finish.
+"""
+import ctypes
+import math
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+IO_CLASSES = {"best-effort": 2, "idle": 3} # Linux ioprio classes; "realtime" needs root
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_SHIFT = 13
+# ioprio_set has no wrapper in Python or glibc, so it is called by its system call number
+IOPRIO_SET = {"x86_64": 251, "i386": 289, "i686": 289, "aarch64": 30, "armv7l": 314, "ppc64le": 273, "riscv64": 30}
+# Seconds the 1-minute load average needs to reflect a change in the number of conversions
+LOAD_RESPONSE_SECONDS = 60
+# Load of one conversion until files have finished to measure it: decoder and encoder of the FFmpeg -> LAME chain
+DEFAULT_LOAD_PER_JOB = 2.0
+# Seconds of finished conversions needed before their measured load is used
+MEASURE_JOB_SECONDS = 30
+
+libc = None
+
+def priority_kwargs(settings):
+    """Popen arguments for the priority settings that only apply when a process is created (Windows)"""
+    nice = settings.get("process_nice", 0)
+    if os.name == "nt" and nice > 0:
+        return {"creationflags": subprocess.IDLE_PRIORITY_CLASS if nice >= 19 else subprocess.BELOW_NORMAL_PRIORITY_CLASS}
+    return {}
+
+def set_io_priority(pid, io_class, level):
+    """Set the Linux I/O scheduling class of a process; False where that is not possible"""
+    global libc
+    number = IOPRIO_SET.get(platform.machine())
+    if number is None or not sys.platform.startswith("linux"):
+        return False
+    if libc is None:
+        libc = ctypes.CDLL(None, use_errno=True)
+    level = 0 if io_class == "idle" else min(7, max(0, level))
+    return libc.syscall(number, IOPRIO_WHO_PROCESS, pid, (IO_CLASSES[io_class] << IOPRIO_CLASS_SHIFT) | level) == 0
+
+def lower_priority(pid, settings):
+    """Apply the niceness, I/O class and CPU affinity settings to a started process, where the OS allows"""
+    nice = settings.get("process_nice", 0)
+    if nice > 0 and hasattr(os, "setpriority"):
+        try:
+            # Niceness is absolute: never give the child a higher priority than the converter has
+            os.setpriority(os.PRIO_PROCESS, pid, max(nice, os.getpriority(os.PRIO_PROCESS, 0)))
+        except OSError:
+            pass
+    io_class = settings.get("process_io_class", "")
+    if io_class in IO_CLASSES:
+        set_io_priority(pid, io_class, settings.get("process_io_level", 7))
+    cpus = settings.get("cpu_affinity") or []
+    if cpus and hasattr(os, "sched_setaffinity"):
+        try:
+            os.sched_setaffinity(pid, cpus)
+        except OSError:
+            pass
+
+def run_lowered(cmd, settings, timeout, input=None, text=False):
+    """
+    subprocess.run with captured output for the short helper processes of a conversion (cover art,
+    ffprobe), at the same priority as the FFmpeg/LAME processes. Raises subprocess.TimeoutExpired.
+    """
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE if input is not None else subprocess.DEVNULL,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=text, **priority_kwargs(settings))
+    lower_priority(proc.pid, settings)
+    try:
+        stdout, stderr = proc.communicate(input, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.communicate()
+        raise
+    return subprocess.CompletedProcess(cmd, proc.returncode, stdout, stderr)
+
+def children_cpu_seconds():
+    """CPU time used by the finished child processes of this process (0 where the OS does not say)"""
+    times = os.times()
+    return times.children_user + times.children_system
+
+def load_average():
+    """The 1-minute load average, or None where there is none (Windows)"""
+    try:
+        return os.getloadavg()[0]
+    except (AttributeError, OSError):
+        return None
+
+def memory_available_mb():
+    """Memory available without swapping (MemAvailable), in MB, or None where it is not known"""
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+class WorkerGovernor:
+    def __init__(self, settings, workers, log=print, emit=None):
+        self.workers = workers
+        self.minimum = min(workers, max(1, settings.get("min_workers", 1)))
+        self.load_limit = settings.get("load_per_cpu", 1.0) * (os.cpu_count() or 1) # The load average is system wide
+        self.memory_reserve = settings.get("memory_reserve_mb", 512)
+        self.interval = settings.get("governor_interval", 5)
+        self.log = log
+        self.emit = emit
+        self.condition = threading.Condition()
+        self.active = 0 # Permits taken
+        self.limit = workers
+        self.lowest = workers # Lowest limit of the batch, for the summary
+        self.next_check = 0.0
+        self.next_raise = 0.0
+        self.next_lower = 0.0
+        self.own_load = 0.0 # The batch's share of the load average, averaged like it
+        self.last_update = time.monotonic()
+        self.cpu_start = children_cpu_seconds()
+        self.job_seconds = 0.0 # Wall-clock seconds of the finished permits, for load_per_job
+        load = load_average()
+        self.enabled = settings.get("adaptive_workers", True) and load is not None and workers > self.minimum
+        if self.enabled:
+            # The batch has not started yet, so the current load is all other work
+            self.set_limit(round(self.load_limit - load), load, memory_available_mb())
+
+    def set_limit(self, limit, load, memory):
+        limit = max(self.minimum, min(self.workers, limit))
+        if limit == self.limit:
+            return
+        if limit > self.limit:
+            self.next_raise = time.monotonic() + LOAD_RESPONSE_SECONDS
+            self.condition.notify_all()
+        else:
+            self.next_lower = time.monotonic() + LOAD_RESPONSE_SECONDS
+        self.limit = limit
+        self.lowest = min(self.lowest, limit)
+        memory_text = f", {memory:.0f} MB available" if memory is not None else ""
+        self.log(f"Load {load:.1f} on {os.cpu_count() or 1} CPUs{memory_text}: "
+                 f"running up to {limit} of {self.workers} conversions")
+        if self.emit:
+            self.emit("workers", limit=limit, workers=self.workers, load=round(load, 2),
+                      memory_available_mb=round(memory) if memory is not None else None)
+
+    def load_per_job(self):
+        """Load one running conversion causes: its processes' CPU seconds per second, once enough files finished"""
+        if self.job_seconds < MEASURE_JOB_SECONDS:
+            return DEFAULT_LOAD_PER_JOB
+        return (children_cpu_seconds() - self.cpu_start) / self.job_seconds
+
+    def update_own_load(self, now):
+        """Average the batch's load over a minute, as the kernel does the load average it is part of"""
+        decay = math.exp(-(now - self.last_update) / LOAD_RESPONSE_SECONDS)
+        self.own_load = self.own_load * decay + self.active * self.load_per_job() * (1 - decay)
+        self.last_update = now
+
+    def adjust(self):
+        now = time.monotonic()
+        self.update_own_load(now)
+        if now < self.next_check:
+            return
+        self.next_check = now + self.interval
+        load = load_average()
+        memory = memory_available_mb()
+        other_load = max(0.0, load - self.own_load)
+        if memory is not None and memory < self.memory_reserve:
+            self.set_limit(self.limit - 1, load, memory) # Memory use shows at once, unlike the load
+        elif now >= self.next_lower and other_load > self.load_limit - self.limit:
+            self.set_limit(self.limit - 1, load, memory)
+        elif (now >= self.next_raise and other_load < self.load_limit - self.limit - 1
+              and (memory is None or memory > 2 * self.memory_reserve)):
+            self.set_limit(self.limit + 1, load, memory)
+
+    def acquire(self, cancelled=None):
+        """Wait for a permit to start a file; a cancelled batch (event set) gets one at once, to drain its queue"""
+        with self.condition:
+            while True:
+                if self.enabled:
+                    self.adjust()
+                if self.active < self.limit or (cancelled is not None and cancelled.is_set()):
+                    self.active += 1
+                    return
+                self.condition.wait(self.interval)
+
+    def release(self, seconds=0.0):
+        with self.condition:
+            if self.enabled:
+                self.update_own_load(time.monotonic())
+            self.active -= 1
+            self.job_seconds += seconds
+            self.condition.notify()
+
+    @contextmanager
+    def permit(self, cancelled=None):
+        self.acquire(cancelled)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(time.monotonic() - start)
@@ -0,0 +1,263 @@
+"""
+In-process ID3v2.4 tag writer.
+
+Maps FLAC Vorbis comments to ID3v2.4 frames (text frames, TXXX for everything without a standard
+frame, COMM, USLT, the MusicBrainz UFID and APIC for the cover art) and writes them at the start of an MP3. When the file
+already has a tag with enough space (LAME reserves it with --pad-id3v2-size) only the tag is
+rewritten in place; otherwise the file is rewritten once behind the new tag. update_txxx changes
+single TXXX frames (e.g. ReplayGain) the same way, keeping the rest of the tag.
+"""
+import os
+from pathlib import Path
+
+# Vorbis comment -> ID3v2.4 text frame
+TEXT_FRAMES = {
+    "title": "TIT2",
+    "subtitle": "TIT3",
+    "grouping": "TIT1",
+    "artist": "TPE1",
+    "albumartist": "TPE2",
+    "album artist": "TPE2",
+    "conductor": "TPE3",
+    "remixer": "TPE4",
+    "album": "TALB",
+    "discsubtitle": "TSST",
+    "composer": "TCOM",
+    "lyricist": "TEXT",
+    "date": "TDRC",
+    "year": "TDRC",
+    "originaldate": "TDOR",
+    "originalyear": "TDOR",
+    "genre": "TCON",
+    "mood": "TMOO",
+    "bpm": "TBPM",
+    "initialkey": "TKEY",
+    "language": "TLAN",
+    "media": "TMED",
+    "isrc": "TSRC",
+    "copyright": "TCOP",
+    "label": "TPUB",
+    "organization": "TPUB",
+    "publisher": "TPUB",
+    "encodedby": "TENC",
+    "compilation": "TCMP",
+    "albumsort": "TSOA",
+    "artistsort": "TSOP",
+    "titlesort": "TSOT",
+    "albumartistsort": "TSO2",
+    "composersort": "TSOC"
+}
+
+# Vorbis comment -> TXXX description, where taggers agree on a name other than the upper case key
+TXXX_NAMES = {
+    "musicbrainz_albumid": "MusicBrainz Album Id",
+    "musicbrainz_artistid": "MusicBrainz Artist Id",
+    "musicbrainz_albumartistid": "MusicBrainz Album Artist Id",
+    "musicbrainz_releasegroupid": "MusicBrainz Release Group Id",
+    "musicbrainz_releasetrackid": "MusicBrainz Release Track Id",
+    "musicbrainz_workid": "MusicBrainz Work Id",
+    "releasecountry": "MusicBrainz Album Release Country",
+    "releasestatus": "MusicBrainz Album Status",
+    "releasetype": "MusicBrainz Album Type"
+}
+
+COMMENT_KEYS = ("comment", "description")
+LYRICS_KEYS = ("lyrics", "unsyncedlyrics")
+MUSICBRAINZ_UFID_OWNER = "http://musicbrainz.org"
+
+# Merged into TRCK/TPOS as "n/total", or not tags of the MP3 (cover art is handled separately,
+# "encoder" names the FLAC encoder)
+SKIPPED_KEYS = {"tracknumber", "tracktotal", "totaltracks", "discnumber", "disctotal", "totaldiscs",
+                "metadata_block_picture", "coverart", "coverartmime", "encoder"}
+
+# Free space left in a new tag so later edits (e.g. ReplayGain) can be written in place
+DEFAULT_PADDING = 1024
+
+UTF8 = b"\x03"
+FRONT_COVER = 3 # APIC picture type
+
+def synchsafe(value):
+    """28 bit integer as 4 bytes of 7 bits each, as ID3v2 sizes are stored"""
+    return bytes(((value >> 21) & 0x7F, (value >> 14) & 0x7F, (value >> 7) & 0x7F, value & 0x7F))
+
+def unsynchsafe(data):
+    return (data[0] << 21) | (data[1] << 14) | (data[2] << 7) | data[3]
+
+def numbered(tags, number_key, total_keys):
+    """"n/total" from e.g. tracknumber and tracktotal, or just the number"""
+    number = (tags.get(number_key) or [""])[0]
+    if not number:
+        return ""
+    total = next((tags[key][0] for key in total_keys if tags.get(key)), "")
+    if total and "/" not in number:
+        return f"{number}/{total}"
+    return number
+
+def frames_from_tags(tags, artwork=None):
+    """
+    Frame list for Vorbis comments ({lowercase name: [values]}) and optionally the cover art
+    (an art_cache artwork dict).
+
+    Each frame is (frame id, description, values): the description is the TXXX name, the UFID
+    owner or the APIC mime type and empty for other frames. Multiple values of a text frame are
+    kept as a list; the APIC value is the image bytes.
+    """
+    frames = []
+    track = numbered(tags, "tracknumber", ("tracktotal", "totaltracks"))
+    if track:
+        frames.append(("TRCK", "", [track]))
+    disc = numbered(tags, "discnumber", ("disctotal", "totaldiscs"))
+    if disc:
+        frames.append(("TPOS", "", [disc]))
+
+    seen_text = set()
+    for key, values in tags.items():
+        values = [value for value in values if value]
+        if key in SKIPPED_KEYS or not values:
+            continue
+        if key in TEXT_FRAMES:
+            frame_id = TEXT_FRAMES[key]
+            if frame_id not in seen_text: # e.g. "date" and "year" both present: keep the first
+                seen_text.add(frame_id)
+                frames.append((frame_id, "", values))
+        elif key in COMMENT_KEYS:
+            frames.append(("COMM", "", ["\n".join(values)]))
+        elif key in LYRICS_KEYS:
+            frames.append(("USLT", "", ["\n".join(values)]))
+        elif key == "musicbrainz_trackid":
+            frames.append(("UFID", MUSICBRAINZ_UFID_OWNER, values[:1]))
+        else:
+            frames.append(("TXXX", TXXX_NAMES.get(key, key.upper()), values))
+    if artwork:
+        frames.append(("APIC", artwork["mime"], [artwork["data"]]))
+    return frames
+
+def encode_frame(frame):
+    """Bytes of one ID3v2.4 frame (header and body); all text is UTF-8"""
+    frame_id, description, values = frame
+    if frame_id == "UFID":
+        body = description.encode("latin-1") + b"\x00" + values[0].encode("utf-8")[:64]
+    elif frame_id in ("COMM", "USLT"):
+        body = UTF8 + b"eng" + b"\x00" + values[0].encode("utf-8")
+    elif frame_id == "APIC":
+        # Mime type, picture type, empty description, image data
+        body = UTF8 + description.encode("latin-1") + b"\x00" + bytes((FRONT_COVER,)) + b"\x00" + values[0]
+    elif frame_id == "TXXX":
+        body = UTF8 + description.encode("utf-8") + b"\x00" + "\x00".join(values).encode("utf-8")
+    else:
+        # ID3v2.4 separates multiple values of a text frame with NUL
+        body = UTF8 + "\x00".join(values).encode("utf-8")
+    return frame_id.encode("ascii") + synchsafe(len(body)) + b"\x00\x00" + body
+
+def tag_bytes(body, size):
+    """ID3v2.4 header and frames (body), zero padded to size bytes after the header"""
+    return b"ID3\x04\x00\x00" + synchsafe(size) + body + b"\x00" * (size - len(body))
+
+def build_tag(frames, min_size=0, padding=DEFAULT_PADDING):
+    """Complete ID3v2.4 tag, padded to at least min_size bytes and with at least padding free bytes"""
+    body = b"".join(encode_frame(frame) for frame in frames)
+    return tag_bytes(body, max(len(body) + padding, min_size - 10))
+
+def existing_tag_size(path):
+    """Total size in bytes of the ID3v2 tag at the start of the file, 0 if it has none"""
+    with open(path, "rb") as f:
+        header = f.read(10)
+    if len(header) < 10 or header[:3] != b"ID3":
+        return 0
+    size = 10 + unsynchsafe(header[6:10])
+    if header[5] & 0x10: # Footer present
+        size += 10
+    return size
+
+def write_tag(path, frames, padding=DEFAULT_PADDING):
+    """
+    Replace the ID3v2 tag of an MP3 with the given frames.
+
+    Returns True when the tag fitted in the existing one and was written in place, False when
+    the file had to be rewritten (through a temporary file, so it is never left half written).
+    A file with other hardlinks is always rewritten, so the other names keep their tags.
+    """
+    return write_tag_body(path, b"".join(encode_frame(frame) for frame in frames), padding)
+
+def write_tag_body(path, body, padding=DEFAULT_PADDING):
+    """write_tag for already encoded frames"""
+    path = Path(path)
+    old_size = existing_tag_size(path)
+    if old_size and len(body) + 10 <= old_size and os.stat(path).st_nlink == 1:
+        with open(path, "r+b") as f:
+            f.write(tag_bytes(body, old_size - 10))
+        return True
+
+    temp_path = path.with_name(f".{path.name}.retag")
+    with open(path, "rb") as source, open(temp_path, "wb") as target:
+        source.seek(old_size)
+        target.write(tag_bytes(body, len(body) + padding))
+        for chunk in iter(lambda: source.read(1024 * 1024), b""):
+            target.write(chunk)
+    os.replace(temp_path, path)
+    return False
+
+def read_tag_frames(path):
+    """
+    The frames of an MP3's ID3v2.4 tag as (frame id, encoded frame) pairs; empty when it has no tag.
+    Raises ValueError for tags whose frames cannot be copied as they are (other versions,
+    unsynchronisation, extended header).
+    """
+    size = existing_tag_size(path)
+    if not size:
+        return []
+    with open(path, "rb") as f:
+        header = f.read(10)
+        body = f.read(size - 10)
+    if header[3] != 4 or header[5] & 0xC0:
+        raise ValueError(f"ID3v2.{header[3]} tag with flags {header[5]:#x} cannot be updated")
+    frames = []
+    offset = 0
+    while offset + 10 <= len(body) and body[offset] != 0: # Zero bytes start the padding
+        frame_size = unsynchsafe(body[offset + 4:offset + 8])
+        frames.append((body[offset:offset + 4].decode("latin-1"), body[offset:offset + 10 + frame_size]))
+        offset += 10 + frame_size
+    return frames
+
+def txxx_description(frame):
+    """Description of an encoded TXXX frame"""
+    encoding, text = frame[10], frame[11:]
+    if encoding in (1, 2): # UTF-16 with or without BOM, terminated by two zero bytes
+        end = next((i for i in range(0, len(text) - 1, 2) if text[i:i + 2] == b"\x00\x00"), len(text))
+        return text[:end].decode("utf-16" if encoding == 1 else "utf-16-be", errors="replace")
+    return text.split(b"\x00", 1)[0].decode("utf-8" if encoding == 3 else "latin-1", errors="replace")
+
+def update_txxx(path, values, padding=DEFAULT_PADDING):
+    """
+    Set TXXX frames ({description: value}) in an MP3's tag, keeping all other frames; frames with the
+    same description in any case are replaced. Returns None when the tag already held these values,
+    otherwise what write_tag returns. Raises OSError, or ValueError for a tag read_tag_frames cannot read.
+    """
+    names = {description.lower() for description in values}
+    kept, current = [], {}
+    for frame_id, frame in read_tag_frames(path):
+        if frame_id == "TXXX" and txxx_description(frame).lower() in names:
+            current[txxx_description(frame).lower()] = frame
+        else:
+            kept.append(frame)
+    new = [encode_frame(("TXXX", description, [value])) for description, value in values.items()]
+    if [current.get(description.lower()) for description in values] == new:
+        return None
+    return write_tag_body(path, b"".join(kept + new), padding)
+
+def tag_matches(path, frames):
+    """True if the MP3's ID3v2 tag holds exactly these frames (in this order), ignoring padding"""
+    size = existing_tag_size(path)
+    if not size:
+        return False
+    with open(path, "rb") as f:
+        header = f.read(10)
+        body = f.read(size - 10)
+    if header[3] != 4 or header[5] & 0x10: # Not written by build_tag
+        return False
+    expected = b"".join(encode_frame(frame) for frame in frames)
+    return body.startswith(expected) and not body[len(expected):].strip(b"\x00")
+
+def lame_padding_size(frames, padding=DEFAULT_PADDING):
+    """Value for LAME's --pad-id3v2-size that leaves room to write these frames in place"""
+    return len(build_tag(frames, padding=padding))
@@ -0,0 +1,167 @@
+"""
+I/O scheduling: source reads limited per disk, destination writes in one piece.
+
+When several decoders read from one hard disk at once it seeks between their files and its
+throughput collapses. So each source is read ahead into memory, sequentially in large blocks, by at
+most "readers_per_device" workers per device (st_dev: a disk, an array or a mount) at a time, and
+decoded from memory with the device already free for the next file. Encoding, the slow part, stays
+fully parallel. The read-ahead buffers share a budget of "readahead_max_bytes", held by a buffer
+only until it has been written to its decoder, so it limits the reads waiting to be decoded, not the
+encodes running; a larger file is read by the decoder itself.
+
+With "stage_outputs" the MP3s are encoded into the local temporary folder and then copied to the
+destination in one sequential write each, by at most "writers_per_device" workers per destination
+device, so a NAS sees a few large writes instead of many small ones from every encoder at once.
+"auto" stages when the destination is on another device than the temporary folder.
+"""
+import os
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+READ_BLOCK = 8 * 1024 * 1024
+STAGING_FOLDER = "flac2mp3-staging"
+# A staged MP3 unchanged this long belongs to a run that crashed: encoders write continuously
+STALE_STAGED_SECONDS = 3600
+
+def device_of(path):
+    """Device id (st_dev) of the file system holding path, or None when it cannot be read"""
+    try:
+        return os.stat(path).st_dev
+    except OSError:
+        return None
+
+def read_file(path, size):
+    """The contents of a file, read sequentially in large blocks"""
+    data = bytearray(size)
+    view = memoryview(data)
+    filled = 0
+    with open(path, "rb", buffering=0) as f:
+        while filled < size:
+            count = f.readinto(view[filled:filled + READ_BLOCK])
+            if not count:
+                break
+            filled += count
+    view.release()
+    del data[filled:] # Shrunk since its size was read: the decoder gets the data there is
+    return data
+
+class SourceBuffer:
+    """A source read ahead (data, None until read) and its share of the scheduler's read-ahead budget"""
+    def __init__(self, scheduler, size):
+        self.scheduler = scheduler
+        self.size = size # Bytes of the budget held, None once released
+        self.data = None
+
+    def release(self):
+        """Give the budget back and drop the data, once the decoder has it; later calls do nothing"""
+        with self.scheduler.condition:
+            if self.size is None:
+                return
+            self.scheduler.buffered -= self.size
+            self.size = None
+            self.scheduler.condition.notify_all()
+        self.data = None
+
+class DeviceSlots:
+    """At most `limit` holders per device at a time (no limit when 0)"""
+    def __init__(self, limit):
+        self.limit = limit
+        self.semaphores = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def slot(self, core, device, wait_stage):
+        """Hold a slot of device for the block; the time waiting for it counts as wait_stage"""
+        semaphore = None
+        if self.limit and device is not None:
+            with self.lock:
+                semaphore = self.semaphores.setdefault(device, threading.Semaphore(self.limit))
+            with core.timed(wait_stage):
+                semaphore.acquire()
+        try:
+            yield
+        finally:
+            if semaphore is not None:
+                semaphore.release()
+
+class IOScheduler:
+    def __init__(self, settings):
+        self.readers = DeviceSlots(settings.get("readers_per_device", 1))
+        self.writers = DeviceSlots(settings.get("writers_per_device", 1))
+        self.read_ahead_enabled = settings.get("readers_per_device", 1) > 0
+        self.budget = settings.get("readahead_max_bytes", 512 * 1024 * 1024)
+        self.buffered = 0 # Bytes of read-ahead buffers in use
+        self.condition = threading.Condition()
+        self.stage_mode = settings.get("stage_outputs", "auto")
+        self.staging_folder = Path(tempfile.gettempdir()) / STAGING_FOLDER
+        self.staging_device = device_of(tempfile.gettempdir())
+        self.stage_decisions = {} # Destination folder -> whether its outputs are staged
+
+    @contextmanager
+    def read_ahead(self, core, flac_path):
+        """
+        A SourceBuffer with the source's contents, read while holding one of its device's reader slots;
+        None when the decoder should read the file itself (disabled, too large, cancelled). The decoder
+        releases it once fed; whatever it did not release is released at the end of the block.
+        """
+        try:
+            size = os.path.getsize(flac_path)
+        except OSError:
+            size = None
+        if not self.read_ahead_enabled or size is None or size > self.budget:
+            yield None
+            return
+        with core.timed("read_wait"):
+            with self.condition:
+                # A file may always use the whole budget alone, so the largest one cannot wait forever
+                while self.buffered and self.buffered + size > self.budget:
+                    if core.control.cancelled.is_set():
+                        break
+                    self.condition.wait(1)
+                self.buffered += size
+        buffer = SourceBuffer(self, size)
+        try:
+            if not core.control.cancelled.is_set():
+                with self.readers.slot(core, device_of(flac_path), "read_wait"), core.timed("read"):
+                    buffer.data = read_file(flac_path, size)
+            yield buffer if buffer.data is not None else None
+        finally:
+            buffer.release()
+
+    def stages(self, output_folder):
+        """Whether outputs into output_folder are encoded into the temporary folder first"""
+        if self.stage_mode in ("always", "never"):
+            return self.stage_mode == "always"
+        output_folder = str(output_folder)
+        if output_folder not in self.stage_decisions:
+            device = device_of(output_folder)
+            self.stage_decisions[output_folder] = device is not None and device != self.staging_device
+        return self.stage_decisions[output_folder]
+
+    def staging_path(self, partial_path):
+        """Where the encoder writes an output that is staged (named after its partial file, so unique)"""
+        self.staging_folder.mkdir(parents=True, exist_ok=True)
+        return self.staging_folder / Path(partial_path).name
+
+    def remove_stale(self, log):
+        """Remove staged MP3s left behind by crashed runs (on any host sharing the temporary folder)"""
+        try:
+            entries = list(os.scandir(self.staging_folder))
+        except OSError:
+            return
+        for entry in entries:
+            try:
+                if time.time() - entry.stat().st_mtime > STALE_STAGED_SECONDS:
+                    os.remove(entry.path)
+                    log(f"Removed a staged MP3 left by an interrupted run: {entry.name}")
+            except OSError:
+                pass
+
+    def copy_out(self, core, staged_path, partial_path):
+        """Copy a staged output to its partial file in the destination, one writer per device at a time"""
+        with self.writers.slot(core, device_of(Path(partial_path).parent), "write_wait"), core.timed("write"):
+            shutil.copyfile(staged_path, partial_path)
@@ -0,0 +1,251 @@
+"""
+Cancellation, pausing and progress watchdog for the FFmpeg/LAME child processes.
+
+BatchControl holds the cancel/pause state of a batch and every child process it is running, so
+a cancel can kill them all at once, and the jobs running them, whose progress it sums for the
+throughput sampler (throughput.py). WatchedJob starts the processes of one conversion, reads their
+progress output (FFmpeg's "time=" stats, LAME's frame counter) and aborts the job when the output
+stops advancing or when it runs longer than a limit scaled to the track's duration.
+"""
+import re
+import signal
+import subprocess
+import threading
+import time
+
+from governor import lower_priority, priority_kwargs
+
+# FFmpeg stats line: "size=  1024kB time=00:01:23.45 bitrate=..."
+FFMPEG_TIME = re.compile(rb"time=\s*(\d+):(\d+):(\d+(?:\.\d+)?)")
+# LAME frame counter: "  1234/5678   (22%)|..." (the total is unknown when reading from a pipe)
+LAME_FRAMES = re.compile(rb"^\s*(\d+)/\s*\d*\s*\(\s*[\d?]*%\)")
+# Samples per MPEG-1 Layer III frame
+SAMPLES_PER_FRAME = 1152
+
+# Keep at most this much of a process's non-progress output for error messages
+MAX_ERROR_OUTPUT = 64 * 1024
+
+class JobCancelled(Exception):
+    """The batch was cancelled while this job was running"""
+
+class JobStalled(Exception):
+    """A child process stopped reporting progress"""
+
+class JobTimedOut(Exception):
+    """The job ran longer than the limit for the track's duration"""
+
+class BatchControl:
+    def __init__(self):
+        self.cancelled = threading.Event()
+        self.unpaused = threading.Event() # Cleared while the batch is paused
+        self.unpaused.set()
+        self.processes = set()
+        self.jobs = set() # Running WatchedJobs
+        self.finished_audio_seconds = 0.0 # Audio processed by the jobs that ended
+        self.lock = threading.Lock()
+
+    def add_job(self, job):
+        with self.lock:
+            self.jobs.add(job)
+
+    def remove_job(self, job):
+        with self.lock:
+            if job in self.jobs:
+                self.jobs.discard(job)
+                self.finished_audio_seconds += job.position()
+
+    def audio_progress(self):
+        """(audio seconds processed by the jobs that ended, by the running ones so far)"""
+        with self.lock:
+            jobs = list(self.jobs)
+            finished = self.finished_audio_seconds
+        return finished, sum(job.position() for job in jobs)
+
+    def register(self, proc):
+        with self.lock:
+            self.processes.add(proc)
+        # A process started just as the batch was cancelled must not escape the kill
+        if self.cancelled.is_set():
+            self.kill(proc)
+
+    def unregister(self, proc):
+        with self.lock:
+            self.processes.discard(proc)
+
+    def kill(self, proc):
+        try:
+            if hasattr(signal, "SIGCONT"):
+                proc.send_signal(signal.SIGCONT) # A stopped process cannot handle its kill cleanly
+            proc.kill()
+        except OSError:
+            pass
+
+    def cancel(self):
+        """Stop the batch: kill every running child process; queued files are not started"""
+        self.cancelled.set()
+        self.unpaused.set() # Wake workers waiting on a pause so they can see the cancel
+        with self.lock:
+            processes = list(self.processes)
+        for proc in processes:
+            self.kill(proc)
+
+    def pause(self):
+        """Stop starting new files and suspend running child processes where the OS allows it"""
+        self.unpaused.clear()
+        self.signal_all(getattr(signal, "SIGSTOP", None))
+
+    def resume(self):
+        self.unpaused.set()
+        self.signal_all(getattr(signal, "SIGCONT", None))
+
+    def signal_all(self, signum):
+        if signum is None: # Windows: running processes keep going, only new files wait
+            return
+        with self.lock:
+            processes = list(self.processes)
+        for proc in processes:
+            try:
+                proc.send_signal(signum)
+            except OSError:
+                pass
+
+    def is_paused(self):
+        return not self.unpaused.is_set()
+
+    def wait_if_paused(self):
+        """Block while paused; returns False if the batch was cancelled"""
+        self.unpaused.wait()
+        return not self.cancelled.is_set()
+
+class ProgressReader:
+    """Reads a process's stderr on a daemon thread, tracking progress and keeping the other output"""
+    def __init__(self, stream, job, sample_rate):
+        self.stream = stream
+        self.job = job
+        self.sample_rate = sample_rate
+        self.output = bytearray()
+        self.position = 0.0 # Seconds of audio processed, from the latest progress line
+        self.thread = threading.Thread(target=self.read, daemon=True)
+        self.thread.start()
+
+    def read(self):
+        pending = b""
+        with self.stream:
+            for chunk in iter(lambda: self.stream.read1(65536), b""):
+                # Progress lines end with \r, other messages with \n
+                lines = (pending + chunk).replace(b"\r", b"\n").split(b"\n")
+                pending = lines.pop()
+                for line in lines:
+                    self.handle_line(line)
+        if pending:
+            self.handle_line(pending)
+
+    def handle_line(self, line):
+        position = self.parse_position(line)
+        if position is None:
+            if line.strip() and len(self.output) < MAX_ERROR_OUTPUT:
+                self.output += line + b"\n"
+            return
+        if position > self.position:
+            self.position = position
+            self.job.progressed()
+
+    def parse_position(self, line):
+        match = FFMPEG_TIME.search(line)
+        if match:
+            hours, minutes, seconds = match.groups()
+            return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+        match = LAME_FRAMES.match(line)
+        if match:
+            return int(match.group(1)) * SAMPLES_PER_FRAME / (self.sample_rate or 44100)
+        return None
+
+    def text(self):
+        self.thread.join(timeout=5)
+        return self.output.decode(errors="replace").strip()
+
+class WatchedJob:
+    """
+    The child processes of one conversion, supervised together.
+
+    wait() returns once every process has exited. It raises JobCancelled, JobStalled or JobTimedOut
+    (after killing the processes) when the batch is cancelled, when no process has advanced for
+    "stall_timeout" seconds, or when the job exceeds "timeout_base" + "timeout_per_audio_second"
+    times the track duration. Time spent paused does not count.
+    """
+    def __init__(self, control, settings, duration, sample_rate=0):
+        self.control = control
+        self.settings = settings
+        self.stall_timeout = settings.get("stall_timeout", 60)
+        self.time_limit = settings.get("timeout_base", 120) + settings.get("timeout_per_audio_second", 2.0) * (duration or 0)
+        self.sample_rate = sample_rate
+        self.processes = []
+        self.readers = {}
+        self.encoders = [] # Readers of the processes whose position is the job's (not the decoder feeding them)
+        self.last_progress = time.monotonic()
+        control.add_job(self)
+
+    def spawn(self, cmd, progress=True, **popen_kwargs):
+        """
+        Start a process with its stderr monitored for progress, at the governor's priority. The job's
+        position is the least of its processes' positions, except for those started with progress=False.
+        """
+        proc = subprocess.Popen(cmd, stderr=subprocess.PIPE, **priority_kwargs(self.settings), **popen_kwargs)
+        lower_priority(proc.pid, self.settings)
+        self.last_progress = time.monotonic() # Give each new process the full stall timeout
+        self.processes.append(proc)
+        self.control.register(proc)
+        self.readers[proc] = ProgressReader(proc.stderr, self, self.sample_rate)
+        if progress:
+            self.encoders.append(self.readers[proc])
+        return proc
+
+    def progressed(self):
+        self.last_progress = time.monotonic()
+
+    def position(self):
+        """Seconds of audio the job has processed so far"""
+        return min((reader.position for reader in self.encoders), default=0.0)
+
+    def stderr(self, proc):
+        """Non-progress stderr output of a finished process"""
+        return self.readers[proc].text()
+
+    def wait(self, poll_interval=0.5):
+        active_seconds = 0.0
+        last_check = time.monotonic()
+        while any(proc.poll() is None for proc in self.processes):
+            if self.control.cancelled.is_set():
+                self.kill()
+                raise JobCancelled()
+            now = time.monotonic()
+            if self.control.is_paused():
+                self.last_progress = now # Suspended processes cannot make progress
+            else:
+                active_seconds += now - last_check
+            last_check = now
+            if now - self.last_progress > self.stall_timeout:
+                self.kill()
+                raise JobStalled(f"no progress for {self.stall_timeout} seconds")
+            if active_seconds > self.time_limit:
+                self.kill()
+                raise JobTimedOut(f"exceeded {self.time_limit:.0f} seconds")
+            try:
+                self.processes[-1].wait(timeout=poll_interval)
+            except subprocess.TimeoutExpired:
+                pass
+        if self.control.cancelled.is_set():
+            raise JobCancelled()
+
+    def kill(self):
+        for proc in self.processes:
+            if proc.poll() is None:
+                self.control.kill(proc)
+                proc.wait()
+
+    def close(self):
+        """Kill anything still running and stop tracking the processes"""
+        self.kill()
+        for proc in self.processes:
+            self.control.unregister(proc)
+        self.control.remove_job(self)
@@ -0,0 +1,116 @@
+"""
+Append-only journal of the jobs of the current batch, stored as JSON lines next to the MP3s.
+
+The first line describes the batch (source folder and encoder settings); each following line is a
+job state change: "queued", "running" (with the temporary files being written), "done" or "failed".
+Paths are absolute, so a run started from another working directory still finds them.
+A batch that ends normally appends "batch_complete". When a run is interrupted (crash, reboot,
+cancel) the next run finds the journal without that line: it removes the temporary files of the
+jobs that were running and, for the same source and settings, does not convert the "done" files again.
+"""
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+JOURNAL_FILENAME = ".flac2mp3-journal.jsonl"
+
+class JobJournal:
+    def __init__(self, dest_folder):
+        self.path = Path(dest_folder) / JOURNAL_FILENAME
+        self.lock = threading.Lock()
+        self.file = None
+
+    def source_key(self, flac_path):
+        return str(Path(flac_path).absolute())
+
+    def load_interrupted(self):
+        """
+        (batch header, {source: latest job record}) of a batch that did not complete,
+        or None when there is no journal or its batch completed. A truncated last line is ignored.
+        """
+        if not self.path.exists():
+            return None
+        header = None
+        jobs = {}
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                    state = record["state"]
+                except (ValueError, KeyError):
+                    continue
+                if state == "batch":
+                    header, jobs = record, {}
+                elif state == "batch_complete":
+                    header = None
+                elif header is not None and "source" in record:
+                    jobs[record["source"]] = record
+        if header is None:
+            return None
+        return header, jobs
+
+    def begin(self, source_folder, encoder_settings, carried_over=()):
+        """Start a new journal for this batch, keeping the "done" records carried over from an interrupted one"""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.file = open(self.path, "w", encoding="utf-8")
+        self.append({"state": "batch", "source_folder": str(Path(source_folder).absolute()),
+                     "settings": encoder_settings})
+        for record in carried_over:
+            self.append(record)
+
+    def queued(self, flac_path):
+        self.append({"state": "queued", "source": self.source_key(flac_path)})
+
+    def running(self, flac_path, partial_paths):
+        self.append({"state": "running", "source": self.source_key(flac_path),
+                     "partials": [str(Path(path).absolute()) for path in partial_paths]})
+
+    def done(self, flac_path, output_path):
+        self.append({"state": "done", "source": self.source_key(flac_path),
+                     "output": str(Path(output_path).absolute()) if output_path else None})
+
+    def failed(self, flac_path):
+        self.append({"state": "failed", "source": self.source_key(flac_path)})
+
+    def append(self, record):
+        """Write one line (safe to call from worker threads); flushed, so it survives the app being killed"""
+        record["time"] = round(time.time(), 3)
+        with self.lock:
+            if self.file:
+                self.file.write(json.dumps(record) + "\n")
+                self.file.flush()
+
+    def finish(self):
+        """Mark the batch complete and close the journal"""
+        self.append({"state": "batch_complete"})
+        self.close()
+
+    def close(self):
+        with self.lock:
+            if self.file:
+                self.file.close()
+                self.file = None
+
+def is_same_batch(header, source_folder, encoder_settings):
+    """True if an interrupted batch converted the same source with the same settings"""
+    return (header.get("source_folder") == str(Path(source_folder).absolute())
+            and header.get("settings") == encoder_settings)
+
+def remove_stale_partials(jobs, log):
+    """Delete the temporary outputs of jobs that were running when the previous run stopped"""
+    for record in jobs.values():
+        if record["state"] != "running":
+            continue
+        partials = list(record.get("partials", []))
+        if record.get("partial"): # Journals written before output profiles
+            partials.append(record["partial"])
+        for partial in partials:
+            if not os.path.exists(partial):
+                continue
+            try:
+                os.remove(partial)
+                log(f"Removed incomplete output of an interrupted run: {partial}")
+            except OSError as e:
+                log(f"Error removing incomplete output {partial}: {e}")
@@ -0,0 +1,114 @@
+"""
+ReplayGain 2.0 from the decode the conversion already runs.
+
+With the "replaygain" setting FFmpeg's ebur128 filter is added to the decode of each conversion; it
+prints the EBU R128 integrated loudness and true peak when the stream ends. It only takes double
+samples, so an aformat filter after it converts them back to the source's sample format (exactly:
+doubles hold every 16 and 24 bit sample) and the encoders get the same samples as without it. The track gain is the difference to the ReplayGain 2.0 reference of -18 LUFS.
+The album loudness is the duration weighted power average of its tracks' loudness, so it needs no
+second decode either (it differs from gating the whole album at once only by the relative gate).
+Measurements are kept in the manifest records, whose source size and mtime they belong to, so an
+unchanged track is never measured again; neither is one that could not be measured (silent, or FFmpeg
+failed), which is recorded as UNMEASURED. Gains are written as TXXX frames into the tag's padding.
+"""
+import math
+import re
+import subprocess
+
+from jobcontrol import WatchedJob, JobCancelled, JobStalled, JobTimedOut
+
+REFERENCE_LUFS = -18.0
+# The per-100 ms measurements only go to the verbose log
+LOUDNESS_FILTER = "ebur128=peak=true:framelog=verbose"
+# Recorded for a track whose loudness could not be measured, so it is not measured on every run
+UNMEASURED = {"lufs": None}
+
+def loudness_filter(bits_per_sample):
+    """
+    LOUDNESS_FILTER for a decode feeding an encoder: followed by a conversion back to the sample format
+    FFmpeg decodes the FLAC to (s16 up to 16 bits, s32 above or when unknown)
+    """
+    sample_format = "s16" if 0 < bits_per_sample <= 16 else "s32"
+    return f"{LOUDNESS_FILTER},aformat=sample_fmts={sample_format}"
+
+def is_measured(loudness):
+    """True for a measurement, False for None or UNMEASURED"""
+    return bool(loudness) and loudness.get("lufs") is not None
+
+# From the summary ebur128 prints when the stream ends
+INTEGRATED = re.compile(r"^\s*I:\s+(-?\d+(?:\.\d+)?|-inf) LUFS", re.MULTILINE)
+TRUE_PEAK = re.compile(r"^\s*Peak:\s+(-?\d+(?:\.\d+)?|-inf) dBFS", re.MULTILINE)
+
+def parse_loudness(ffmpeg_stderr, seconds):
+    """
+    {"lufs": integrated loudness, "peak": linear true peak, "seconds": duration} from FFmpeg's
+    stderr, or None when it holds no ebur128 summary
+    """
+    integrated = INTEGRATED.findall(ffmpeg_stderr)
+    peak = TRUE_PEAK.findall(ffmpeg_stderr)
+    if not integrated or integrated[-1] == "-inf":
+        return None
+    peak_db = float(peak[-1]) if peak and peak[-1] != "-inf" else -math.inf
+    return {"lufs": float(integrated[-1]), "peak": round(10 ** (peak_db / 20), 6), "seconds": round(seconds, 3)}
+
+def album_loudness(tracks):
+    """Loudness of an album from its tracks' measurements: power average weighted by duration, highest peak"""
+    total_seconds = sum(track["seconds"] for track in tracks)
+    if total_seconds <= 0:
+        total_seconds = len(tracks)
+        weights = [1.0] * len(tracks)
+    else:
+        weights = [track["seconds"] for track in tracks]
+    power = sum(weight * 10 ** (track["lufs"] / 10) for weight, track in zip(weights, tracks)) / total_seconds
+    return {"lufs": round(10 * math.log10(power), 2), "peak": max(track["peak"] for track in tracks),
+            "seconds": round(sum(track["seconds"] for track in tracks), 3)}
+
+def replaygain_values(track=None, album=None):
+    """TXXX descriptions and values of the ReplayGain tags for track and/or album measurements"""
+    values = {}
+    for scope, loudness in (("TRACK", track), ("ALBUM", album)):
+        if is_measured(loudness):
+            values[f"REPLAYGAIN_{scope}_GAIN"] = f"{REFERENCE_LUFS - loudness['lufs']:+.2f} dB"
+            values[f"REPLAYGAIN_{scope}_PEAK"] = f"{loudness['peak']:.6f}"
+    return values
+
+def replaygain_frames(track=None, album=None):
+    """replaygain_values as ID3 frames"""
+    return [("TXXX", description, [value]) for description, value in replaygain_values(track, album).items()]
+
+def analyse_loudness(core, flac_path, metadata):
+    """
+    Measure a file on its own, for sources converted before ReplayGain was enabled. Returns the
+    measurement, UNMEASURED when FFmpeg ran but measured nothing, or None when it was stopped or could
+    not start (the reason is logged; on a cancel nothing is).
+    """
+    ffmpeg_cmd = [
+        core.settings["ffmpeg_path"], "-hide_banner", "-nostdin",
+        "-i", str(flac_path),
+        "-af", LOUDNESS_FILTER,
+        "-f", "null", "-"
+    ]
+    job = WatchedJob(core.control, core.settings, metadata.get("duration", 0), metadata.get("sample_rate", 0))
+    try:
+        ffmpeg_proc = job.spawn(ffmpeg_cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+        with core.timed("loudness"):
+            job.wait()
+        stderr = job.stderr(ffmpeg_proc)
+        if ffmpeg_proc.returncode != 0:
+            core.log(f"Loudness analysis failed for {flac_path.name}: {stderr}")
+            return dict(UNMEASURED)
+        loudness = parse_loudness(stderr, metadata.get("duration", 0))
+        if loudness is None:
+            core.log(f"No loudness measured for {flac_path.name} (silent or too short)")
+            return dict(UNMEASURED)
+        return loudness
+    except FileNotFoundError as e:
+        core.log(f"Executable not found: {e}. Please check the FFmpeg path in settings.")
+        return None
+    except JobCancelled:
+        return None
+    except (JobStalled, JobTimedOut) as e:
+        core.log(f"Loudness analysis aborted for {flac_path.name}: {e}.")
+        return None
+    finally:
+        job.close()
@@ -2,11 +2,16 @@ import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
 import os
 import json
-import subprocess
+import queue
 import threading
 from pathlib import Path
-import re
-import tempfile
+
+from converter_core import ConverterCore, DEFAULT_SETTINGS
+
+# How often queued log lines and progress events are applied to the widgets
+UI_REFRESH_MS = 100
+# Upper bound of queued items applied per refresh, so a flood of events cannot freeze the window
+UI_MAX_EVENTS_PER_REFRESH = 5000
 
 class FlacToMp3Converter:
     def __init__(self, root):
@@ -17,21 +22,28 @@ class FlacToMp3Converter:
         # Configuration file path
         self.config_file = "config.json"
         
-        # Default settings
+        # Log lines and progress events from any thread are queued here and applied to the widgets
+        # in batches by drain_ui_events on the Tk thread; Tk must not be touched from worker threads
+        self.ui_events = queue.Queue()
+        self.log_file = None
+        
+        # Default settings: the GUI's folder choices plus the conversion settings of the core
         self.settings = {
             "source_folder": "",
             "destination_folder": "", # This will hold the actual path if 'browse' was chosen
             "destination_option": "create_mp3_folder", # New setting: "create_mp3_folder" or "browse"
-            "filename_template": "{artist} - {title}",
-            # Set default paths based on OS, leave empty to force user selection initially
-            "lame_path": "" if os.name == "nt" else "/usr/bin/lame", 
-            "ffmpeg_path": "" if os.name == "nt" else "/usr/bin/ffmpeg",
-            "ffprobe_path": "" if os.name == "nt" else "/usr/bin/ffprobe",
-            "quality": "320"
+            **DEFAULT_SETTINGS,
+            "log_max_lines": 2000, # Lines kept in the log widget, the full log is in log_file
+            "log_file": "conversion.log"
         }
         
         self.load_settings()
+        # The core shares the settings dict, so values saved by start_conversion apply to the next batch
+        self.core = ConverterCore(self.settings, log=self.log,
+                                  on_event=lambda event, data: self.ui_events.put(("event", event, data)),
+                                  on_error=lambda title, message: self.ui_events.put(("error", title, message)))
         self.create_widgets()
+        self.root.after(UI_REFRESH_MS, self.drain_ui_events)
         
     def load_settings(self):
         """Load settings from config file"""
@@ -172,13 +184,24 @@ class FlacToMp3Converter:
         browse_button_ffprobe.grid(row=0, column=3, padx=5)
         
         # --- Quality selection ---
-        ttk.Label(main_frame, text="MP3 Quality (kbps):").grid(row=8, column=0, sticky=tk.W, pady=5)
+        ttk.Label(main_frame, text="MP3 Quality (kbps or VBR):").grid(row=8, column=0, sticky=tk.W, pady=5)
         self.quality_var = tk.StringVar(value=self.settings["quality"])
         quality_combo = ttk.Combobox(main_frame, textvariable=self.quality_var, 
-                                     values=["128", "160", "192", "256", "320"], 
+                                     values=["128", "160", "192", "256", "320", "V2", "V0"], 
                                      state="readonly", width=10)
         quality_combo.grid(row=8, column=1, sticky=tk.W, padx=5, pady=5)
         
+        # --- Parallel workers ---
+        workers_frame = ttk.Frame(main_frame)
+        workers_frame.grid(row=8, column=1, sticky=tk.E, padx=5, pady=5)
+        ttk.Label(workers_frame, text="Parallel Workers (0 = CPU count):").pack(side=tk.LEFT)
+        self.workers_var = tk.StringVar(value=str(self.settings["workers"]))
+        ttk.Spinbox(workers_frame, from_=0, to=64, textvariable=self.workers_var, width=5).pack(side=tk.LEFT, padx=5)
+        ttk.Label(workers_frame, text="Encoder:").pack(side=tk.LEFT)
+        self.engine_var = tk.StringVar(value=self.settings["encoder_engine"])
+        ttk.Combobox(workers_frame, textvariable=self.engine_var, values=["auto", "ffmpeg", "lame"],
+                     state="readonly", width=7).pack(side=tk.LEFT, padx=5)
+        
         # --- Progress frame ---
         progress_frame = ttk.LabelFrame(main_frame, text="Conversion Progress", padding="5")
         progress_frame.grid(row=9, column=0, columnspan=3, sticky=(tk.W, tk.E), pady=10)
@@ -189,6 +212,8 @@ class FlacToMp3Converter:
         self.progress_bar.grid(row=0, column=0, sticky=(tk.W, tk.E), pady=5)
         
         self.status_var = tk.StringVar(value="Ready")
+        self.files_status = "" # Status line parts: file counts, from "file_done" events...
+        self.speed_status = "" # ...and speed, from "throughput" events
         self.status_label = ttk.Label(progress_frame, textvariable=self.status_var)
         self.status_label.grid(row=1, column=0, pady=5)
         
@@ -196,9 +221,31 @@ class FlacToMp3Converter:
         button_frame = ttk.Frame(main_frame)
         button_frame.grid(row=10, column=0, columnspan=3, pady=10)
         
+        self.stream_decode_var = tk.BooleanVar(value=self.settings["stream_decode"])
+        ttk.Checkbutton(button_frame, text="Stream FFmpeg into LAME (no temporary WAV)",
+                        variable=self.stream_decode_var).pack(side=tk.LEFT, padx=5)
+        
+        self.recursive_var = tk.BooleanVar(value=self.settings["recursive"])
+        ttk.Checkbutton(button_frame, text="Include subfolders",
+                        variable=self.recursive_var).pack(side=tk.LEFT, padx=5)
+        
+        self.incremental_var = tk.BooleanVar(value=self.settings["incremental"])
+        ttk.Checkbutton(button_frame, text="Skip unchanged files",
+                        variable=self.incremental_var).pack(side=tk.LEFT, padx=5)
+        
+        self.replaygain_var = tk.BooleanVar(value=self.settings["replaygain"])
+        ttk.Checkbutton(button_frame, text="ReplayGain tags",
+                        variable=self.replaygain_var).pack(side=tk.LEFT, padx=5)
+        
         self.convert_button = ttk.Button(button_frame, text="Convert Files", command=self.start_conversion)
         self.convert_button.pack(side=tk.LEFT, padx=5)
         
+        # Enabled only while a batch runs (from its "start" event, once the core can accept them)
+        self.pause_button = ttk.Button(button_frame, text="Pause", command=self.toggle_pause, state='disabled')
+        self.pause_button.pack(side=tk.LEFT, padx=5)
+        self.cancel_button = ttk.Button(button_frame, text="Cancel", command=self.cancel_conversion, state='disabled')
+        self.cancel_button.pack(side=tk.LEFT, padx=5)
+        
         # --- Log frame ---
         log_frame = ttk.LabelFrame(main_frame, text="Log", padding="5")
         log_frame.grid(row=11, column=0, columnspan=3, sticky=(tk.W, tk.E, tk.N, tk.S), pady=10)
@@ -304,31 +351,38 @@ class FlacToMp3Converter:
         status_label.config(text="❓") 
         exec_path = path_var.get()
         
-        if not exec_path: # Path is empty
-            status_label.config(text="❌")
-            self.log(f"Error: {name} path is empty.")
-            return False
-
-        if not os.path.exists(exec_path):
-            status_label.config(text="❌")
-            self.log(f"Error: {name} not found at: {exec_path}")
-            return False
+        ok, error = self.core.test_executable(exec_path, name, test_arg)
+        if ok:
+            status_label.config(text="✅")
+            return True
         
-        try:
-            result = subprocess.run([exec_path, test_arg], capture_output=True, text=True, timeout=10)
-            if result.returncode == 0:
-                status_label.config(text="✅")
-                return True
-            else:
-                messagebox.showerror("Error", f"{name} test failed. Error: {result.stderr}")
-                status_label.config(text="❌")
-                self.log(f"Error: {name} test failed. Output: {result.stderr}")
-                return False
-        except Exception as e:
-            messagebox.showerror("Error", f"Error testing {name}: {str(e)}")
-            status_label.config(text="❌") 
-            self.log(f"Error testing {name}: {str(e)}")
-            return False
+        status_label.config(text="❌")
+        self.log(error)
+        # A missing path is shown by the status icon; a tool that exists but fails deserves a dialog
+        if exec_path and os.path.exists(exec_path):
+            messagebox.showerror("Error", error)
+        return False
+
+    def probe_tools_in_background(self):
+        """Check all executables on a background thread, so the window appears at once (cached after the first run)"""
+        for status_label in (self.lame_status_label, self.ffmpeg_status_label, self.ffprobe_status_label):
+            status_label.config(text="❓")
+        thread = threading.Thread(target=lambda: self.ui_events.put(("tools", self.core.probe_tools())))
+        thread.daemon = True
+        thread.start()
+    
+    def show_tool_status(self, results):
+        """Show the results of probe_tools_in_background (Tk thread only)"""
+        status_labels = {"lame_path": self.lame_status_label, "ffmpeg_path": self.ffmpeg_status_label,
+                         "ffprobe_path": self.ffprobe_status_label}
+        for path_key, (ok, error) in results.items():
+            status_labels[path_key].config(text="✅" if ok else "❌")
+            if not ok:
+                self.log(error)
+        # Keep the probe results in config.json, so the next start does not run the tools again
+        if self.core.toolchain.changed:
+            self.core.toolchain.changed = False
+            self.save_settings()
 
     def test_lame(self):
         """Test if LAME encoder is working"""
@@ -343,163 +397,53 @@ class FlacToMp3Converter:
         return self.test_executable(self.ffprobe_path_var, self.ffprobe_status_label, "FFprobe", "-version")
         
     def log(self, message):
-        """Add message to log"""
-        self.log_text.insert(tk.END, f"{message}\n")
-        self.log_text.see(tk.END)
-        self.root.update_idletasks()
-
-    def get_flac_metadata(self, flac_path):
-        """
-        Extract metadata from FLAC file using ffprobe.
-
-        If metadata extraction fails, falls back to using the filename as the title and default values for other fields.
-        """
-        ffprobe_path = self.ffprobe_path_var.get()
-        try:
-            cmd = [ffprobe_path, "-v", "quiet", "-print_format", "json", "-show_format", str(flac_path)]
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=30)
-
-            if result.returncode == 0:
-                import json
-                data = json.loads(result.stdout)
-                tags = data.get("format", {}).get("tags", {})
-                
-                # Normalize tag names (case insensitive)
-                normalized_tags = {}
-                for key, value in tags.items():
-                    normalized_tags[key.lower()] = value
-                
-                return {
-                    "artist": normalized_tags.get("artist", "Unknown Artist"),
-                    "title": normalized_tags.get("title", "Unknown Title"),
-                    "album": normalized_tags.get("album", "Unknown Album"),
-                    "track": normalized_tags.get("track", ""),
-                    "year": normalized_tags.get("date", normalized_tags.get("year", ""))
-                }
-            else:
-                self.log(f"ffprobe failed for {flac_path.name}: {result.stderr.strip()}")
-        except Exception as e:
-            self.log(f"Error reading metadata from {flac_path.name}: {str(e)}")
-        
-        # Fallback to filename
-        filename = Path(flac_path).stem
-        return {
-            "artist": "Unknown Artist",
-            "title": filename,
-            "album": "Unknown Album",
-            "track": "",
-            "year": ""
-        }
-    
-    def sanitize_filename(self, filename):
-        """Remove invalid characters from filename"""
-        # Remove or replace invalid characters and remove leading/trailing spaces
-        return re.sub(r'[<>:"/\\|?*]', '_', filename).strip(' .')
+        """Add message to log (safe to call from any thread)"""
+        self.ui_events.put(("log", message))
     
-    def format_filename(self, template, metadata):
-        """Format filename using template and metadata"""
-        # Create a mutable copy of metadata to format track number
-        formatted_metadata = metadata.copy()
-        if 'track' in formatted_metadata and formatted_metadata['track']:
-            try:
-                # Attempt to convert to int and format as 2 digits, e.g., '1' -> '01'
-                track_num = int(formatted_metadata['track'].split('/')[0]) # Handle 'X/Y' format
-                formatted_metadata['track'] = f"{track_num:02d}"
-            except ValueError:
-                # If conversion fails (e.g., track is non-numeric), keep original or handle
-                pass # Keep original value if it's not a number we can format
-
+    def drain_ui_events(self):
+        """Apply queued log lines and events to the widgets, then reschedule itself (Tk thread only)"""
+        lines = []
         try:
-            formatted = template.format(**formatted_metadata)
-            return self.sanitize_filename(formatted)
-        except KeyError as e:
-            self.log(f"Invalid template variable: {e}. Falling back to default filename format.")
-            return self.sanitize_filename(f"{formatted_metadata.get('artist', 'Unknown Artist')} - {formatted_metadata.get('title', 'Unknown Title')}")
-
-    def convert_file(self, flac_path, output_path):
-        """Convert single FLAC file to MP3 via an intermediate WAV file."""
-        ffmpeg_path = self.ffmpeg_path_var.get()
-        lame_path = self.lame_path_var.get()
-        quality = self.quality_var.get()
-        
-        temp_wav_path = None # Initialize to None to ensure proper cleanup in finally block
-
+            for _ in range(UI_MAX_EVENTS_PER_REFRESH):
+                item = self.ui_events.get_nowait()
+                if item[0] == "log":
+                    lines.append(item[1])
+                elif item[0] == "event":
+                    self.handle_event(item[1], item[2])
+                elif item[0] == "error":
+                    messagebox.showerror(item[1], item[2])
+                elif item[0] == "tools":
+                    self.show_tool_status(item[1])
+                elif item[0] == "done":
+                    # Re-enable convert button
+                    self.convert_button.config(state='normal')
+                    self.pause_button.config(state='disabled', text="Pause")
+                    self.cancel_button.config(state='disabled')
+        except queue.Empty:
+            pass
+        
+        if lines:
+            self.write_log_lines(lines)
+        self.root.after(UI_REFRESH_MS, self.drain_ui_events)
+    
+    def write_log_lines(self, lines):
+        """Append lines to the log file and, in one insert, to the log widget, keeping only the latest lines"""
+        text = "\n".join(lines) + "\n"
         try:
-            # 1. Create a temporary WAV file path
-            with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as temp_wav_file:
-                temp_wav_path = Path(temp_wav_file.name)
-            
-
-            # 2. Convert FLAC to WAV using FFmpeg
-            ffmpeg_cmd = [
-                ffmpeg_path, "-y", # Overwrite without asking
-                "-i", str(flac_path),
-                "-f", "wav", # Output format
-                "-acodec", "pcm_s16le", # Force PCM 16-bit signed little-endian
-                str(temp_wav_path) # Output to temporary WAV file
-            ]
-            
-            ffmpeg_result = subprocess.run(
-                ffmpeg_cmd,
-                capture_output=True,
-                text=True,
-                timeout=120 # Increased timeout for potentially large files
-            )
-
-            if ffmpeg_result.returncode != 0:
-                self.log(f"FFmpeg conversion failed for {flac_path.name}.")
-                self.log(f"FFmpeg stderr: {ffmpeg_result.stderr.strip()}")
-                if ffmpeg_result.stdout.strip(): # Log stdout if it exists
-                    self.log(f"FFmpeg stdout: {ffmpeg_result.stdout.strip()}")
-                return False
-
-            self.log("FFmpeg conversion to WAV successful.")
-
-            # 3. Convert WAV to MP3 using LAME
-            lame_cmd = [
-                lame_path,
-                "-b", quality, # Bitrate
-                str(temp_wav_path), # Input from temporary WAV file
-                str(output_path) # Output to final MP3 file
-            ]
-
-            lame_result = subprocess.run(
-                lame_cmd,
-                capture_output=True,
-                text=True,
-                timeout=120 # Increased timeout
-            )
-
-            if lame_result.returncode != 0:
-                self.log(f"LAME conversion failed for {temp_wav_path.name}.")
-                self.log(f"LAME stderr: {lame_result.stderr.strip()}")
-                if lame_result.stdout.strip(): # Log stdout if it exists
-                    self.log(f"LAME stdout: {lame_result.stdout.strip()}")
-                return False
-
-            self.log("LAME conversion to MP3 successful.")
-            return True
+            if self.log_file is None:
+                self.log_file = open(self.settings["log_file"], "a", encoding="utf-8")
+            self.log_file.write(text)
+            self.log_file.flush()
+        except OSError as e:
+            print(f"Error writing log file: {e}")
+        
+        self.log_text.insert(tk.END, text)
+        # Trim from the top so the widget does not slow down as the log grows
+        excess = int(self.log_text.index("end-1c").split(".")[0]) - 1 - self.settings["log_max_lines"]
+        if excess > 0:
+            self.log_text.delete("1.0", f"{excess + 1}.0")
+        self.log_text.see(tk.END)
 
-        except FileNotFoundError as e:
-            self.log(f"Executable not found: {e}. Please check LAME/FFmpeg paths in settings.")
-            messagebox.showerror("Error", f"Executable not found: {e}. Please check LAME/FFmpeg paths in settings.")
-            return False
-        except subprocess.TimeoutExpired:
-            self.log(f"Conversion timed out for {flac_path.name}.")
-            messagebox.showerror("Timeout", f"Conversion timed out for {flac_path.name}.")
-            return False
-        except Exception as e:
-            self.log(f"An unexpected error occurred during conversion of {flac_path.name}: {str(e)}")
-            messagebox.showerror("Error", f"An unexpected error occurred: {str(e)}")
-            return False
-        finally:
-            # 4. Clean up temporary WAV file
-            if temp_wav_path and temp_wav_path.exists():
-                try:
-                    os.remove(temp_wav_path)
-                except OSError as e:
-                    self.log(f"Error cleaning up temporary WAV {temp_wav_path.name}: {e}")
-    
     def start_conversion(self):
         """Start the conversion process in a separate thread"""
         # Update settings for source and general template/quality
@@ -509,6 +453,15 @@ class FlacToMp3Converter:
         self.settings["ffmpeg_path"] = self.ffmpeg_path_var.get()
         self.settings["ffprobe_path"] = self.ffprobe_path_var.get()
         self.settings["quality"] = self.quality_var.get()
+        self.settings["stream_decode"] = self.stream_decode_var.get()
+        self.settings["encoder_engine"] = self.engine_var.get()
+        self.settings["incremental"] = self.incremental_var.get()
+        self.settings["recursive"] = self.recursive_var.get()
+        self.settings["replaygain"] = self.replaygain_var.get()
+        try:
+            self.settings["workers"] = max(0, int(self.workers_var.get()))
+        except ValueError:
+            self.settings["workers"] = 0
         
         # Determine actual destination folder based on user choice
         selected_dest_option = self.destination_choice_var.get()
@@ -543,8 +496,10 @@ class FlacToMp3Converter:
             # Button is already re-enabled
             return
         
-        # Explicitly re-test executables before conversion to ensure current paths are valid
-        if not (self.test_lame() and self.test_ffmpeg() and self.test_ffprobe()):
+        # Explicitly re-test executables before conversion to ensure current paths are valid.
+        # LAME is only needed when the selected encoder engine runs it.
+        tests = {"lame_path": self.test_lame, "ffmpeg_path": self.test_ffmpeg, "ffprobe_path": self.test_ffprobe}
+        if not all([tests[path_key]() for path_key, _, _ in self.core.required_tools()]):
             messagebox.showerror("Error", "One or more required executables (LAME, FFmpeg, FFprobe) are not properly configured or found. Please check their paths and ensure they are valid.")
             # Button is already re-enabled
             return
@@ -565,70 +520,86 @@ class FlacToMp3Converter:
         thread.daemon = True # Allow the thread to exit with the main program
         thread.start()
     
-    def convert_files(self, actual_destination_folder): # Accept destination_folder as argument
-        """Convert all FLAC files in the source folder"""
-        source_folder = Path(self.settings["source_folder"])
-        dest_folder = actual_destination_folder # Use the passed argument for the current conversion batch
-        template = self.settings["filename_template"]
-        
-        # Find all FLAC files using a case-insensitive check for the .flac extension
-        flac_files = []
-        for p in source_folder.iterdir(): # Iterate through all items in the directory
-            if p.is_file() and p.suffix.lower() == ".flac": # Check if it's a file and its lowercase suffix is .flac
-                flac_files.append(p)
-        
-        if not flac_files:
-            self.log("No FLAC files found in source folder")
-            self.status_var.set("No FLAC files found")
-            self.convert_button.config(state='normal')
-            return
-        
-        total_files = len(flac_files)
-        self.log(f"Found {total_files} FLAC files to convert")
-        
-        converted = 0
-        failed = 0
-        
-        # Sort files for consistent processing order (optional but good practice)
-        flac_files.sort()
-
-        for i, flac_path in enumerate(flac_files):
-            progress = (i / total_files) * 100
-            self.progress_var.set(progress)
-            self.status_var.set(f"Converting {flac_path.name}...")
-            
-            # Get metadata
-            metadata = self.get_flac_metadata(flac_path)
-            
-            # Format output filename
-            output_filename = self.format_filename(template, metadata) + ".mp3"
-            output_path = dest_folder / output_filename
-            
-            self.log(f"Converting: {flac_path.name} -> {output_filename}")
-            
-            # Convert file
-            if self.convert_file(flac_path, output_path):
-                converted += 1
-                self.log(f"✓ Converted: {output_filename}")
+    def toggle_pause(self):
+        """Pause or resume the running batch"""
+        if self.core.control.is_paused():
+            self.core.resume()
+            self.pause_button.config(text="Pause")
+            self.status_var.set("Resumed")
+        else:
+            self.core.pause()
+            self.pause_button.config(text="Resume")
+            self.status_var.set("Paused")
+    
+    def cancel_conversion(self):
+        """Cancel the running batch; running conversions are killed and their partial files removed"""
+        self.core.cancel()
+        self.pause_button.config(state='disabled', text="Pause")
+        self.cancel_button.config(state='disabled')
+        self.status_var.set("Cancelling...")
+    
+    def handle_event(self, event, data):
+        """Reflect conversion progress events from the core in the progress bar and status line (Tk thread only)"""
+        if event == "start":
+            self.status_var.set("Scanning and converting...")
+            self.files_status = "Scanning and converting..."
+            self.speed_status = ""
+            self.pause_button.config(state='normal', text="Pause")
+            self.cancel_button.config(state='normal')
+        elif event == "file_done":
+            # While the scan is still running the total only counts the files found so far
+            total = f"{data['total']}" if data["scan_complete"] else f"{data['total']}+"
+            # Progress is weighted by audio length, so a long track moves the bar more than a short one
+            self.progress_var.set(data["progress"] * 100)
+            self.files_status = f"Converted {data['completed']} of {total} files ({data['failed']} failed)"
+            self.show_progress_status(data["eta_seconds"])
+        elif event == "throughput":
+            # Sent every second from the encoders' progress, so the bar also moves during long tracks
+            self.progress_var.set(data["progress"] * 100)
+            self.speed_status = f"{data['realtime_factor']:.1f}x realtime" if data["realtime_factor"] else ""
+            self.show_progress_status(data["eta_seconds"])
+        elif event == "complete":
+            if data["was_cancelled"]:
+                self.status_var.set(f"Cancelled: {data['converted']} converted, {data['skipped']} unchanged, "
+                                    f"{data['failed']} failed, {data['cancelled']} not converted")
+            elif data["total"] == 0:
+                self.status_var.set("No FLAC files found")
             else:
-                failed += 1
-                self.log(f"✗ Failed: {flac_path.name}")
-        
-        # Final progress update
-        self.progress_var.set(100)
-        self.status_var.set(f"Complete: {converted} converted, {failed} failed")
-        self.log(f"\nConversion complete: {converted} files converted, {failed} failed\n")
-        
-        # Re-enable convert button
-        self.convert_button.config(state='normal')
+                # Final progress update
+                self.progress_var.set(100)
+                status = f"Complete: {data['converted']} converted, {data['skipped']} unchanged, {data['failed']} failed"
+                if data["reused"]:
+                    status += f", {data['reused']} duplicates reused"
+                if data["orphans"]:
+                    status += f", {len(data['orphans'])} orphaned outputs (see log)"
+                self.status_var.set(status)
+    
+    def show_progress_status(self, eta_seconds):
+        """Status line from the latest file counts, speed and ETA (Tk thread only)"""
+        status = self.files_status
+        if self.core.control.is_paused():
+            status += " (paused)"
+        else:
+            if self.speed_status:
+                status += f", {self.speed_status}"
+            if eta_seconds is not None:
+                minutes, seconds = divmod(int(eta_seconds), 60)
+                status += f", about {minutes}:{seconds:02d} remaining"
+        self.status_var.set(status)
+    
+    def convert_files(self, actual_destination_folder): # Accept destination_folder as argument
+        """Convert all FLAC files in the source folder (runs on the conversion thread)"""
+        try:
+            self.core.convert_files(self.settings["source_folder"], actual_destination_folder)
+        finally:
+            # Re-enable the convert button from the Tk thread
+            self.ui_events.put(("done",))
 
 def main():
     root = tk.Tk()
     app = FlacToMp3Converter(root)
-    # Perform initial tests for all executables on startup
-    app.test_lame()
-    app.test_ffmpeg()
-    app.test_ffprobe()
+    # Test all executables on startup, without holding up the window
+    app.probe_tools_in_background()
     root.mainloop()
 
 if __name__ == "__main__":
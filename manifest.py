@@ -0,0 +1,149 @@
+"""
+Persistent manifest of converted files, stored as JSON lines next to the MP3s.
+
+Each line records one conversion: the source path, its size and modification time
+(optionally a content hash), the encoder settings that produced the output and the output path.
+Later lines override earlier ones for the same source, so recording is a cheap append;
+compact() rewrites the file with only the latest record per source. Records also keep the audio MD5
+from the FLAC's STREAMINFO, so outputs can be found by their audio (see dedup.py), and the
+loudness measured for ReplayGain (see loudness.py).
+"""
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+
+MANIFEST_FILENAME = ".flac2mp3-manifest.jsonl"
+
+class ConversionManifest:
+    def __init__(self, dest_folder, use_hash=False):
+        self.path = Path(dest_folder) / MANIFEST_FILENAME
+        self.use_hash = use_hash
+        self.records = {} # source path -> latest record
+        self.by_audio = {} # audio MD5 -> sources recorded with it (may include outdated entries)
+        self.lock = threading.Lock()
+        self.file = None
+        self.load()
+
+    def load(self):
+        """Read existing records; a truncated last line (e.g. after a crash) is ignored"""
+        if not self.path.exists():
+            return
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                    self.add(record)
+                except (ValueError, KeyError):
+                    continue
+
+    def open(self):
+        """Open the manifest for appending new records"""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.file = open(self.path, "a", encoding="utf-8")
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def source_key(self, flac_path):
+        return str(Path(flac_path).absolute())
+
+    def output_key(self, output_path):
+        """Outputs are recorded by absolute path too, so the records hold whatever folder a run starts from"""
+        return str(Path(output_path).absolute())
+
+    def fingerprint(self, flac_path):
+        """Size, modification time and, when enabled, SHA-1 of the source file"""
+        stat = os.stat(flac_path)
+        fingerprint = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+        if self.use_hash:
+            fingerprint["sha1"] = self.hash_file(flac_path)
+        return fingerprint
+
+    def hash_file(self, flac_path):
+        digest = hashlib.sha1()
+        with open(flac_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def lookup(self, flac_path):
+        with self.lock:
+            return self.records.get(self.source_key(flac_path))
+
+    def is_up_to_date(self, flac_path, encoder_settings):
+        """
+        True when the source was already converted with the same encoder settings,
+        has not changed since and its output still exists.
+
+        A source whose size or mtime changed is still up to date when hashing is enabled
+        and its content hash matches the recorded one (e.g. a touched or copied file).
+        """
+        record = self.lookup(flac_path)
+        if not record or record.get("settings") != encoder_settings:
+            return False
+        if not Path(record["output"]).exists():
+            return False
+        stat = os.stat(flac_path)
+        if stat.st_size == record.get("size") and stat.st_mtime_ns == record.get("mtime_ns"):
+            return True
+        if self.use_hash and record.get("sha1") and stat.st_size == record.get("size"):
+            if self.hash_file(flac_path) == record["sha1"]:
+                # Remember the new mtime so the next run does not hash the file again
+                self.append({**record, "mtime_ns": stat.st_mtime_ns})
+                return True
+        return False
+
+    def find_audio(self, audio_md5, encoder_settings):
+        """Records whose output was encoded from this audio with the same settings and still exists"""
+        with self.lock:
+            candidates = [self.records[source] for source in sorted(self.by_audio.get(audio_md5, ()))]
+        return [record for record in candidates
+                if record.get("audio_md5") == audio_md5 and record.get("settings") == encoder_settings
+                and os.path.exists(record["output"])]
+
+    def record(self, flac_path, fingerprint, encoder_settings, output_path, audio_md5="", loudness=None):
+        """Append the record of a successful conversion (safe to call from worker threads)"""
+        record = {
+            "source": self.source_key(flac_path),
+            **fingerprint,
+            "settings": encoder_settings,
+            "output": self.output_key(output_path)
+        }
+        if audio_md5:
+            record["audio_md5"] = audio_md5
+        if loudness:
+            record["loudness"] = loudness
+        self.append(record)
+
+    def add(self, record):
+        self.records[record["source"]] = record
+        if record.get("audio_md5"):
+            self.by_audio.setdefault(record["audio_md5"], set()).add(record["source"])
+
+    def append(self, record):
+        with self.lock:
+            self.add(record)
+            if self.file:
+                self.file.write(json.dumps(record) + "\n")
+                self.file.flush()
+
+    def orphans(self):
+        """Records whose source file no longer exists but whose output does"""
+        with self.lock:
+            records = list(self.records.values())
+        return [record for record in records
+                if not os.path.exists(record["source"]) and os.path.exists(record["output"])]
+
+    def compact(self):
+        """Rewrite the manifest keeping only the latest record per source"""
+        with self.lock:
+            records = list(self.records.values())
+        temp_path = self.path.with_name(self.path.name + ".tmp")
+        with open(temp_path, "w", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+        os.replace(temp_path, self.path)
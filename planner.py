@@ -0,0 +1,65 @@
+"""
+Output path planning: the MP3 name of every source is decided before it is converted.
+
+A filename template can give different tracks the same name (two "Intro" tracks of one artist,
+untagged files that all become "Unknown Artist - Unknown Title"), and names that differ only in case
+are one file on Windows, macOS and most players' file systems. Each destination keeps an index of
+the names taken, by case-folded path; a source whose name is taken by another gets a suffix instead
+of overwriting that MP3: " (disc 2, track 3)" or " (track 3)" when its numbers tell it apart,
+otherwise " (2)", " (3)"... The names recorded in the manifest are taken first and new sources claim
+theirs in scan order, so the same library always gets the same names.
+"""
+import itertools
+import os
+import threading
+from pathlib import Path
+
+def number(value):
+    """Leading number of a "3" or "3/12" track or disc tag, or None"""
+    try:
+        return int(str(value).split("/")[0])
+    except ValueError:
+        return None
+
+class OutputPlanner:
+    def __init__(self, manifest):
+        self.owners = {} # case-folded output path -> source key
+        self.claims = {} # source key -> output path
+        self.renamed = 0 # Sources given a suffixed name, in this batch
+        self.lock = threading.Lock()
+        with manifest.lock:
+            records = list(manifest.records.values())
+        for record in records:
+            self.take(record["source"], Path(record["output"]))
+
+    def key(self, path):
+        return os.path.normcase(os.path.abspath(path)).casefold()
+
+    def take(self, source, path):
+        old_path = self.claims.get(source)
+        if old_path is not None and self.owners.get(self.key(old_path)) == source:
+            del self.owners[self.key(old_path)] # The source's earlier name is free again
+        self.owners[self.key(path)] = source
+        self.claims[source] = path
+
+    def candidates(self, path, metadata):
+        """path, then the same name with a disc/track suffix when known, then numbered"""
+        yield path
+        track = number(metadata.get("track", ""))
+        disc = number((metadata.get("tags", {}).get("discnumber") or [""])[0])
+        if track is not None:
+            suffix = f" (disc {disc}, track {track})" if disc else f" (track {track})"
+            yield path.with_name(f"{path.stem}{suffix}{path.suffix}")
+        for n in itertools.count(2):
+            yield path.with_name(f"{path.stem} ({n}){path.suffix}")
+
+    def claim(self, source, path, metadata):
+        """The output path of source: path itself, or path with a suffix when another source has that name"""
+        with self.lock:
+            for candidate in self.candidates(Path(path), metadata):
+                owner = self.owners.get(self.key(candidate))
+                if owner is None or owner == source:
+                    if candidate != Path(path):
+                        self.renamed += 1
+                    self.take(source, candidate)
+                    return candidate
@@ -0,0 +1,85 @@
+"""
+Output profiles: several MP3 versions of every source in one run.
+
+A profile has a name, a quality ("320" for a constant bitrate in kbps, "V0" to "V9" for LAME's VBR
+presets), a destination folder (relative to the batch destination unless absolute) and a filename
+template. Each source is decoded once and its PCM feeds one encoder per profile. Without a "profiles"
+setting a batch has a single profile made from "quality" and "filename_template" that writes straight
+into the destination folder, as before profiles existed.
+"""
+import os
+import re
+from pathlib import Path
+
+QUALITY_PATTERN = re.compile(r"^(?:(\d{1,3})|[Vv]([0-9]))$")
+# Bitrates MP3 frames can have (MPEG-1 and MPEG-2 layer III), in kbps
+BITRATES = {8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160, 192, 224, 256, 320}
+
+class OutputProfile:
+    def __init__(self, name, quality, dest_folder, template):
+        self.name = name
+        self.quality = quality
+        self.dest_folder = Path(dest_folder)
+        self.template = template
+        # Set per batch by ConverterCore
+        self.manifest = None
+        self.planner = None
+        self.dedup = None
+        self.encoder_settings = None
+
+    def describe(self):
+        bitrate, vbr = parse_quality(self.quality)
+        return f"{self.name}: {f'{bitrate} kbps' if bitrate else f'VBR V{vbr}'} -> {self.dest_folder}"
+
+def parse_quality(quality):
+    """(bitrate, None) for a constant bitrate or (None, VBR preset) for "V0".."V9"; raises ValueError"""
+    match = QUALITY_PATTERN.match(str(quality).strip())
+    if not match or (match.group(1) and int(match.group(1)) not in BITRATES):
+        raise ValueError(f"Invalid MP3 quality {quality!r}: use a bitrate in kbps (e.g. 320) or V0 to V9")
+    return match.group(1), match.group(2)
+
+def lame_quality_args(quality):
+    bitrate, vbr = parse_quality(quality)
+    return ["-b", bitrate] if bitrate else ["-V", vbr]
+
+def ffmpeg_quality_args(quality):
+    bitrate, vbr = parse_quality(quality)
+    return ["-b:a", f"{bitrate}k"] if bitrate else ["-q:a", vbr]
+
+def profiles_from_settings(settings, dest_folder):
+    """
+    The output profiles of a batch into dest_folder, from the "profiles" setting (a list of dicts with
+    "quality" and optionally "name", "dest" and "template"). Raises ValueError for an invalid quality
+    or two profiles writing into the same folder.
+    """
+    specs = settings.get("profiles") or []
+    if not specs:
+        parse_quality(settings["quality"])
+        return [OutputProfile(str(settings["quality"]), settings["quality"], dest_folder, settings["filename_template"])]
+
+    profiles = []
+    folders = set()
+    for spec in specs:
+        quality = str(spec["quality"])
+        parse_quality(quality)
+        name = spec.get("name") or quality
+        profile = OutputProfile(name, quality, Path(dest_folder) / spec.get("dest", name),
+                                spec.get("template") or settings["filename_template"])
+        folder = os.path.normcase(os.path.abspath(profile.dest_folder))
+        if folder in folders:
+            raise ValueError(f"Two output profiles write into {profile.dest_folder}")
+        folders.add(folder)
+        profiles.append(profile)
+    return profiles
+
+def parse_profile(text):
+    """A profile dict from the command line form QUALITY[:FOLDER[:TEMPLATE]]"""
+    quality, _, rest = text.partition(":")
+    dest, _, template = rest.partition(":")
+    parse_quality(quality)
+    spec = {"quality": quality}
+    if dest:
+        spec["dest"] = dest
+    if template:
+        spec["template"] = template
+    return spec
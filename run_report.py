@@ -0,0 +1,129 @@
+"""
+Structured report of a conversion batch.
+
+Collects one record per file (time spent in each stage, bytes read and written, outcome)
+and, when the batch ends, adds aggregate percentiles per stage, the CPU time used by the
+FFmpeg/LAME child processes and the slowest files. The report is saved as JSON next to the output.
+"""
+import json
+import math
+import os
+import threading
+import time
+from pathlib import Path
+
+try:
+    import resource # Unix only: CPU time of child processes
+except ImportError:
+    resource = None
+
+REPORT_FILENAME = "conversion_report.json"
+
+# Number of slowest files listed in the report
+SLOWEST_FILES = 10
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(fraction * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+def child_cpu_seconds():
+    """(user, system) CPU seconds of all finished child processes, or None where unavailable"""
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime, usage.ru_stime
+
+class RunReport:
+    def __init__(self, source_folder, dest_folder, settings):
+        self.source_folder = str(source_folder)
+        self.dest_folder = Path(dest_folder)
+        self.settings = settings
+        self.files = []
+        self.albums = [] # Album loudness measurements, when ReplayGain is enabled
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self.cpu_start = child_cpu_seconds()
+        self.report = None
+
+    def add_file(self, record):
+        """Add the record of one processed file (safe to call from worker threads)"""
+        with self.lock:
+            self.files.append(record)
+
+    def finish(self, summary):
+        """Build the final report from the file records and the batch summary"""
+        wall_seconds = time.perf_counter() - self.start
+        with self.lock:
+            files = list(self.files)
+
+        stages = {}
+        for record in files:
+            for stage, seconds in record["stages"].items():
+                stages.setdefault(stage, []).append(seconds)
+        aggregates = {}
+        for stage, values in stages.items():
+            values.sort()
+            aggregates[stage] = {
+                "count": len(values),
+                "total": round(sum(values), 3),
+                "mean": round(sum(values) / len(values), 4),
+                "p50": round(percentile(values, 0.50), 4),
+                "p90": round(percentile(values, 0.90), 4),
+                "p99": round(percentile(values, 0.99), 4),
+                "max": round(values[-1], 4)
+            }
+
+        cpu_end = child_cpu_seconds()
+        child_cpu = None
+        if self.cpu_start and cpu_end:
+            child_cpu = {"user": round(cpu_end[0] - self.cpu_start[0], 3),
+                         "system": round(cpu_end[1] - self.cpu_start[1], 3)}
+
+        slowest = sorted(files, key=lambda record: record["stages"].get("total", 0), reverse=True)[:SLOWEST_FILES]
+        self.report = {
+            "started_at": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started_at)),
+            "wall_seconds": round(wall_seconds, 3),
+            "source_folder": self.source_folder,
+            "dest_folder": str(self.dest_folder),
+            "settings": self.settings,
+            "summary": {key: summary[key] for key in ("total", "converted", "reused", "skipped", "failed", "cancelled")},
+            "bytes_read": sum(record.get("bytes_read", 0) for record in files),
+            "bytes_written": sum(record.get("bytes_written", 0) for record in files),
+            "child_cpu_seconds": child_cpu,
+            "stages": aggregates,
+            "slowest_files": [{"source": record["source"], "seconds": record["stages"].get("total", 0)}
+                              for record in slowest],
+            "files": files
+        }
+        if self.albums:
+            self.report["albums"] = self.albums
+        return self.report
+
+    def save(self):
+        """Write the report to the destination folder and return its path"""
+        path = self.dest_folder / REPORT_FILENAME
+        temp_path = path.with_name(path.name + ".tmp")
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(self.report, f, indent=1)
+        os.replace(temp_path, path)
+        return path
+
+    def summary_lines(self):
+        """Short human readable summary of the finished report"""
+        report = self.report
+        lines = [f"Run report: {report['wall_seconds']:.1f}s wall, "
+                 f"{report['bytes_read'] / 1e6:.1f} MB read, {report['bytes_written'] / 1e6:.1f} MB written"]
+        if report["child_cpu_seconds"]:
+            cpu = report["child_cpu_seconds"]
+            lines.append(f"  FFmpeg/LAME CPU time: {cpu['user'] + cpu['system']:.1f}s")
+        for stage, stats in sorted(report["stages"].items()):
+            lines.append(f"  {stage}: total {stats['total']:.2f}s, p50 {stats['p50']:.3f}s, "
+                         f"p90 {stats['p90']:.3f}s, max {stats['max']:.3f}s")
+        if report["slowest_files"]:
+            slowest = report["slowest_files"][0]
+            lines.append(f"  Slowest file: {Path(slowest['source']).name} ({slowest['seconds']:.2f}s)")
+        return lines
@@ -0,0 +1,58 @@
+"""
+Streaming FLAC library scanner.
+
+Walks a folder tree with os.scandir and yields FLAC files one at a time, so conversion can start
+while the scan is still running and memory use does not grow with the size of the library.
+"""
+import os
+from fnmatch import fnmatch
+from pathlib import Path
+
+def matches_any(relative_path, patterns):
+    """True if the relative POSIX path, or just its file name, matches one of the glob patterns"""
+    name = relative_path.rsplit("/", 1)[-1]
+    return any(fnmatch(relative_path, pattern) or fnmatch(name, pattern) for pattern in patterns)
+
+def scan_flac_files(source_folder, recursive=True, include=(), exclude=(), skip_dirs=()):
+    """
+    Yield the FLAC files under source_folder in a stable order (sorted by name within each folder,
+    subfolders after the files of their parent).
+
+    include/exclude are glob patterns matched against the path relative to source_folder
+    (e.g. "Live/*" or "*demo*"); a file must match one of the include patterns, if any are given,
+    and none of the exclude patterns. Excluded folders are not descended into.
+    skip_dirs are folders never scanned, such as a destination folder inside the source.
+    """
+    source_folder = Path(source_folder)
+    skip_dirs = {os.path.normcase(os.path.abspath(d)) for d in skip_dirs}
+    # Depth-first walk with an explicit stack: only one folder listing is held per level
+    stack = [(source_folder, "")]
+    while stack:
+        folder, relative_folder = stack.pop()
+        try:
+            with os.scandir(folder) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+        except OSError:
+            continue # Unreadable folder: skip it rather than abort the whole scan
+
+        subfolders = []
+        for entry in entries:
+            relative_path = f"{relative_folder}{entry.name}"
+            try:
+                if entry.is_dir(follow_symlinks=False): # Do not follow links, they can create cycles
+                    if not recursive or matches_any(relative_path, exclude):
+                        continue
+                    if os.path.normcase(os.path.abspath(entry.path)) in skip_dirs:
+                        continue
+                    subfolders.append((Path(entry.path), relative_path + "/"))
+                elif entry.is_file() and entry.name.lower().endswith(".flac"):
+                    if include and not matches_any(relative_path, include):
+                        continue
+                    if matches_any(relative_path, exclude):
+                        continue
+                    yield Path(entry.path)
+            except OSError:
+                continue
+
+        # Reversed so the stack pops subfolders in name order
+        stack.extend(reversed(subfolders))
@@ -0,0 +1,51 @@
+"""
+Live throughput and ETA from the encoders' progress output.
+
+The progress readers of jobcontrol.py follow how far into its track each running FFmpeg/LAME
+encoder is, from the stats lines the processes print anyway (FFmpeg's "time=", LAME's frame
+counter). A ThroughputSampler looks at them every "throughput_interval" seconds from the thread
+collecting the batch's results, so its cost depends on the number of running jobs, not on how many
+progress lines they print. The audio seconds processed per wall-clock second (the realtime factor)
+are smoothed exponentially over "throughput_smoothing" seconds, and the audio still to convert
+divided by that gives the ETA, so the estimate moves during long tracks, not only between files.
+"""
+import math
+import time
+
+class ThroughputSampler:
+    def __init__(self, control, interval=1.0, smoothing=20.0):
+        self.control = control
+        self.interval = interval
+        self.smoothing = smoothing
+        self.last_time = time.perf_counter()
+        self.last_processed = 0.0
+        self.next_sample = self.last_time + interval
+        self.rate = None # Smoothed audio seconds per wall-clock second, None until audio was processed
+        self.current_rate = 0.0 # Over the last interval only
+
+    def due(self):
+        return time.perf_counter() >= self.next_sample
+
+    def sample(self):
+        """Update the rates from the running and finished jobs; returns the audio seconds of the running jobs"""
+        now = time.perf_counter()
+        finished, running = self.control.audio_progress()
+        processed = finished + running
+        elapsed = now - self.last_time
+        self.next_sample = now + self.interval
+        # While paused nothing is processed; keep the rate the batch will continue at
+        if elapsed > 0 and not self.control.is_paused():
+            self.current_rate = max(0.0, processed - self.last_processed) / elapsed
+            if self.rate is not None:
+                self.rate += (1 - math.exp(-elapsed / self.smoothing)) * (self.current_rate - self.rate)
+            elif self.current_rate > 0:
+                self.rate = self.current_rate
+        self.last_time = now
+        self.last_processed = processed
+        return running
+
+    def eta(self, remaining_seconds):
+        """Seconds until remaining_seconds of audio are converted at the smoothed rate, or None"""
+        if not self.rate:
+            return None
+        return max(0.0, remaining_seconds) / self.rate
@@ -0,0 +1,98 @@
+"""
+Cached discovery of the external tools (LAME, FFmpeg, FFprobe).
+
+Probing a tool means starting it, once for its version and, for FFmpeg, again for its encoders and
+the sample formats its libmp3lame accepts; on Windows or a cold disk that takes seconds. The results
+are kept in the "tool_probes" setting, keyed by the executable's path and checked against its size
+and modification time, so a tool is only run again after it was replaced or updated. Front ends that
+save their settings (the GUI's config.json) therefore skip the probes entirely on the next start.
+"""
+import os
+import subprocess
+import threading
+
+# Bumped when the probe records more, so entries written by older versions are probed again
+PROBE_FORMAT = 1
+
+def tool_signature(exec_path):
+    """[size, mtime in ns] of an executable, or None if it cannot be read"""
+    try:
+        stat = os.stat(exec_path)
+        return [stat.st_size, stat.st_mtime_ns]
+    except OSError:
+        return None
+
+def run_tool(args):
+    """(return code, stdout, stderr) of a short tool run; return code None if it could not be run"""
+    try:
+        result = subprocess.run(args, capture_output=True, text=True, timeout=10)
+        return result.returncode, result.stdout, result.stderr
+    except Exception as e:
+        return None, "", str(e)
+
+def parse_sample_formats(help_text):
+    """Sample formats from the "Supported sample formats:" line of ffmpeg -h encoder=..."""
+    for line in help_text.splitlines():
+        label, _, formats = line.strip().partition(":")
+        if label == "Supported sample formats":
+            return formats.split()
+    return []
+
+class Toolchain:
+    def __init__(self, settings):
+        self.settings = settings
+        self.settings["tool_probes"] = dict(settings.get("tool_probes") or {})
+        # Held for cache lookups and stores only, never while a tool runs: a thread probing a slow tool must
+        # not block the GUI thread reading another's cached probe. Two threads may probe one tool twice.
+        self.lock = threading.Lock()
+        self.changed = False # Set when a probe ran, so the front end knows to save its settings
+
+    def cached(self, exec_path):
+        """The stored probe of an executable if it has not changed since, else None"""
+        entry = self.settings["tool_probes"].get(exec_path)
+        if not entry or entry.get("format") != PROBE_FORMAT:
+            return None
+        if entry.get("signature") != tool_signature(exec_path):
+            return None
+        return entry
+
+    def store(self, exec_path, entry):
+        # Replace the dict rather than modify it, so a thread saving the settings never sees it change
+        with self.lock:
+            self.settings["tool_probes"] = {**self.settings["tool_probes"], exec_path: entry}
+            self.changed = True
+
+    def probe(self, exec_path, version_arg="-version"):
+        """
+        {"ok", "error", "version"} of an executable, from the cache or by running it with version_arg.
+        "error" holds the tool's error output when it did not run successfully.
+        """
+        with self.lock:
+            entry = self.cached(exec_path)
+        if entry is not None and entry.get("version_arg") == version_arg:
+            return entry
+        signature = tool_signature(exec_path)
+        returncode, stdout, stderr = run_tool([exec_path, version_arg])
+        lines = stdout.strip().splitlines()
+        entry = {"format": PROBE_FORMAT, "signature": signature, "version_arg": version_arg,
+                 "ok": returncode == 0, "error": "" if returncode == 0 else stderr.strip(),
+                 "version": lines[0] if lines else ""}
+        if signature is not None:
+            self.store(exec_path, entry)
+        return entry
+
+    def ffmpeg_capabilities(self, ffmpeg_path):
+        """{"libmp3lame": bool, "sample_formats": [...]} of an FFmpeg build, probed once per binary"""
+        entry = self.probe(ffmpeg_path)
+        if "capabilities" in entry:
+            return entry["capabilities"]
+        returncode, stdout, _ = run_tool([ffmpeg_path, "-hide_banner", "-encoders"])
+        libmp3lame = returncode == 0 and " libmp3lame " in stdout
+        sample_formats = []
+        if libmp3lame:
+            _, help_text, _ = run_tool([ffmpeg_path, "-hide_banner", "-h", "encoder=libmp3lame"])
+            sample_formats = parse_sample_formats(help_text)
+        capabilities = {"libmp3lame": libmp3lame, "sample_formats": sample_formats}
+        if entry.get("signature") is not None:
+            self.store(ffmpeg_path, {**entry, "capabilities": capabilities})
+        return capabilities
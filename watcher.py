@@ -0,0 +1,270 @@
+"""
+Watch mode: convert FLAC files as they arrive in the source folder.
+
+On Linux the folder tree is watched with inotify (through ctypes, no extra dependency), so the
+process sleeps until something changes; elsewhere, or when inotify is unavailable, the tree is
+rescanned every few seconds. A changed file is converted once it has stopped changing: no events
+for "watch_settle_seconds" and the same size and modification time on two checks. Each batch of
+settled files goes through ConverterCore.convert_files with an explicit file list, so an arrival
+costs only the work for that file, not a rescan of the library.
+"""
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import time
+from pathlib import Path
+
+from scanner import matches_any, scan_flac_files
+
+# inotify event masks (linux/inotify.h)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+              | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+EVENT_HEADER = struct.Struct("iIII") # wd, mask, cookie, name length
+
+# Longest sleep while nothing is pending, so a stop request is noticed without busy waiting
+IDLE_WAKEUP_SECONDS = 1.0
+
+class FolderWatcher:
+    """Base class: which files under the source folder are of interest"""
+    def __init__(self, source_folder, settings, skip_dirs=()):
+        self.source_folder = Path(source_folder).absolute()
+        self.recursive = settings.get("recursive", True)
+        self.include = settings.get("include_patterns", [])
+        self.exclude = settings.get("exclude_patterns", [])
+        self.skip_dirs = {os.path.normcase(os.path.abspath(d)) for d in skip_dirs}
+
+    def is_wanted(self, path):
+        if not path.name.lower().endswith(".flac"):
+            return False
+        try:
+            relative_path = path.relative_to(self.source_folder).as_posix()
+        except ValueError:
+            return False
+        if self.include and not matches_any(relative_path, self.include):
+            return False
+        return not matches_any(relative_path, self.exclude)
+
+    def is_watched_dir(self, path):
+        """False for folders never scanned: the destination, excluded folders and, if not recursive, subfolders"""
+        if os.path.normcase(str(path)) in self.skip_dirs:
+            return False
+        if path == self.source_folder:
+            return True
+        if not self.recursive:
+            return False
+        relative_path = path.relative_to(self.source_folder).as_posix()
+        return not matches_any(relative_path, self.exclude)
+
+    def scan(self, folder):
+        """The wanted FLAC files under folder"""
+        return [path for path in scan_flac_files(folder, recursive=self.recursive, skip_dirs=self.skip_dirs)
+                if self.is_wanted(Path(path).absolute())]
+
+    def changes(self, timeout):
+        """Wait up to timeout seconds (None = until something happens) and return the changed FLAC paths"""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+class InotifyWatcher(FolderWatcher):
+    """Linux inotify watches on every folder of the tree; raises OSError if inotify cannot be used"""
+    name = "inotify"
+
+    def __init__(self, source_folder, settings, skip_dirs=()):
+        super().__init__(source_folder, settings, skip_dirs)
+        libc_name = ctypes.util.find_library("c")
+        if not libc_name:
+            raise OSError("C library not found")
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self.libc, "inotify_init1"):
+            raise OSError("inotify is not available")
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.folders = {} # watch descriptor -> folder path
+        try:
+            self.add_tree(self.source_folder)
+        except OSError:
+            self.close()
+            raise
+
+    def add_tree(self, folder):
+        """Watch folder and its subfolders; returns the FLAC files already in them"""
+        if not self.is_watched_dir(folder):
+            return []
+        stack = [folder]
+        while stack:
+            current = stack.pop()
+            if not self.is_watched_dir(current):
+                continue
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(current), WATCH_MASK)
+            if wd < 0:
+                error = ctypes.get_errno()
+                if error == errno.ENOSPC:
+                    raise OSError(error, "inotify watch limit reached (fs.inotify.max_user_watches)")
+                continue # Folder vanished or is unreadable
+            self.folders[wd] = current
+            try:
+                with os.scandir(current) as it:
+                    stack.extend(Path(entry.path) for entry in it if entry.is_dir(follow_symlinks=False))
+            except OSError:
+                continue
+        return self.scan(folder)
+
+    def changes(self, timeout):
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        changed = set()
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, name_length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = data[offset:offset + name_length].rstrip(b"\0")
+                offset += name_length
+                if mask & IN_Q_OVERFLOW:
+                    # Events were lost: fall back to a rescan, the manifest skips what is unchanged
+                    changed.update(self.scan(self.source_folder))
+                    continue
+                folder = self.folders.get(wd)
+                if mask & IN_IGNORED:
+                    self.folders.pop(wd, None)
+                    continue
+                if folder is None or not name:
+                    continue
+                path = folder / os.fsdecode(name)
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        changed.update(self.add_tree(path))
+                elif self.is_wanted(path):
+                    changed.add(path)
+        return sorted(changed)
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+class PollingWatcher(FolderWatcher):
+    """Rescans the tree every poll_interval seconds and reports files whose size or mtime changed"""
+    name = "polling"
+
+    def __init__(self, source_folder, settings, skip_dirs=()):
+        super().__init__(source_folder, settings, skip_dirs)
+        self.poll_interval = settings.get("watch_poll_interval", 10)
+        self.snapshot = self.take_snapshot()
+        self.next_poll = time.monotonic() + self.poll_interval
+
+    def take_snapshot(self):
+        snapshot = {}
+        for path in self.scan(self.source_folder):
+            try:
+                stat = os.stat(path)
+                snapshot[path] = (stat.st_size, stat.st_mtime_ns)
+            except OSError:
+                continue
+        return snapshot
+
+    def changes(self, timeout):
+        wait = self.next_poll - time.monotonic()
+        if timeout is not None:
+            wait = min(wait, timeout)
+        if wait > 0:
+            time.sleep(wait)
+        if time.monotonic() < self.next_poll:
+            return []
+        self.next_poll = time.monotonic() + self.poll_interval
+        snapshot = self.take_snapshot()
+        changed = [path for path, signature in snapshot.items() if self.snapshot.get(path) != signature]
+        self.snapshot = snapshot
+        return sorted(changed)
+
+def create_watcher(source_folder, settings, skip_dirs, log):
+    """inotify where available, otherwise polling"""
+    if settings.get("watch_method", "auto") != "polling":
+        try:
+            return InotifyWatcher(source_folder, settings, skip_dirs)
+        except (OSError, AttributeError) as e:
+            log(f"inotify unavailable ({e}), polling every {settings.get('watch_poll_interval', 10)} seconds")
+    return PollingWatcher(source_folder, settings, skip_dirs)
+
+def file_signature(path):
+    try:
+        stat = os.stat(path)
+        return stat.st_size, stat.st_mtime_ns
+    except OSError:
+        return None
+
+def watch_folder(core, source_folder, dest_folder, stop_event):
+    """
+    Convert what is new in source_folder, then keep converting FLAC files as they arrive or change
+    until stop_event is set or a batch is cancelled.
+    """
+    settle_seconds = core.settings.get("watch_settle_seconds", 5)
+    # Watching starts before the catch-up batch, which can take hours: files arriving during it are
+    # queued by inotify or differ from the polling snapshot, and are picked up once it is done
+    watcher = create_watcher(source_folder, core.settings, [dest_folder], core.log)
+    pending = {} # path -> (signature at the last check, time of the last change)
+    try:
+        summary = core.convert_files(source_folder, dest_folder) # Catch up with what arrived while not watching
+        if summary["was_cancelled"]:
+            return
+        core.log(f"Watching {source_folder} for new FLAC files ({watcher.name})")
+        core.emit("watching", source=str(source_folder), method=watcher.name)
+        while not stop_event.is_set():
+            now = time.monotonic()
+            if pending:
+                # Wake up when the earliest pending file may have settled
+                timeout = max(0.0, min(changed_at for _, changed_at in pending.values()) + settle_seconds - now)
+                timeout = min(timeout, IDLE_WAKEUP_SECONDS)
+            else:
+                timeout = IDLE_WAKEUP_SECONDS
+            for path in watcher.changes(timeout):
+                pending[path] = (file_signature(path), time.monotonic())
+
+            now = time.monotonic()
+            settled = []
+            for path, (signature, changed_at) in list(pending.items()):
+                if now - changed_at < settle_seconds:
+                    continue
+                current = file_signature(path)
+                if current is None: # Deleted or moved away before it settled
+                    del pending[path]
+                elif current != signature: # Still being written without events (e.g. polling, network shares)
+                    pending[path] = (current, now)
+                else:
+                    settled.append(path)
+                    del pending[path]
+
+            if settled and not stop_event.is_set():
+                core.log(f"{len(settled)} new or changed FLAC files settled, converting")
+                summary = core.convert_files(source_folder, dest_folder, files=settled)
+                if summary["was_cancelled"]:
+                    break
+    finally:
+        watcher.close()
+    core.log(f"Stopped watching {source_folder}")